@@ -23,7 +23,7 @@ from concurrent.futures import ThreadPoolExecutor
 from threading import Event
 import time
 
-log = logging.getLogger("cloudinstall.async")
+log = logging.getLogger("cloudinstall.background")
 
 
 class ThreadCancelledException(Exception):
@@ -42,7 +42,7 @@ def submit(func, exc_callback):
         if e:
             exc_callback(e)
     if ShutdownEvent.is_set():
-        log.debug("ignoring async.submit due to impending shutdown.")
+        log.debug("ignoring background.submit due to impending shutdown.")
         return
     f = AsyncPool.submit(func)
     f.add_done_callback(cb)
@@ -24,10 +24,10 @@ import yaml
 from queue import Queue
 import shutil
 import subprocess
-import requests
 
-from macumba import MacumbaError, ServerError
-from cloudinstall import async
+from macumba import MacumbaError
+from macumba.charmstore import charm_store
+from cloudinstall import background
 from cloudinstall import utils
 from cloudinstall.placement.controller import AssignmentType
 
@@ -56,10 +56,18 @@ def query_cs(charm, series='trusty'):
     :param str charm: charm name
     :param str series: series, defaults. trusty
     """
-    charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
-    url = path.join(charm_store_url, series, charm)
-    r = requests.get(url)
-    return r.json()
+    return charm_store.query(charm, series)
+
+
+def query_many(charm_classes, series='trusty'):
+    """ Looks up the charm store entries of several charm classes in
+    parallel, warming the cache used when they are deployed.
+
+    :returns: list of metadata, or the lookup's error, per charm class
+    """
+    return charm_store.query_many([c.charm_store_name()
+                                   for c in charm_classes],
+                                  series, return_exceptions=True)
 
 
 class DisplayPriorities:
@@ -184,6 +192,15 @@ export OS_REGION_NAME=\"RegionOne\"
             return class_.charm_name
         return class_.__name__.lower()
 
+    @classmethod
+    def charm_store_name(class_):
+        """ Charm name as looked up in the charm store by deploy(), with
+        the pinned revision if there is one
+        """
+        if class_.charm_rev:
+            return "{}-{}".format(class_.charm_name, class_.charm_rev)
+        return class_.charm_name
+
     def constraints_arg(self):
         """ converts self.constraints into arg form for juju CLI"""
         args = []
@@ -427,28 +444,22 @@ class CharmQueue:
         """ Setup charm relations
         """
         valid_relations = self.filter_valid_relations()
-        completed_relations = []
         if len(valid_relations) <= 0:
             return
         log.debug("Processing relations: {}".format(valid_relations))
-        while len(valid_relations) != len(completed_relations):
-            for relation_a, relation_b in valid_relations:
-                async.sleep_until(0)
-                try:
-                    log.debug("Calling juju.add_relation({}, {})".format(
-                        relation_a, relation_b))
-                    self.juju.add_relation(relation_a,
-                                           relation_b)
-                    completed_relations.append((relation_a,
-                                                relation_b))
-                except ServerError as e:
-                    msg = ('Failure in add_relation({}, {}): {}'.format(
-                        relation_a,
-                        relation_b,
-                        e))
-                    log.exception(msg)
-                    self.ui.status_info_message(msg)
-                    raise e
+        background.sleep_until(0)
+        log.debug("Calling juju.add_relations({})".format(valid_relations))
+        results = self.juju.add_relations(valid_relations,
+                                          return_exceptions=True)
+        for (relation_a, relation_b), rv in zip(valid_relations, results):
+            if isinstance(rv, Exception):
+                msg = ('Failure in add_relation({}, {}): {}'.format(
+                    relation_a,
+                    relation_b,
+                    rv))
+                log.error(msg)
+                self.ui.status_info_message(msg)
+                raise rv
         self.config.setopt('relations_complete', True)
 
     def _charm_classes(self):
@@ -467,7 +478,7 @@ class CharmQueue:
         for charm in self._charm_classes():
             self.charm_post_proc_q.put(charm)
 
-        async.sleep_until(0)
+        background.sleep_until(0)
 
         log.debug("Starting charm post processing watcher.")
         while not self.charm_post_proc_q.empty():
@@ -482,5 +493,5 @@ class CharmQueue:
                 log.exception(msg)
                 self.ui.status_error_message(msg)
 
-            async.sleep_until(10)
+            background.sleep_until(10)
         self.config.setopt('postproc_complete', True)
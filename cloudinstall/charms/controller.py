@@ -44,9 +44,9 @@ class CharmNovaCloudController(CharmBase):
 
     def post_proc(self):
         """ post processing for nova-cloud-controller """
-        svc = self.juju_state.service(self.charm_name)
+        svc = self.juju_state.service(self.charm_name, filtered=True)
         unit = svc.unit(self.charm_name)
-        k_svc = self.juju_state.service('keystone')
+        k_svc = self.juju_state.service('keystone', filtered=True)
         keystone = k_svc.unit('keystone')
         openstack_password = self.config.getopt('openstack_password')
         public_address = keystone.public_address
@@ -48,7 +48,7 @@ class CharmKeystone(CharmBase):
         if self._is_auth_url_valid():
             return False
 
-        service = self.juju_state.service('keystone')
+        service = self.juju_state.service('keystone', filtered=True)
         if len(service.units) < 1:
             return True
 
@@ -45,7 +45,7 @@ class CharmNeutron(CharmBase):
 
     def post_proc(self):
         """ performs additional network configuration for charm """
-        svc = self.juju_state.service(self.charm_name)
+        svc = self.juju_state.service(self.charm_name, filtered=True)
         unit = svc.unit(self.charm_name)
 
         if unit.machine_id == '-1':
@@ -119,6 +119,16 @@ class Config:
     def placements_filename(self):
         return os.path.join(self.cfg_path, 'placements.yaml')
 
+    @property
+    def juju_metrics_filename(self):
+        """ juju api request metrics, written on exit """
+        return os.path.join(self.cfg_path, 'juju-metrics.json')
+
+    @property
+    def juju_status_filename(self):
+        """ last juju status, shown while reconnecting on the next start """
+        return os.path.join(self.cfg_path, 'juju-status.json.gz')
+
     def is_single(self):
         if self.getopt('install_type') and \
            'Single' in self.getopt('install_type'):
@@ -25,7 +25,7 @@ import time
 import platform
 import shutil
 from subprocess import call, check_call, check_output, STDOUT
-from cloudinstall import async, utils, netutils
+from cloudinstall import background, utils, netutils
 from cloudinstall.api.container import (LXCContainer, LXDContainer,
                                         NoContainerIPException,
                                         ContainerRunException)
@@ -449,8 +449,8 @@ class SingleInstall:
         if self.config.getopt('headless'):
             self.do_install()
         else:
-            async.submit(self.do_install,
-                         self.display_controller.show_exception_message)
+            background.submit(self.do_install,
+                              self.display_controller.show_exception_message)
 
     def do_install(self):
         self.display_controller.status_info_message("Building environment")
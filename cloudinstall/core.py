@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import logging
 import time
 
@@ -20,20 +21,21 @@ from os import path, getenv
 
 from operator import attrgetter
 
-from cloudinstall import async
+from cloudinstall import background
 from cloudinstall.config import OPENSTACK_RELEASE_LABELS
 from cloudinstall import utils
 from cloudinstall.alarms import AlarmMonitor
 from cloudinstall.state import ControllerState
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import Freshness, WatchingJujuState
 from cloudinstall.maas import (connect_to_maas, FakeMaasState,
                                MaasMachineStatus)
-from cloudinstall.charms import CharmQueue
+from cloudinstall.charms import CharmQueue, query_many
 from cloudinstall.log import PrettyLog
 from cloudinstall.placement.controller import (PlacementController,
                                                AssignmentType)
 
-from macumba import JujuClient
+from macumba import JujuClient, MacumbaError
+from macumba.recording import RecordingJujuClient, ReplayJujuClient
 from macumba import Jobs as JujuJobs
 
 
@@ -42,6 +44,9 @@ log = logging.getLogger('cloudinstall.core')
 
 class FakeJujuState:
 
+    version = 0
+    refresh_interval = 1
+
     @property
     def services(self):
         return []
@@ -52,11 +57,26 @@ class FakeJujuState:
     def invalidate_status_cache(self):
         "does nothing"
 
+    def refresh(self):
+        "does nothing"
+
+    def start_refresher(self, interval=None):
+        "does nothing"
+
+    def wait_live(self, timeout=None):
+        return True
+
+    def freshness(self):
+        return Freshness(0, None, True, False)
+
 
 class Controller:
 
     """ Controller for Juju deployments and Maas machine init """
 
+    # seconds to wait for a live juju status before giving up
+    live_status_timeout = 120
+
     def __init__(self, ui, config, loop):
         self.ui = ui
         self.ui.controller = self
@@ -67,6 +87,7 @@ class Controller:
         self.maas = None
         self.maas_state = None
         self.nodes = []
+        self.nodes_version = None
         self.juju_m_idmap = None  # for single, {instance_id: machine id}
         self.deployed_charm_classes = []
         self.placement_controller = None
@@ -96,8 +117,8 @@ class Controller:
             interval = self.config.node_install_wait_interval
         elif current_state == ControllerState.ADD_SERVICES:
             def submit_deploy():
-                async.submit(self.deploy_new_services,
-                             self.ui.show_exception_message)
+                background.submit(self.deploy_new_services,
+                                  self.ui.show_exception_message)
 
             self.ui.render_add_services_dialog(
                 submit_deploy, self.cancel_add_services)
@@ -120,16 +141,21 @@ class Controller:
             return
         deployed_services = sorted(self.juju_state.services,
                                    key=attrgetter('service_name'))
-        deployed_service_names = [s.service_name for s in deployed_services]
 
-        charm_classes = sorted(
-            [m.__charm_class__ for m in
-             utils.load_charms(self.config.getopt('charm_plugin_dir'))
-             if m.__charm_class__.charm_name in
-             deployed_service_names],
-            key=attrgetter('charm_name'))
+        # nodes only need rebuilding when juju's status changed
+        if self.nodes_version != self.juju_state.version:
+            deployed_service_names = [s.service_name
+                                      for s in deployed_services]
+
+            charm_classes = sorted(
+                [m.__charm_class__ for m in
+                 utils.load_charms(self.config.getopt('charm_plugin_dir'))
+                 if m.__charm_class__.charm_name in
+                 deployed_service_names],
+                key=attrgetter('charm_name'))
 
-        self.nodes = list(zip(charm_classes, deployed_services))
+            self.nodes = list(zip(charm_classes, deployed_services))
+            self.nodes_version = self.juju_state.version
 
         if len(self.nodes) == 0:
             return
@@ -146,13 +172,74 @@ class Controller:
             state_server = 'localhost:17070'
         else:
             state_server = self.config.juju_env['state-servers'][0]
-        self.juju = JujuClient(
-            url=path.join('wss://', state_server),
-            password=self.config.juju_api_password)
+        snapshot_filename = self.config.juju_status_filename
+        metrics_filename = self.config.juju_metrics_filename
+        url = path.join('wss://', state_server)
+        password = self.config.juju_api_password
+        if getenv("JUJU_API_REPLAY"):
+            # play back a recording instead of talking to juju, e.g.
+            # to profile the status screen offline
+            self.juju = ReplayJujuClient(
+                getenv("JUJU_API_REPLAY"),
+                speed=float(getenv("JUJU_API_REPLAY_SPEED", 1)))
+            # don't overwrite the real environment's files
+            snapshot_filename = None
+            metrics_filename = None
+        elif getenv("JUJU_API_RECORD"):
+            self.juju = RecordingJujuClient(getenv("JUJU_API_RECORD"),
+                                            url=url, password=password)
+            atexit.register(self.juju.close)
+        else:
+            self.juju = JujuClient(url=url, password=password)
+        if metrics_filename is not None:
+            atexit.register(self.juju.metrics.dump, metrics_filename)
         self.juju.login()
-        self.juju_state = JujuState(self.juju)
+        environment = None
+        if snapshot_filename is not None:
+            # snapshots are only loaded into the environment they were
+            # saved from
+            try:
+                environment = self.juju.info().get('UUID')
+            except MacumbaError:
+                log.exception("Could not get juju environment info.")
+            environment = environment or url
+        self.juju_state = WatchingJujuState(
+            self.juju, snapshot_filename=snapshot_filename,
+            environment=environment)
+        atexit.register(self.juju_state.save_snapshot)
+        if not self.config.getopt('headless') and \
+           self.juju_state.load_snapshot():
+            # draw the last known status now, catch up in the background.
+            # anything deciding what to do calls juju_state.wait_live()
+            log.debug("Loaded juju status saved by an earlier run.")
+            background.submit(self.start_juju_state,
+                              self.ui.show_exception_message)
+        else:
+            self.start_juju_state()
         log.debug('Authenticated against juju api.')
 
+    def start_juju_state(self):
+        """ Keeps juju_state current, by watching or else polling """
+        try:
+            self.juju_state.start()
+        except MacumbaError:
+            log.exception("Could not start juju allwatcher, "
+                          "polling status instead.")
+            self.juju_state.start_refresher()
+
+    def wait_live_status(self):
+        """ Waits for a status fetched from juju, rather than one loaded
+        from a snapshot, raising if none arrives in live_status_timeout
+        seconds instead of hanging.
+
+        :returns: True
+        """
+        if self.juju_state.wait_live(self.live_status_timeout):
+            return True
+        reason = self.juju_state.freshness().last_error or \
+            "no status after {} seconds".format(self.live_status_timeout)
+        raise Exception("Could not get juju status: {}".format(reason))
+
     def initialize(self):
         """Authenticates against juju/maas and sets up placement controller."""
         if getenv("FAKE_API_DATA"):
@@ -185,6 +272,7 @@ class Controller:
             # controller to use the deployments in the file as
             # assignments:
             if len(self.placement_controller.machines_pending()) == 0 and \
+               self.wait_live_status() and \
                len(self.juju_state.machines()) == 0:
                 self.placement_controller.set_assignments_from_deployments()
                 log.info("Using deployments saved from previous install"
@@ -205,8 +293,8 @@ class Controller:
             if self.config.getopt('headless'):
                 self.begin_deployment()
             else:
-                async.submit(self.begin_deployment,
-                             self.ui.show_exception_message)
+                background.submit(self.begin_deployment,
+                                  self.ui.show_exception_message)
             return
 
         if self.config.getopt('edit_placement') or \
@@ -217,8 +305,8 @@ class Controller:
             if self.config.getopt('headless'):
                 self.begin_deployment()
             else:
-                async.submit(self.begin_deployment,
-                             self.ui.show_exception_message)
+                background.submit(self.begin_deployment,
+                                  self.ui.show_exception_message)
 
     def commit_placement(self):
         self.config.setopt('current_state', ControllerState.SERVICES.value)
@@ -228,10 +316,12 @@ class Controller:
         if self.config.getopt('headless'):
             self.begin_deployment()
         else:
-            async.submit(self.begin_deployment,
-                         self.ui.show_exception_message)
+            background.submit(self.begin_deployment,
+                              self.ui.show_exception_message)
 
     def begin_deployment(self):
+        # not on the status saved by an earlier run
+        self.wait_live_status()
         if self.config.is_multi():
 
             # now all machines are added
@@ -258,7 +348,7 @@ class Controller:
                                             "start: {}".format(summary))
                 _previous_summary = summary
 
-            async.sleep_until(1)
+            background.sleep_until(self.juju_state.refresh_interval)
 
         if len(self.juju_state.machines()) == 0:
             raise Exception("Expected some juju machines started.")
@@ -272,7 +362,7 @@ class Controller:
                 self.configure_lxc_network(controller_machine)
 
                 for juju_machine_id in self.juju_m_idmap.values():
-                    async.sleep_until(0)
+                    background.sleep_until(0)
                     self.run_apt_go_fast(juju_machine_id)
 
             self.deploy_using_placement()
@@ -282,21 +372,30 @@ class Controller:
             self.ui.status_info_message("Ready")
 
     def all_maas_machines_ready(self):
-        self.maas_state.invalidate_nodes_cache()
+        # polled every 3s, nodes fetched for the last poll are too old.
+        # the summary fetches all nodes, the constrained lists are
+        # filtered from those, however long fetching took
+        since = time.time() - 1
 
+        def max_age():
+            return time.time() - since
+
+        summary = ", ".join(["{} {}".format(v, k) for k, v in
+                             self.maas_state.machines_summary(
+                                 max_age=max_age()).items()])
         cons = self.config.getopt('constraints')
         needed = set([m.instance_id for m in
                       self.placement_controller.machines_pending()])
         ready = set([m.instance_id for m in
                      self.maas_state.machines(MaasMachineStatus.READY,
-                                              constraints=cons)])
+                                              constraints=cons,
+                                              max_age=max_age())])
         allocated = set([m.instance_id for m in
                          self.maas_state.machines(MaasMachineStatus.ALLOCATED,
-                                                  constraints=cons)
+                                                  constraints=cons,
+                                                  max_age=max_age())
                          ])
 
-        summary = ", ".join(["{} {}".format(v, k) for k, v in
-                             self.maas_state.machines_summary().items()])
         self.ui.status_info_message("Waiting for {} maas machines to be ready."
                                     " Machines Summary: {}".format(len(needed),
                                                                    summary))
@@ -308,7 +407,8 @@ class Controller:
         """Adds each of the machines used for the placement to juju, if it
         isn't already there."""
 
-        self.juju_state.invalidate_status_cache()
+        # needs current status, or machines get added twice
+        self.juju_state.refresh()
         juju_ids = [jm.instance_id for jm in self.juju_state.machines()]
 
         machine_params = []
@@ -336,25 +436,19 @@ class Controller:
         return n_allocated >= n_needed
 
     def add_machines_to_juju_single(self):
-        self.juju_state.invalidate_status_cache()
+        self.juju_state.refresh()
         self.juju_m_idmap = {}
-        for jm in self.juju_state.machines():
-            response = self.juju.get_annotations(jm.machine_id,
-                                                 'machine')
+        juju_machines = self.juju_state.machines()
+        responses = self.juju.get_annotations_many(
+            [(jm.machine_id, 'machine') for jm in juju_machines])
+        for jm, response in zip(juju_machines, responses):
             ann = response['Annotations']
             if 'instance_id' in ann:
                 self.juju_m_idmap[ann['instance_id']] = jm.machine_id
 
         log.debug("existing juju machines: {}".format(self.juju_m_idmap))
 
-        def get_created_machine_id(iid, response):
-            d = response['Machines'][0]
-            if d['Error']:
-                raise Exception("Error adding machine '{}':"
-                                "{}".format(iid, response))
-            else:
-                return d['Machine']
-
+        new_machines = []
         for machine in self.placement_controller.machines_pending():
             if machine.instance_id in self.juju_m_idmap:
                 machine.machine_id = self.juju_m_idmap[machine.instance_id]
@@ -364,14 +458,37 @@ class Controller:
                 continue
             log.debug("adding machine with "
                       "constraints={}".format(machine.constraints))
-            rv = self.juju.add_machine(constraints=machine.constraints)
-            m_id = get_created_machine_id(machine.instance_id, rv)
+            new_machines.append(machine)
+
+        if len(new_machines) == 0:
+            return
+
+        # one AddMachines request for all of them, then one pipelined
+        # batch of annotations
+        machine_params = [self.juju.machine_params(
+            constraints=machine.constraints) for machine in new_machines]
+        rv = self.juju.add_machines(machine_params)
+
+        # annotate every machine that was added before raising for the
+        # others, the idmap is rebuilt from annotations on a retry
+        annotations = []
+        failed = None
+        for machine, d in zip(new_machines, rv['Machines']):
+            if d['Error']:
+                failed = failed or machine
+                continue
+            m_id = d['Machine']
             machine.machine_id = m_id
-            rv = self.juju.set_annotations(m_id, 'machine',
-                                           {'instance_id':
-                                            machine.instance_id})
+            annotations.append((m_id, 'machine',
+                                {'instance_id': machine.instance_id}))
             self.juju_m_idmap[machine.instance_id] = m_id
 
+        if annotations:
+            self.juju.set_annotations_many(annotations)
+        if failed is not None:
+            raise Exception("Error adding machine '{}':"
+                            "{}".format(failed.instance_id, rv))
+
     def run_apt_go_fast(self, machine_id):
         utils.remote_cp(machine_id,
                         src=path.join(self.config.share_path,
@@ -407,6 +524,9 @@ class Controller:
         assigned_ccs = self.placement_controller.assigned_charm_classes()
         charm_classes = sorted(assigned_ccs,
                                key=attrgetter('deploy_priority'))
+        # one parallel round of charm store lookups up front, deploys
+        # then hit the cache
+        query_many(charm_classes)
 
         def undeployed_charm_classes():
             return [c for c in charm_classes
@@ -455,7 +575,7 @@ class Controller:
                 log.debug("deployed_charm_classes={}".format(
                     PrettyLog(self.deployed_charm_classes)))
 
-                async.sleep_until(5)
+                background.sleep_until(5)
             update_pending_display()
 
     def try_deploy(self, charm_class):
@@ -549,16 +669,16 @@ class Controller:
 
         not_ready_len = 0
         while not self.juju_state.all_agents_started():
-            not_ready = [(a, b) for a, b in self.juju_state.get_agent_states()
-                         if b != 'started']
+            not_ready = list(
+                self.juju_state.agent_summary().not_ready.values())
             if len(not_ready) == not_ready_len:
-                async.sleep_until(3)
+                background.sleep_until(self.juju_state.refresh_interval)
                 continue
 
             not_ready_len = len(not_ready)
             log.info("Checking availability of {} ".format(
                 ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
-            async.sleep_until(3)
+            background.sleep_until(self.juju_state.refresh_interval)
 
         self.config.setopt('deploy_complete', True)
         self.ui.status_info_message(
@@ -576,10 +696,10 @@ class Controller:
             charm_q.watch_relations()
             charm_q.watch_post_proc()
         else:
-            async.submit(charm_q.watch_relations,
-                         self.ui.show_exception_message)
-            async.submit(charm_q.watch_post_proc,
-                         self.ui.show_exception_message)
+            background.submit(charm_q.watch_relations,
+                              self.ui.show_exception_message)
+            background.submit(charm_q.watch_post_proc,
+                              self.ui.show_exception_message)
 
         charm_q.is_running = True
 
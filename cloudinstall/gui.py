@@ -22,7 +22,7 @@ import urwid
 from urwid import (Text, Pile,
                    Filler, Frame, WidgetWrap)
 
-from cloudinstall import async
+from cloudinstall import background
 from cloudinstall.task import Tasker
 from cloudinstall.ui.widgets import (SelectorWithDescriptionWidget,
                                      PasswordInput,
@@ -209,11 +209,21 @@ class PegasusGUI(WidgetWrap):
         rcstr = "complete" if rc else "pending"
         ppc = config.getopt('postproc_complete')
         ppcstr = "complete" if ppc else "pending"
-        self.status_info_message("Status: Deployments {}, "
-                                 "Relations {}, "
-                                 "Post-processing {} ".format(dcstr,
-                                                              rcstr,
-                                                              ppcstr))
+        msg = ("Status: Deployments {}, "
+               "Relations {}, "
+               "Post-processing {} ".format(dcstr, rcstr, ppcstr))
+        juju_state = self.services_view.juju_state
+        freshness = juju_state.freshness()
+        if freshness.last_error:
+            msg += "(juju status {:.0f}s old, refresh failed: {}) ".format(
+                freshness.age or 0, freshness.last_error)
+        elif freshness.stale:
+            msg += "(juju status saved {:.0f}s ago, connecting) ".format(
+                freshness.age or 0)
+        elif not freshness.live and freshness.age is not None and \
+                freshness.age > 2 * juju_state.refresh_interval:
+            msg += "(juju status {:.0f}s old) ".format(freshness.age)
+        self.status_info_message(msg)
 
     def render_node_install_wait(self, message):
         if self.node_install_wait_view is None:
@@ -260,7 +270,7 @@ class PegasusGUI(WidgetWrap):
         self.frame.body = Filler(self.add_services_dialog)
 
     def show_exception_message(self, ex):
-        if isinstance(ex, async.ThreadCancelledException):
+        if isinstance(ex, background.ThreadCancelledException):
             log.debug("Thread cancelled intentionally.")
         else:
             msg = ("A fatal error has occurred: {}\n".format(ex.args[0]))
@@ -16,31 +16,375 @@
 
 """ Represents a juju status """
 
-from collections import Counter
+from collections import Counter, OrderedDict, namedtuple
+import gzip
+from itertools import compress
+import json
 import logging
+import os
+import threading
 import time
 
 from cloudinstall.machine import Machine
 from cloudinstall.service import Service
 
-from macumba import RequestTimeout
+from macumba import ConnectionClosedError, MacumbaError, RequestTimeout
 
 log = logging.getLogger('cloudinstall.juju')
 
+Changes = namedtuple('Changes', ['added', 'removed', 'changed'])
+
+# age: seconds since the status was fetched, None if never
+# last_error: why the last background refresh failed, None if it didn't
+# live: kept current by an AllWatcher, age does not apply
+# stale: loaded from the snapshot of an earlier run, not fetched yet
+Freshness = namedtuple('Freshness', ['age', 'last_error', 'live', 'stale'])
+
+
+def _status_machines(status):
+    """ machine and container id -> machine, without its containers """
+    machines = {}
+    for machine_id, machine in status.get('Machines', {}).items():
+        for container_id, container in (machine.get('Containers') or
+                                        {}).items():
+            machines[container_id] = container
+        machines[machine_id] = {k: v for k, v in machine.items()
+                                if k != 'Containers'}
+    return machines
+
+
+def _status_services(status):
+    """ service name -> service, without its units """
+    return {name: {k: v for k, v in service.items() if k != 'Units'}
+            for name, service in status.get('Services', {}).items()}
+
+
+def _status_units(status):
+    units = {}
+    for service in status.get('Services', {}).values():
+        units.update(service.get('Units') or {})
+    return units
+
+
+def _changes(old, new):
+    return Changes(added=new.keys() - old.keys(),
+                   removed=old.keys() - new.keys(),
+                   changed={k for k in new.keys() & old.keys()
+                            if new[k] != old[k]})
+
+
+def _compose(steps, present):
+    """ Net Changes over consecutive Changes steps
+
+    :param set present: ids there after the last step
+    """
+    existed = {}
+    for step in steps:
+        for k in step.added:
+            existed.setdefault(k, False)
+        for k in step.removed | step.changed:
+            existed.setdefault(k, True)
+    changes = Changes(set(), set(), set())
+    for k, was in existed.items():
+        now = k in present
+        if was and now:
+            changes.changed.add(k)
+        elif was:
+            changes.removed.add(k)
+        elif now:
+            changes.added.add(k)
+    return changes
+
+
+class StatusDiff:
+
+    """ Machines (containers included), services and units that were
+    added, removed or changed between two status versions. Each is a
+    Changes tuple of sets of ids.
+    """
+
+    def __init__(self, old_version, version, machines, services, units):
+        self.old_version = old_version
+        self.version = version
+        self.machines = machines
+        self.services = services
+        self.units = units
+
+    @classmethod
+    def between(cls, old_version, version, old, new):
+        """ Compares the status documents old and new """
+        return cls(old_version, version,
+                   _changes(_status_machines(old), _status_machines(new)),
+                   _changes(_status_services(old), _status_services(new)),
+                   _changes(_status_units(old), _status_units(new)))
+
+    @classmethod
+    def composed(cls, old_version, steps, status):
+        """ Folds the StatusDiffs of consecutive versions into one
+
+        :param status: the status document after the last step
+        """
+        machines = set()
+        for machine_id, machine in status.get('Machines', {}).items():
+            machines.add(machine_id)
+            machines.update(machine.get('Containers') or {})
+        units = set()
+        for service in status.get('Services', {}).values():
+            units.update(service.get('Units') or {})
+        return cls(old_version, steps[-1].version,
+                   _compose([d.machines for d in steps], machines),
+                   _compose([d.services for d in steps],
+                            set(status.get('Services', {}))),
+                   _compose([d.units for d in steps], units))
+
+    def __bool__(self):
+        return any(any(changes) for changes in
+                   (self.machines, self.services, self.units))
+
+
+def _machine_info(machine):
+    """ e.g. 'pending', 'started dying' or 'error no matching tools' """
+    s = machine.get('AgentState')
+    if s == '':
+        s = 'unknown'
+    si = machine.get('AgentStateInfo')
+    if si:
+        s += " " + si
+    life = machine.get('Life', None)
+    if life:
+        s += " " + life
+    return s
+
+
+class MachineColumns:
+
+    """ Machine status fields as parallel tuples, in the order of
+    StatusIndex.machines, so summaries and filters over all machines
+    run over plain values instead of Machine objects
+    """
+
+    def __init__(self, ids, machines):
+        self.ids = tuple(ids)
+        self.agent_states = tuple(m.get('AgentState') for m in machines)
+        self.agent_statuses = tuple((m.get('Agent') or {}).get('Status')
+                                    for m in machines)
+        self.lives = tuple(m.get('Life') for m in machines)
+        self.instance_ids = tuple(m.get('InstanceId') for m in machines)
+        self.summary = Counter(map(_machine_info, machines))
+        self._allocated = {}
+
+    def allocated(self, valid_states):
+        """ Returns a tuple of booleans, True for every machine whose
+        agent is in one of valid_states
+        """
+        key = frozenset(valid_states)
+        mask = self._allocated.get(key)
+        if mask is None:
+            mask = self._allocated[key] = tuple(
+                state in key or status in key
+                for state, status in zip(self.agent_states,
+                                         self.agent_statuses))
+        return mask
+
+
+class StatusIndex:
+
+    """ Machine and Service objects for one status document, by id """
+
+    def __init__(self, status):
+        self.status = status
+        self.machines = []
+        self.machines_by_id = {}
+        self.containers_by_id = {}
+        for machine_id, machine in status.get('Machines', {}).items():
+            if '0' == machine_id:
+                continue
+            m = Machine(machine_id, machine)
+            self.machines.append(m)
+            self.machines_by_id[machine_id] = m
+            for container in m.containers:
+                self.containers_by_id[container.machine_id] = container
+        self.columns = MachineColumns(
+            [m.machine_id for m in self.machines],
+            [m.machine for m in self.machines])
+
+        self.services = []
+        self.services_by_name = {}
+        for name, service in status.get('Services', {}).items():
+            svc = Service(name, service)
+            self.services.append(svc)
+            self.services_by_name[name] = svc
+
+
+class AgentSummary:
+
+    """ Unit agent state counts for one status document
+
+    Built when a document is published. Per service results of the
+    previous summary are reused for every service the new document
+    shares with the previous one, as the allwatcher's documents do.
+
+    :ivar Counter unit_states: unit agent state -> number of units
+    :ivar dict not_ready: unit name -> (service name, agent state) of
+                          every unit that is not started
+    """
+
+    def __init__(self, status, previous=None):
+        self._services = {}
+        self.unit_states = Counter()
+        self.not_ready = {}
+        prev_services = previous._services if previous else {}
+
+        for name, svc in status.get('Services', {}).items():
+            entry = prev_services.get(name)
+            if entry is None or entry[0] is not svc:
+                states = Counter()
+                not_ready = {}
+                for unit_name, unit in (svc.get('Units') or {}).items():
+                    state = unit.get('AgentState', 'unknown')
+                    states[state] += 1
+                    if state != 'started':
+                        not_ready[unit_name] = (name, state)
+                entry = (svc, states, not_ready)
+            self._services[name] = entry
+            self.unit_states.update(entry[1])
+            self.not_ready.update(entry[2])
 
-class JujuState:
+    @property
+    def all_started(self):
+        return not self.not_ready
+
+
+class PollInterval:
+
+    """ Seconds between juju status polls
 
-    """ Represents a global Juju state """
+    Stays at fastest while the environment is busy, and grows by factor
+    up to slowest with every poll that finds it settled. reset() goes
+    back to fastest, e.g. after a change was requested.
+    """
 
-    def __init__(self, juju):
+    def __init__(self, fastest=2, slowest=120, factor=2):
+        self.fastest = fastest
+        self.slowest = slowest
+        self.factor = factor
+        self.current = fastest
+
+    def reset(self):
+        self.current = self.fastest
+
+    def update(self, busy):
+        """ Returns the interval until the next poll """
+        if busy:
+            self.current = self.fastest
+        else:
+            self.current = min(self.current * self.factor, self.slowest)
+        return self.current
+
+
+class JujuState:
+
+    """ Represents a global Juju state
+
+    Every distinct status document gets a new, increasing version; use
+    diff() to find out what changed since an earlier one.
+    """
+
+    # how many versions back diff() can report changes from. only the
+    # current document is kept, with what changed in each version
+    max_diffs = 64
+    # agent states nothing more happens in without being asked to
+    settled_states = frozenset(['started', 'error', 'down', 'stopped'])
+    # requests that change the environment, status is refreshed right
+    # after them
+    write_requests = frozenset(['Client.AddMachines',
+                                'Client.DestroyMachines',
+                                'Client.ServiceDeploy',
+                                'Client.ServiceDestroy',
+                                'Client.ServiceSetCharm',
+                                'Client.AddServiceUnits',
+                                'Client.DestroyServiceUnits',
+                                'Client.AddRelation',
+                                'Client.DestroyRelation',
+                                'Client.Resolved'])
+    # layout of the snapshot file, older or newer ones are ignored
+    snapshot_format = 1
+    # seconds between writes of the snapshot file
+    snapshot_interval = 30
+
+    def __init__(self, juju, snapshot_filename=None, environment=None):
         """ Builds a JujuState
 
         :param juju: Juju API connection
+        :param str snapshot_filename: where save_snapshot() keeps the
+                                      latest status, gzipped json
+        :param str environment: identifies the juju environment, e.g. its
+                                UUID; snapshots saved for another one
+                                are not loaded
         """
         self.juju = juju
         self.start_time = time.time()
         self._juju_status = None
+        self._index = None
+        self.version = 0
+        self._diffs = OrderedDict()
+        self._publish_lock = threading.Lock()
+        self.refreshed_at = None
+        self.last_error = None
+        self._refresher = None
+        self._refresher_lock = threading.Lock()
+        self._refresh_now = threading.Event()
+        self._refresher_stop = threading.Event()
+        self.poll = PollInterval()
+        self._filtered = {}
+        self._summary = None
+        self.snapshot_filename = snapshot_filename
+        self._snapshot_saved = 0
+        self.environment = environment
+        self.stale = False
+        self._live = threading.Event()
         self.valid_states = ['pending', 'started', 'down']
+        juju.metrics.add_callback(self._request_done)
+
+    @property
+    def refresh_interval(self):
+        """ Seconds a fetched status is used for, the cadence of the
+        background refresher
+        """
+        return self.poll.current
+
+    def _request_done(self, sample):
+        """ Refreshes soon after the environment was changed """
+        if sample.request_type in self.write_requests and not sample.error:
+            self.poll.reset()
+            self.invalidate_status_cache()
+
+    def busy(self, status=None):
+        """ True if a machine or unit agent is in a state that is about
+        to change, like pending or installing
+        """
+        if status is None:
+            status = self._juju_status
+        if status is None:
+            return True
+        return any(doc.get('AgentState') not in self.settled_states
+                   for docs in (_status_machines(status),
+                                _status_units(status))
+                   for doc in docs.values())
+
+    def index(self, patterns=None):
+        """ Returns the StatusIndex of the current status, built once
+        per status document
+
+        :param list patterns: juju status patterns, see status()
+        """
+        if patterns is not None and not self._status_fresh():
+            return self._filtered_index(patterns)
+        status = self.status()
+        index = self._index
+        if index is None or index.status is not status:
+            index = self._index = StatusIndex(status)
+        return index
 
     def get_agent_states(self):
         """ Returns list of deployed services and their agent-state """
@@ -58,12 +402,16 @@ class JujuState:
         :rtype: :class:`~cloudinstall.service.Unit`
         :returns: True if all svcs are started, False otherwise
         """
-        return all([state == "started" for _, state in
-                    self.get_agent_states()])
+        return self.agent_summary().all_started
+
+    def agent_summary(self):
+        """ Returns the AgentSummary of the current status """
+        self.status()
+        return self._summary
 
-    def status(self):
+    def status(self, patterns=None):
         """Returns juju status.
-        Caches value for 20 seconds.
+        Caches value for refresh_interval seconds.
 
         Call invalidate_status_cache() to force next status call to
         fetch from server.
@@ -71,61 +419,265 @@ class JujuState:
         If request times out (macumba default is 60 seconds), retries
         5 times.
 
+        Once start_refresher() was called, or while the status loaded
+        by load_snapshot() is waiting to be replaced, never blocks and
+        returns the latest status instead.
+
+        With patterns (service, unit or machine names, wildcards
+        allowed), only what matches them is fetched, and cached per
+        set of patterns. A fresh full status is returned as is, it
+        covers every pattern.
         """
+        if patterns is not None and not self._status_fresh():
+            return self._filtered_index(patterns).status
+        if self._refresher is not None or self.stale:
+            return self._juju_status
         elapsed_time = time.time() - self.start_time
+        if not self._juju_status or elapsed_time > self.refresh_interval:
+            self.refresh()
+        return self._juju_status
+
+    def _status_fresh(self):
+        """ True if status() returns without fetching """
+        if self._refresher is not None or self.stale:
+            return True
+        return self._juju_status is not None and \
+            time.time() - self.start_time <= self.refresh_interval
+
+    def _fetch(self, patterns=None):
         n_retries = 0
-        if not self._juju_status or elapsed_time > 20:
-            self._juju_status = None
-            while self._juju_status is None:
-                try:
-                    self._juju_status = self.juju.status()
-                except RequestTimeout:
-                    n_retries += 1
-                    if n_retries == 5:
-                        raise Exception("Connection failure with juju API")
-            self.start_time = time.time()
+        status = None
+        while status is None:
+            try:
+                status = self.juju.status(patterns)
+            except RequestTimeout:
+                n_retries += 1
+                if n_retries == 5:
+                    raise Exception("Connection failure with juju API")
+        return status
+
+    def _filtered_index(self, patterns):
+        key = tuple(sorted(patterns))
+        entry = self._filtered.get(key)
+        if entry is None or \
+           time.time() - entry[0] > self.refresh_interval:
+            entry = (time.time(), StatusIndex(self._fetch(list(key))))
+            self._filtered[key] = entry
+        return entry[1]
+
+    def refresh(self):
+        """ Fetches status now, blocking until it arrives. """
+        status = self._fetch()
+        self._publish(status)
+        self.start_time = self.refreshed_at = time.time()
+        self.last_error = None
+        self.poll.update(self.busy(status))
         return self._juju_status
 
+    def start_refresher(self, interval=None):
+        """ Keeps status fresh from a background thread, every
+        refresh_interval seconds or right after invalidate_status_cache().
+        A fixed interval replaces the adaptive one.
+
+        Readers get the latest status without waiting on the network
+        (stale-while-revalidate). Blocks only if there is no status yet.
+        """
+        if self._refresher is not None:
+            return
+        if interval is not None:
+            self.poll = PollInterval(interval, interval)
+        fetched = self._juju_status is None
+        if fetched:
+            self.refresh()
+        with self._refresher_lock:
+            if self._refresher is not None:
+                return
+            # events of its own, a stopped refresher still finishing a
+            # refresh can't take a wake-up or stop meant for this one
+            self._refresh_now = refresh_now = threading.Event()
+            self._refresher_stop = stop = threading.Event()
+            if not fetched:
+                refresh_now.set()
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               args=(refresh_now, stop),
+                                               name='juju-status-refresher',
+                                               daemon=True)
+            self._refresher.start()
+
+    def stop_refresher(self):
+        """ Stops refreshing in the background, status() fetches when
+        the cache expires again. A refresh in progress still completes.
+        """
+        with self._refresher_lock:
+            if self._refresher is None:
+                return
+            self._refresher_stop.set()
+            self._refresh_now.set()
+            self._refresher = None
+
+    def _refresh_loop(self, refresh_now, stop):
+        while True:
+            refresh_now.wait(self.refresh_interval)
+            refresh_now.clear()
+            if stop.is_set():
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                log.exception("background juju status refresh failed")
+                self.last_error = str(e)
+
+    def freshness(self):
+        """ Returns a Freshness for the current status """
+        age = None
+        if self.refreshed_at is not None:
+            age = time.time() - self.refreshed_at
+        return Freshness(age, self.last_error, False, self.stale)
+
+    def load_snapshot(self):
+        """ Makes the status saved by an earlier run current, marked
+        stale until a live status replaces it.
+
+        :returns: True if a snapshot was loaded
+        """
+        if self.snapshot_filename is None:
+            return False
+        try:
+            with gzip.open(self.snapshot_filename, 'rt') as f:
+                data = json.load(f)
+            if data.get('format') != self.snapshot_format:
+                log.info("ignoring juju status snapshot in format "
+                         "{}".format(data.get('format')))
+                return False
+            if data.get('environment') != self.environment:
+                log.info("ignoring juju status snapshot of environment "
+                         "{}".format(data.get('environment')))
+                return False
+            status = data['status']
+            saved = data['saved']
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, AttributeError):
+            log.exception("could not load juju status snapshot "
+                          "{}".format(self.snapshot_filename))
+            return False
+        self._publish(status, stale=True)
+        self.refreshed_at = saved
+        return True
+
+    def wait_live(self, timeout=None):
+        """ Blocks until a status was fetched from juju, rather than
+        loaded by load_snapshot(). Decisions about the environment
+        should not be made on a snapshot.
+
+        :returns: False if timeout seconds passed first
+        """
+        return self._live.wait(timeout)
+
+    def save_snapshot(self):
+        """ Writes the current status to snapshot_filename """
+        if self.snapshot_filename is None:
+            return
+        with self._publish_lock:
+            status = self._juju_status
+            stale = self.stale
+        if status is None or stale:
+            return
+        self._snapshot_saved = time.time()
+        freshness = self.freshness()
+        data = dict(format=self.snapshot_format,
+                    environment=self.environment,
+                    saved=time.time() - (freshness.age or 0),
+                    status=status)
+        tmp = "{}.{}".format(self.snapshot_filename, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_filename),
+                        exist_ok=True)
+            with gzip.open(tmp, 'wt') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.snapshot_filename)
+        except (OSError, TypeError, ValueError):
+            log.exception("could not save juju status snapshot "
+                          "{}".format(self.snapshot_filename))
+
+    def _publish(self, status, stale=False):
+        """ Makes status the current document. A new version is only
+        started if it differs from the current one.
+
+        :param bool stale: status was not fetched, but loaded
+        """
+        with self._publish_lock:
+            self.stale = stale
+            latest = self._juju_status
+            if latest is not None and (status is latest or status == latest):
+                # keep the old document, so objects indexed from it
+                # stay valid
+                if not stale:
+                    self._live.set()
+                return
+            self.version += 1
+            self._diffs[self.version] = StatusDiff.between(
+                self.version - 1, self.version, latest or {}, status)
+            while len(self._diffs) > self.max_diffs:
+                self._diffs.popitem(last=False)
+            self._summary = AgentSummary(status, self._summary)
+            self._juju_status = status
+        if not stale:
+            self._live.set()
+        if not stale and self.snapshot_filename is not None and \
+           time.time() - self._snapshot_saved >= self.snapshot_interval:
+            self.save_snapshot()
+
+    def diff(self, old_version):
+        """ Returns a StatusDiff from old_version to the current status.
+
+        If old_version is too old to be remembered (or None),
+        everything is reported as added.
+        """
+        self.status()
+        with self._publish_lock:
+            version = self.version
+            status = self._juju_status or {}
+            if old_version == version:
+                return StatusDiff.between(version, version, {}, {})
+            if old_version is None or old_version + 1 not in self._diffs:
+                return StatusDiff.between(old_version, version, {}, status)
+            steps = [self._diffs[v] for v in range(old_version + 1,
+                                                   version + 1)]
+        return StatusDiff.composed(old_version, steps, status)
+
     def invalidate_status_cache(self):
         """Invalidates cache of status.  Use this to force fetching from
-        server more often than every 20 seconds.
+        server more often than every refresh_interval seconds.
+
+        With the background refresher running, asks it to refresh now;
+        readers keep getting the current status until it's done.
         """
-        self._juju_status = None
+        self._filtered.clear()
+        if self._refresher is not None:
+            self._refresh_now.set()
+        else:
+            self.start_time = 0
 
     def machines_summary(self):
         """ Returns summary of known machines and their status
         Excludes bootstrap.
         """
-        m_status = self.status().get('Machines', {}).values()
-
-        def get_info_string(m):
-            s = m.get('AgentState')
-            if s == '':
-                s = 'unknown'
-            si = m.get('AgentStateInfo')
-            if si:
-                s += " " + si
-            l = m.get('Life', None)
-            if l:
-                s += " " + l
-            return s
-
-        d = Counter([get_info_string(m)
-                     for m in m_status
-                     if m['Id'] != '0'])
-        return d
-
-    def machine(self, machine_id):
+        return Counter(self.index().columns.summary)
+
+    def machine(self, machine_id, filtered=False):
         """ Return single machine state
 
         :param str machine_id: machine machine_id
+        :param bool filtered: only fetch this machine's status
         :returns: machine
         :rtype: :class:`~cloudinstall.machine.Machine`
         """
-        for m in self.machines():
-            if m.machine_id == machine_id:
-                return m
-        return Machine('-', {})
+        patterns = [machine_id] if filtered else None
+        m = self.index(patterns).machines_by_id.get(machine_id)
+        if m is None:
+            return Machine('-', {})
+        return m
 
     def machines(self):
         """ Machines property
@@ -133,27 +685,16 @@ class JujuState:
         :returns: machines known to juju (except bootstrap)
         :rtype: list
         """
-        ret = self.status()
-        machines = []
-
-        for machine_id, machine in ret.get('Machines', {}).items():
-            if '0' == machine_id:
-                continue
-            machines.append(Machine(machine_id, machine))
-        return machines
+        return list(self.index().machines)
 
     def machine_or_container(self, machine_id):
         """ returns machine or container matching the id
         """
-        for machine in self.machines():
-            if '0' == machine_id:
-                continue
-            if machine.machine_id == machine_id:
-                return machine
-            for container in machine.containers:
-                if container.machine_id == machine_id:
-                    return container
-        return None
+        if '0' == machine_id:
+            return None
+        index = self.index()
+        return index.machines_by_id.get(machine_id) or \
+            index.containers_by_id.get(machine_id)
 
     def base_machine(self, machine_id):
         """ returns machine if given a numeric machine id,
@@ -170,22 +711,23 @@ class JujuState:
         :returns: all machines in an allocated state (see self.valid_states)
         :rtype: list
         """
-        return [m for m in self.machines()
-                if m.agent_state in self.valid_states or
-                (m.agent is not None and
-                 m.agent['Status'] in self.valid_states)]
+        index = self.index()
+        return list(compress(index.machines,
+                             index.columns.allocated(self.valid_states)))
 
-    def service(self, name):
+    def service(self, name, filtered=False):
         """ Return a single service entry
 
         :param str name: service/charm name
+        :param bool filtered: only fetch this service's status
         :returns: a service entry or None
         :rtype: :class:`~cloudinstall.service.Service`
         """
-        for s in self.services:
-            if s.service_name == name:
-                return s
-        return Service(name, {})
+        patterns = [name] if filtered else None
+        s = self.index(patterns).services_by_name.get(name)
+        if s is None:
+            return Service(name, {})
+        return s
 
     @property
     def services(self):
@@ -194,16 +736,247 @@ class JujuState:
         :returns: Service() of all loaded services
         :rtype: list
         """
-        ret = self.status()
-        services = []
-
-        for name, service in ret.get('Services', {}).items():
-            services.append(Service(name, service))
-
-        return services
+        return list(self.index().services)
 
     @property
     def networks(self):
         """ Juju netwoks property
         """
         return self.status()['Networks']
+
+
+class WatchingJujuState(JujuState):
+
+    """ JujuState kept current by a Juju AllWatcher
+
+    A background thread consumes AllWatcher deltas and folds them into
+    an in-memory copy of the FullStatus document, so status() and
+    everything built on it never touch the network. Each batch of
+    deltas publishes a new document; unchanged branches are shared
+    with the previous one, so readers never see a half-applied batch.
+
+    Watchers do not survive a reconnect of the API connection, so a
+    new one is created and the model rebuilt from its initial deltas.
+    If that fails too, falls back to polling FullStatus.
+    """
+
+    def __init__(self, juju, snapshot_filename=None, environment=None):
+        super().__init__(juju, snapshot_filename, environment)
+        self.watcher_id = None
+        self.watching = False
+        self._relations = {}
+        self._stop = threading.Event()
+
+    def start(self):
+        """ Creates the watcher and loads the initial model.
+
+        Blocks until the first batch of deltas (the whole environment)
+        has been applied, then keeps watching in a daemon thread.
+        """
+        self._restart()
+        self.watching = True
+        threading.Thread(target=self._watch,
+                         name='juju-allwatcher',
+                         daemon=True).start()
+
+    def stop(self):
+        """ Stops watching, status() falls back to polling """
+        self._stop.set()
+        self.watching = False
+        if self.watcher_id is not None:
+            try:
+                self.juju.call(dict(Type="AllWatcher",
+                                    Request="Stop",
+                                    Id=self.watcher_id))
+            except MacumbaError:
+                log.exception("error stopping allwatcher")
+
+    def _restart(self):
+        """ Gets a new watcher, the first deltas from it describe the
+        whole environment.
+        """
+        self.watcher_id = self.juju.get_watcher()['AllWatcherId']
+        self._next_deltas(reset=True)
+
+    def _watch(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._next_deltas()
+                except ConnectionClosedError:
+                    log.info("juju api connection was lost, "
+                             "restarting allwatcher")
+                    self._restart()
+        except Exception:
+            if self._stop.is_set():
+                # stop() ended the watcher under us
+                return
+            log.exception("allwatcher failed, falling back to polling")
+            self.watching = False
+            try:
+                self.start_refresher()
+            except Exception:
+                log.exception("could not start polling juju status")
+
+    def _next_deltas(self, reset=False):
+        rv = self.juju.get_watched_tasks(self.watcher_id)
+        self._apply_deltas(rv.get('Deltas') or [], reset)
+
+    def status(self, patterns=None):
+        """ Returns the watched model, or polls if not watching """
+        if self.watching:
+            return self._juju_status
+        return super().status(patterns)
+
+    def _status_fresh(self):
+        return self.watching or super()._status_fresh()
+
+    def invalidate_status_cache(self):
+        """ The watched model is always current """
+        if not self.watching:
+            super().invalidate_status_cache()
+
+    def refresh(self):
+        if self.watching:
+            return self._juju_status
+        return super().refresh()
+
+    def freshness(self):
+        if self.watching:
+            return Freshness(0, None, True, False)
+        return super().freshness()
+
+    def _apply_deltas(self, deltas, reset=False):
+        """ Folds a batch of [kind, change, entity] deltas into a new
+        status document and publishes it.
+
+        :param bool reset: start from an empty document
+        """
+        if reset:
+            self._relations = {}
+            status = {'Machines': {}, 'Services': {}, 'Networks': {}}
+        else:
+            status = dict(self._juju_status)
+        machines = status['Machines'] = dict(status['Machines'])
+        services = status['Services'] = dict(status['Services'])
+        relations_changed = False
+
+        for kind, change, entity in deltas:
+            removed = change == 'remove'
+            if kind == 'machine':
+                self._apply_machine(machines, entity, removed)
+            elif kind == 'service':
+                name = entity['Name']
+                if removed:
+                    services.pop(name, None)
+                    continue
+                svc = dict(services.get(name, {}))
+                svc.update(Charm=entity.get('CharmURL'),
+                           Exposed=entity.get('Exposed'),
+                           Life=entity.get('Life'),
+                           Subordinate=entity.get('Subordinate'))
+                services[name] = svc
+            elif kind == 'unit':
+                self._apply_unit(services, entity, removed)
+            elif kind == 'relation':
+                if removed:
+                    self._relations.pop(entity['Key'], None)
+                else:
+                    self._relations[entity['Key']] = entity['Endpoints']
+                relations_changed = True
+
+        if relations_changed:
+            self._apply_relations(services)
+        self._publish(status)
+
+    def _apply_machine(self, machines, entity, removed):
+        mid = entity['Id']
+        parts = mid.split('/')
+        if len(parts) == 1:
+            siblings = machines
+        else:
+            # containers live under their host machine
+            host = machines.get(parts[0])
+            if removed and mid not in ((host or {}).get('Containers') or
+                                       {}):
+                # nothing to remove, don't bring back a removed host
+                return
+            parent = dict(host or {'Id': parts[0]})
+            siblings = parent['Containers'] = dict(
+                parent.get('Containers') or {})
+            machines[parts[0]] = parent
+
+        if removed:
+            siblings.pop(mid, None)
+            return
+
+        m = dict(siblings.get(mid, {}))
+        hwc = entity.get('HardwareCharacteristics') or {}
+        hw = [('arch', hwc.get('Arch')),
+              ('cpu-cores', hwc.get('CpuCores')),
+              ('cpu-power', hwc.get('CpuPower')),
+              ('mem', hwc.get('Mem') and "{}M".format(hwc['Mem'])),
+              ('root-disk', hwc.get('RootDisk') and
+               "{}M".format(hwc['RootDisk']))]
+        addresses = [a['Value'] for a in entity.get('Addresses') or []
+                     if a.get('Scope') == 'public']
+        m.update(Id=mid,
+                 InstanceId=entity.get('InstanceId'),
+                 AgentState=entity.get('Status', ''),
+                 AgentStateInfo=entity.get('StatusInfo', ''),
+                 Agent=dict(Status=entity.get('Status', ''),
+                            Info=entity.get('StatusInfo', '')),
+                 Life=entity.get('Life'),
+                 Series=entity.get('Series'),
+                 Jobs=entity.get('Jobs'),
+                 HasVote=entity.get('HasVote'),
+                 WantsVote=entity.get('WantsVote'),
+                 Hardware=" ".join("{}={}".format(k, v)
+                                   for k, v in hw if v))
+        if addresses:
+            m['DNSName'] = addresses[0]
+        siblings[mid] = m
+
+    def _apply_unit(self, services, entity, removed):
+        if entity.get('Subordinate'):
+            # FullStatus lists these under their principal, not here
+            return
+        name = entity['Name']
+        current = services.get(entity['Service'])
+        if removed and name not in ((current or {}).get('Units') or {}):
+            # nothing to remove, don't bring back a removed service
+            return
+        svc = dict(current or {})
+        units = svc['Units'] = dict(svc.get('Units') or {})
+        services[entity['Service']] = svc
+        if removed:
+            units.pop(name, None)
+            return
+
+        workload = entity.get('WorkloadStatus') or {}
+        agent = entity.get('AgentStatus') or {}
+        units[name] = dict(AgentState=entity.get('Status', ''),
+                           AgentStateInfo=entity.get('StatusInfo', ''),
+                           Machine=entity.get('MachineId', ''),
+                           PublicAddress=entity.get('PublicAddress', ''),
+                           Charm=entity.get('CharmURL'),
+                           Workload=dict(Status=workload.get('Current', ''),
+                                         Info=workload.get('Message', '')),
+                           UnitAgent=dict(Status=agent.get('Current', ''),
+                                          Info=agent.get('Message', '')))
+
+    def _apply_relations(self, services):
+        """ Rebuilds each service's {relation name: [services]} map """
+        rels = {}
+        for endpoints in self._relations.values():
+            names = [e['ServiceName'] for e in endpoints]
+            for e in endpoints:
+                others = [n for n in names if n != e['ServiceName']] \
+                    or [e['ServiceName']]
+                r = rels.setdefault(e['ServiceName'], {})
+                r.setdefault(e['Relation']['Name'], []).extend(others)
+        for name, svc in services.items():
+            if svc.get('Relations', {}) != rels.get(name, {}):
+                svc = dict(svc)
+                svc['Relations'] = rels.get(name, {})
+                services[name] = svc
@@ -22,9 +22,11 @@ from maasclient.auth import MaasAuth
 from maasclient import MaasClient
 from collections import Counter
 from enum import Enum
+from itertools import compress
 import json
 import logging
 import os
+import threading
 import time
 
 
@@ -288,46 +290,163 @@ class MaasMachine(Machine):
                 "storage:{storage} cores:{cpus}").format(**d)
 
 
+class NodeColumns:
+    """ Fields of a list of MAAS nodes as parallel tuples, so summaries
+    and filters run over plain values instead of MaasMachine objects
+
+    The MaasMachine of each node and the indexes by instance_id,
+    system_id and hostname are built on first use.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.hostnames = tuple(n.get('hostname', '') for n in nodes)
+        self.statuses = tuple(n.get('status', MaasMachineStatus.UNKNOWN.value)
+                              for n in nodes)
+        self.not_bootstrap = tuple(h != 'juju-bootstrap.maas'
+                                   for h in self.hostnames)
+        self._status_counts = Counter(self.statuses)
+        self._machines = None
+        self._indexes = {}
+
+    def summary(self):
+        """ Returns MaasMachineStatus -> number of nodes """
+        summary = Counter()
+        for status, count in self._status_counts.items():
+            summary[MaasMachineStatus(status)] += count
+        return summary
+
+    def machines(self, state=None):
+        """ Returns MaasMachines except the juju bootstrap node, only
+        those in state if given
+        """
+        mask = self.not_bootstrap
+        if state:
+            wanted = set(s for s in self._status_counts
+                         if MaasMachineStatus(s) == state)
+            mask = [keep and status in wanted
+                    for keep, status in zip(mask, self.statuses)]
+        return list(compress(self.all_machines(), mask))
+
+    def all_machines(self):
+        """ Returns a MaasMachine per node, the same ones every call """
+        if self._machines is None:
+            self._machines = tuple(MaasMachine(-1, n) for n in self.nodes)
+        return self._machines
+
+    def index(self, field):
+        """ Returns field value -> MaasMachine, except the juju bootstrap
+        node
+
+        :param str field: instance_id, system_id or hostname
+        """
+        index = self._indexes.get(field)
+        if index is None:
+            machines = compress(self.all_machines(), self.not_bootstrap)
+            index = self._indexes[field] = {getattr(m, field): m
+                                            for m in machines}
+        return index
+
+
+def _constraint_filters(constraints):
+    """ Returns the arch and tags (sorted) a juju constraints string
+    filters MAAS nodes on, the other constraints don't
+    """
+    if not constraints:
+        return None, ()
+    cd = dict(x.split('=', 1) for x in constraints.split())
+    tagstr = cd.get('tags', None)
+    tags = tuple(sorted(set(tagstr.split(',')))) if tagstr else ()
+    return cd.get('arch', None) or None, tags
+
+
 class MaasState:
-    """ Represents global MaaS state """
+    """ Represents global MaaS state
+
+    Node lists are cached for ttl seconds per constraints, concurrent
+    callers wanting the same list share one fetch.
+    """
 
-    def __init__(self, maas_client):
+    # seconds a fetched node list is used for
+    ttl = 20
+
+    def __init__(self, maas_client, ttl=None):
         self.maas_client = maas_client
-        self._maas_client_nodes = None
-        self.start_time = time.time()
+        if ttl is not None:
+            self.ttl = ttl
+        # constraints key -> (time fetch started, nodes)
+        self._nodes = {}
+        self._fetching = {}
+        self._lock = threading.Lock()
+        self._columns = {}
+
+    @staticmethod
+    def constraints_key(constraints):
+        """ Normalized constraints string, equal for constraints that
+        select the same nodes
+        """
+        arch, tags = _constraint_filters(constraints)
+        key = []
+        if arch:
+            key.append('arch=' + arch)
+        if tags:
+            key.append('tags=' + ','.join(tags))
+        return ' '.join(key)
+
+    def _cached(self, key, since):
+        """ Cached nodes for key fetched at or after since, filtered
+        from the unconstrained list when that is newer
+        """
+        entry = self._nodes.get(key)
+        everything = self._nodes.get('')
+        if key and everything is not None and everything[0] >= since and \
+           (entry is None or entry[0] < everything[0]):
+            arch, tags = _constraint_filters(key)
+            entry = self._nodes[key] = (everything[0], [
+                n for n in everything[1]
+                if (not arch or
+                    n.get('architecture', '').split('/')[0] == arch) and
+                set(tags).issubset(n.get('tag_names', []))])
+        if entry is not None and entry[0] >= since:
+            return entry[1]
+        return None
 
-    def nodes(self, constraints=None):
+    def _fetch(self, key):
+        if not key:
+            return self.maas_client.nodes
+        # tags are looked up by MAAS, only nodes carrying them are fetched
+        arch, tags = _constraint_filters(key)
+        return self.maas_client.nodes_filtered(arch=arch,
+                                               tags=list(tags) or None)
+
+    def nodes(self, constraints=None, max_age=None):
         """ Cache MAAS nodes
+
+        :param str constraints: juju style constraints, nodes are
+                                filtered on arch and tags
+        :param float max_age: oldest cached list to return, in seconds,
+                              defaults to ttl
         """
-        elapsed_time = time.time() - self.start_time
-        if not self._maas_client_nodes or elapsed_time > 20:
-            self._maas_client_nodes = self.maas_client.nodes
-            self._filtered_nodes = self._maas_client_nodes
-            if constraints:
-                cd = dict(x.split('=') for x in constraints.split(' '))
-                arch = cd.get('arch', None)
-                tagstr = cd.get('tags', None)
-                satisfying_nodes = []
-                for n in self._maas_client_nodes:
-                    if arch:
-                        n_arch = n['architecture'].split('/')[0]
-                        if n_arch != arch:
-                            continue
-                    if tagstr:
-                        c_tags = set(cd['tags'].split(','))
-                        n_tags = set(n['tag_names'])
-                        if not c_tags.issubset(n_tags):
-                            continue
-                    satisfying_nodes.append(n)
-
-                self._filtered_nodes = satisfying_nodes
-
-            self.start_time = time.time()
-        return self._filtered_nodes
+        key = self.constraints_key(constraints)
+        since = time.time() - (self.ttl if max_age is None else max_age)
+        nodes = self._cached(key, since)
+        if nodes is not None:
+            return nodes
+        with self._lock:
+            fetching = self._fetching.setdefault(key, threading.Lock())
+        with fetching:
+            # another caller may have fetched while we waited
+            nodes = self._cached(key, since)
+            if nodes is not None:
+                return nodes
+            started = time.time()
+            nodes = self._fetch(key)
+            self._nodes[key] = (started, nodes)
+            return nodes
 
     def invalidate_nodes_cache(self):
         """Force reload on next access"""
-        self._maas_client_nodes = None
+        self._nodes.clear()
 
     def machine(self, instance_id):
         """ Return single machine state
@@ -336,12 +455,36 @@ class MaasState:
         :returns: machine
         :rtype: cloudinstall.maas.MaasMachine
         """
-        for m in self.machines():
-            if m.instance_id == instance_id:
-                return m
-        return None
+        return self.columns().index('instance_id').get(instance_id)
+
+    def machine_by_system_id(self, system_id):
+        """ Return single machine state
+
+        :param str system_id: MAAS system id
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        return self.columns().index('system_id').get(system_id)
+
+    def machine_by_hostname(self, hostname):
+        """ Return single machine state
 
-    def machines(self, state=None, constraints=None):
+        :param str hostname: hostname reported by MAAS
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        return self.columns().index('hostname').get(hostname)
+
+    def columns(self, constraints=None, max_age=None):
+        """ Returns the NodeColumns of nodes(constraints), built once
+        per node list
+        """
+        nodes = self.nodes(constraints, max_age)
+        key = self.constraints_key(constraints)
+        columns = self._columns.get(key)
+        if columns is None or columns.nodes is not nodes:
+            columns = self._columns[key] = NodeColumns(nodes)
+        return columns
+
+    def machines(self, state=None, constraints=None, max_age=None):
         """Maas Machines
 
         :param state
@@ -349,27 +492,20 @@ class MaasState:
         :param str constraints: a juju style constraints string that
         we parse for arch and tags
 
+        :param float max_age: see nodes()
+
         :returns: machines known to Maas, except for juju bootstrap
             machine, matching state type, or all if state=None
 
         :rtype: list of MaasMachine
 
         """
-        nodes = [n for n in self.nodes(constraints)
-                 if n['hostname'] != 'juju-bootstrap.maas']
+        return self.columns(constraints, max_age).machines(state)
 
-        all_machines = [MaasMachine(-1, m) for m in nodes]
-        if state:
-            return [m for m in all_machines if m.status == state]
-        else:
-            return all_machines
-
-    def machines_summary(self):
+    def machines_summary(self, max_age=None):
         """ Returns summary of known machines and their states.
         """
-        log.debug("in summary, self.nodes is {}".format(self.nodes()))
-        return Counter([MaasMachineStatus(m['status'])
-                        for m in self.nodes()])
+        return self.columns(max_age=max_age).summary()
 
 
 def connect_to_maas(creds=None):
@@ -389,7 +525,7 @@ def connect_to_maas(creds=None):
 
 class FakeMaasState:
 
-    def machines(self, state=None):
+    def machines(self, state=None, constraints=None, max_age=None):
         fakepath = os.getenv("FAKE_API_DATA")
         fn = os.path.join(fakepath, "maas-machines.json")
         with open(fn) as f:
@@ -404,5 +540,5 @@ class FakeMaasState:
     def invalidate_nodes_cache(self):
         "no op"
 
-    def machines_summary(self):
+    def machines_summary(self, max_age=None):
         return "no summary for fake state"
@@ -22,24 +22,42 @@ import logging
 log = logging.getLogger('cloudinstall.machine')
 
 
+_unset = object()
+
+
+def _status_field(key, default=None):
+    """ read-only property for a key of the machine's status entry """
+    return property(lambda self: self.machine.get(key, default))
+
+
 class Machine:
 
-    """ Base machine class """
+    """ Base machine class
+
+    Wraps one machine entry of a juju status document. Fields are read
+    from the entry when accessed, Hardware is parsed at most once.
+    """
+
+    __slots__ = ('machine_id', 'machine', '_hardware', '_cpu_cores',
+                 '_storage', '_mem', '_containers')
 
     def __init__(self, machine_id, machine):
         self.machine_id = machine_id
         self.machine = machine
-        self._cpu_cores = self.hardware('cpu-cores')
-        self._storage = self.hardware('root-disk')
-        self._mem = self.hardware('memory')
-        self.agent = self.machine.get('Agent', None)
-        self.agent_state = self.machine.get('AgentState', None)
-        self.agent_state_info = self.machine.get('AgentStateInfo', None)
-        self.agent_version = self.machine.get('AgentVersion', None)
-        self.dns_name = self.machine.get('DNSName', '')
-        self.err = self.machine.get('Err', None)
-        self.has_vote = self.machine.get('HasVote')
-        self.wants_vote = self.machine.get('WantsVote')
+        self._hardware = None
+        self._cpu_cores = _unset
+        self._storage = _unset
+        self._mem = _unset
+        self._containers = None
+
+    agent = _status_field('Agent')
+    agent_state = _status_field('AgentState')
+    agent_state_info = _status_field('AgentStateInfo')
+    agent_version = _status_field('AgentVersion')
+    dns_name = _status_field('DNSName', '')
+    err = _status_field('Err')
+    has_vote = _status_field('HasVote')
+    wants_vote = _status_field('WantsVote')
 
     @property
     def instance_id(self):
@@ -57,6 +75,8 @@ class Machine:
         :returns: number of cpus
         :rtype: str
         """
+        if self._cpu_cores is _unset:
+            return self.hardware('cpu-cores')
         return self._cpu_cores
 
     @cpu_cores.setter
@@ -79,10 +99,12 @@ class Machine:
         :returns: storage size
         :rtype: str
         """
+        storage = self._storage
+        if storage is _unset:
+            storage = self.hardware('root-disk')
         try:
-            self._storage = int(self._storage[:-1]) / 1024
-            return "{size}G".format(size=str(self._storage))
-        except:
+            return "{size}G".format(size=str(int(storage[:-1]) / 1024))
+        except (TypeError, ValueError):
             return "N/A"
 
     @storage.setter
@@ -96,7 +118,10 @@ class Machine:
         :returns: memory size
         :rtype: str
         """
-        return "{size}".format(size=str(self._mem))
+        mem = self._mem
+        if mem is _unset:
+            mem = self.hardware('memory')
+        return "{size}".format(size=str(mem))
 
     @mem.setter
     def mem(self, val):
@@ -110,24 +135,28 @@ class Machine:
         :returns: hardware of spec
         :rtype: str
         """
-        _machine = self.machine.get('Hardware', None)
-        if _machine:
-            _hardware_list = _machine.split(' ')
-            for item in _hardware_list:
-                k, v = item.split('=')
-                if k in spec:
-                    return v
+        if self._hardware is None:
+            _machine = self.machine.get('Hardware', None)
+            self._hardware = [tuple(item.split('='))
+                              for item in _machine.split(' ')] \
+                if _machine else []
+        for k, v in self._hardware:
+            if k in spec:
+                return v
         return "N/A"
 
     @property
     def containers(self):
         """ Return containers for machine
 
-        :rtype: generator
+        :rtype: tuple
         """
-        _containers = self.machine.get('Containers', {}).items()
-        for container_id, container in _containers:
-            yield Machine(container_id, container)
+        if self._containers is None:
+            _containers = self.machine.get('Containers', {}).items()
+            self._containers = tuple(Machine(container_id, container)
+                                     for container_id, container
+                                     in _containers)
+        return self._containers
 
     def container(self, container_id):
         """ Inspect a container
@@ -32,6 +32,8 @@ class Unit:
 
     """ Unit class """
 
+    __slots__ = ('unit_name', 'unit')
+
     def __init__(self, unit_name, unit):
         self.unit_name = unit_name
         self.unit = unit
@@ -132,6 +134,8 @@ class Relation:
 
     """ Relation class """
 
+    __slots__ = ('relation_name', 'charms')
+
     def __init__(self, relation_name, charms):
         self.relation_name = relation_name
         self.charms = charms
@@ -147,15 +151,35 @@ class Relation:
 
 class Service:
 
-    """ Service class """
+    """ Service class
+
+    Wraps one service entry of a juju status document. Units and
+    relations are built on first use and then reused.
+    """
+
+    __slots__ = ('service_name', 'service', '_units', '_relations')
 
     def __init__(self, service_name, service):
         self.service_name = service_name
         self.service = service
-        self.charm = self.service.get('Charm')
-        self.exposed = self.service.get('Exposed')
-        self.networks = self.service.get('Networks')
-        self.life = self.service.get('Life')
+        self._units = None
+        self._relations = None
+
+    @property
+    def charm(self):
+        return self.service.get('Charm')
+
+    @property
+    def exposed(self):
+        return self.service.get('Exposed')
+
+    @property
+    def networks(self):
+        return self.service.get('Networks')
+
+    @property
+    def life(self):
+        return self.service.get('Life')
 
     def unit(self, name):
         """ Single unit entry
@@ -178,17 +202,14 @@ class Service:
     def units(self):
         """ Service units
 
-        :returns: iterator of associated units for service
+        :returns: list of associated units for service
         :rtype: Unit()
         """
-        units_list = []
-        units_dict = self.service.get('Units', {})
-        if units_dict is None:
-            return units_list
-
-        for unit_name, units in units_dict.items():
-            units_list.append(Unit(unit_name, units))
-        return units_list
+        if self._units is None:
+            units_dict = self.service.get('Units', {}) or {}
+            self._units = [Unit(unit_name, units)
+                           for unit_name, units in units_dict.items()]
+        return self._units
 
     def relation(self, name):
         """ Single relation entry
@@ -206,12 +227,15 @@ class Service:
     def relations(self):
         """ Service relations
 
-        :returns: iterator of relations for service
+        :returns: list of relations for service
         :rtype: Relation()
         """
-        relations = self.service.get('Relations', {})
-        for relation_name, relation in relations.items():
-            yield Relation(relation_name, relation)
+        if self._relations is None:
+            relations = self.service.get('Relations', {})
+            self._relations = [Relation(relation_name, relation)
+                               for relation_name, relation
+                               in relations.items()]
+        return self._relations
 
     def __repr__(self):
         return "<Service: {name} " \
@@ -19,7 +19,7 @@ import time
 import yaml
 
 from cloudinstall import utils
-from cloudinstall import async
+from cloudinstall import background
 from cloudinstall.alarms import AlarmMonitor
 from cloudinstall.config import Config
 
@@ -191,8 +191,8 @@ class FakeInstall:
         self.tl = ['a', 'b', 'c']
         self.tasker.register_tasks(self.tl)
         self.update_progress()
-        async.submit(self.async_go,
-                     self.display_controller.show_exception_message)
+        background.submit(self.async_go,
+                          self.display_controller.show_exception_message)
 
     def async_go(self):
         for t in self.tl:
@@ -20,7 +20,7 @@ from urwid import (AttrMap, Button, Divider, Filler, Padding, Pile,
                    SelectableIcon, Text, WidgetWrap)
 
 from cloudinstall.maas import connect_to_maas, FakeMaasState, MaasMachineStatus
-from cloudinstall import async
+from cloudinstall import background
 
 log = logging.getLogger('cloudinstall.machinewait')
 
@@ -68,10 +68,10 @@ class MachineWaitView(WidgetWrap):
 
     def get_status(self):
         " returns (global_ok, [ok, condition])"
-        self.maas_state.invalidate_nodes_cache()
         cons = self.config.getopt('constraints')
+        # updated every second, MAAS needn't be asked that often
         machines = self.maas_state.machines(state=MaasMachineStatus.READY,
-                                            constraints=cons)
+                                            constraints=cons, max_age=5)
         powerable_machines = [m for m in machines if m.power_type is not None]
         n_powerable = len(powerable_machines)
 
@@ -124,8 +124,8 @@ class MachineWaitView(WidgetWrap):
         self.main_pile.focus_position = len(self.main_pile.contents) - 1
 
     def do_continue(self, *args, **kwargs):
-        async.submit(self.installer.do_install,
-                     self.display_controller.show_exception_message)
+        background.submit(self.installer.do_install,
+                          self.display_controller.show_exception_message)
 
     def do_cancel(self, *args, **kwargs):
         raise SystemExit("Installation cancelled.")
@@ -93,6 +93,8 @@ class ServicesView(WidgetWrap):
         self.config = config
         self.unit_w = None
         self.log_cache = None
+        # juju status version the widgets were last updated from
+        self.status_version = None
 
         for key, label in self.view_columns:
             self.columns.add(key, label)
@@ -102,7 +104,11 @@ class ServicesView(WidgetWrap):
 
     def refresh_nodes(self, nodes):
         """ Adds services to the view if they don't already exist
+
+        Existing units are only updated if they or their machine changed
+        since the last refresh, or if their display changes over time.
         """
+        changed_units, changed_machines = self._status_changes()
         for node in nodes:
             charm_class, service = node
             if len(service.units) > 0:
@@ -119,10 +125,33 @@ class ServicesView(WidgetWrap):
                         unit_w = self.deployed[u.unit_name]
                         for k, label in self.view_columns:
                             self.columns.add_to(k, getattr(unit_w, k))
+                    else:
+                        if changed_units is not None and \
+                           u.unit_name not in changed_units and \
+                           u.machine_id not in changed_machines and \
+                           not self._animated(u):
+                            continue
 
                     self.update_ui_state(charm_class, u,
                                          unit_w)
 
+    def _status_changes(self):
+        """ Returns names of units and ids of machines changed since the
+        last refresh, or None, None if everything should be updated.
+        """
+        if self.status_version is None:
+            self.status_version = self.juju_state.version
+            return None, None
+        diff = self.juju_state.diff(self.status_version)
+        self.status_version = diff.version
+        return (diff.units.added | diff.units.changed,
+                diff.machines.added | diff.machines.changed)
+
+    def _animated(self, unit):
+        """ units whose display changes without a status change """
+        return unit.agent_state == "pending" or \
+            'glance-simplestreams-sync' in unit.unit_name
+
     def status_icon_state(self, charm_class, unit):
         # unit.agent_state may be "pending" despite errors elsewhere,
         # so we check for error_info first.
@@ -16,37 +16,135 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
 import bson
 from requests_oauthlib import OAuth1
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import threading
+import time
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _node_matches(node, filters):
+    """ True if node passes filters, see MaasClient.nodes_filtered() """
+    for key, wanted in filters.items():
+        wanted = _as_list(wanted)
+        if key == 'tags':
+            if not set(wanted).issubset(node.get('tag_names', [])):
+                return False
+            continue
+        if key == 'hostname':
+            values = [node.get('hostname')]
+        elif key == 'zone':
+            values = [node.get('zone', {}).get('name')]
+        elif key == 'id':
+            values = [node.get('system_id')]
+        elif key == 'mac_address':
+            values = [m['mac_address']
+                      for m in node.get('macaddress_set', [])]
+        elif key == 'arch':
+            values = [node.get('architecture', '').split('/')[0]]
+        else:
+            values = [node.get(key)]
+        if not set(values) & set(wanted):
+            return False
+    return True
+
+
+class _RateLimiter:
+
+    """ Spaces calls at least 1/rate seconds apart, across threads """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
 
 class MaasClient:
 
     """ Client Class
+
+    Requests share one keep-alive session, so consecutive calls reuse
+    their connection to MAAS.
     """
 
-    def __init__(self, auth):
+    # seconds to wait for a connection, and then for the response
+    timeout = (10, 60)
+    # connections kept open to MAAS
+    pool_size = 10
+    # requests in flight during bulk operations, and requests per
+    # second they may send (None for no limit)
+    bulk_concurrency = 8
+    bulk_rate = None
+    # node list filters MAAS applies itself
+    server_node_filters = ('hostname', 'zone', 'id', 'mac_address',
+                           'agent_name')
+    # nodes_bulk() operations and the methods doing them for one node
+    bulk_ops = dict(start='node_start', stop='node_stop',
+                    release='node_release', commission='node_commission',
+                    remove='node_remove')
+
+    def __init__(self, auth, timeout=None, retries=3, pool_size=None):
         """ Entry point to client routines for interfacing
         with MAAS api.
 
         :param auth: MAAS Authorization class (required)
+        :param timeout: seconds, or (connect, read) seconds, to wait
+                        for MAAS, None for the class default
+        :param int retries: times a failed connection attempt is retried
+        :param int pool_size: connections kept open to MAAS
         """
         self.auth = auth
+        if timeout is not None:
+            self.timeout = timeout
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._signer = None
+        self._signer_key = None
 
     def _oauth(self):
         """ Generates OAuth attributes for protected resources
 
+        The signer is built once per set of credentials, it signs each
+        request with a new nonce and timestamp.
+
         :returns: OAuth class
         """
-        oauth = OAuth1(self.auth.consumer_key,
-                       client_secret=self.auth.consumer_secret,
-                       resource_owner_key=self.auth.token_key,
-                       resource_owner_secret=self.auth.token_secret,
-                       signature_method='PLAINTEXT',
-                       signature_type='query')
-        return oauth
+        key = (self.auth.api_key, self.auth.consumer_secret)
+        if self._signer is None or self._signer_key != key:
+            self._signer = OAuth1(
+                self.auth.consumer_key,
+                client_secret=self.auth.consumer_secret,
+                resource_owner_key=self.auth.token_key,
+                resource_owner_secret=self.auth.token_secret,
+                signature_method='PLAINTEXT',
+                signature_type='query')
+            self._signer_key = key
+        return self._signer
 
     def get(self, url, params=None):
         """ Performs a authenticated GET against a MAAS endpoint
@@ -54,9 +152,10 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.get(url=self.auth.api_url + url,
-                            auth=self._oauth(),
-                            params=params)
+        return self.session.get(url=self.auth.api_url + url,
+                                auth=self._oauth(),
+                                params=params,
+                                timeout=self.timeout)
 
     def post(self, url, params=None):
         """ Performs a authenticated POST against a MAAS endpoint
@@ -64,9 +163,10 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.post(url=self.auth.api_url + url,
-                             auth=self._oauth(),
-                             data=params)
+        return self.session.post(url=self.auth.api_url + url,
+                                 auth=self._oauth(),
+                                 data=params,
+                                 timeout=self.timeout)
 
     def delete(self, url, params=None):
         """ Performs a authenticated DELETE against a MAAS endpoint
@@ -74,8 +174,35 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.delete(url=self.auth.api_url + url,
-                               auth=self._oauth())
+        return self.session.delete(url=self.auth.api_url + url,
+                                   auth=self._oauth(),
+                                   timeout=self.timeout)
+
+    def close(self):
+        """ Closes the connections to MAAS """
+        self.session.close()
+
+    def _fan_out(self, fn, items, concurrency=None, rate=None):
+        """ Calls fn(item) for every item from a bounded pool of threads
+
+        :returns: list of results in the order of items, with the
+                  exception raised for an item in place of its result
+        """
+        items = list(items)
+        if not items:
+            return []
+        limiter = _RateLimiter(rate or self.bulk_rate)
+
+        def call(item):
+            limiter.wait()
+            try:
+                return fn(item)
+            except Exception as e:
+                return e
+
+        workers = min(concurrency or self.bulk_concurrency, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(call, items))
 
     ###########################################################################
     # Boot Images API
@@ -140,19 +267,50 @@ class MaasClient:
 
         :param params: keyword parameters to filter returned nodes
                        allowed values include hostnames, mac_addresses,
-                       zone.
+                       zone, state, and the filters of nodes_filtered()
         :returns: managed nodes
         :rtype: list
         """
-        params['op'] = 'list'
-        res = self.get('/nodes/', params)
-        if res.ok:
-            machines = map(Machine, res.json())
-            # Filter by state post response manually till maas fixes.
-            if 'state' in params:
-                machines = [m for m in machines if m.state == params['state']]
-            return machines
-        return []
+        for key, filter_key in (('state', 'status'),
+                                ('hostnames', 'hostname'),
+                                ('mac_addresses', 'mac_address')):
+            value = params.pop(key, None)
+            if value is not None:
+                params[filter_key] = value
+        return [Machine(n) for n in self.nodes_filtered(**params)]
+
+    def nodes_filtered(self, **filters):
+        """ Nodes managed by MAAS, matching all filters
+
+        hostname, zone, id (system id), mac_address and agent_name are
+        applied by MAAS. With tags, MAAS lists the nodes of the first
+        tag, everything else is checked here, as are status and arch
+        (e.g. 'amd64').
+
+        :param filters: a value, or a list of values any of which may
+                        match; for tags, a list of tags nodes must all
+                        have
+        :returns: managed nodes
+        :rtype: list
+        """
+        filters = {k: v for k, v in filters.items() if v is not None}
+        tags = _as_list(filters.get('tags', []))
+        if tags:
+            res = self.get('/tags/{}/'.format(tags[0]), dict(op='nodes'))
+            local = filters
+        else:
+            params = {k: _as_list(v) for k, v in filters.items()
+                      if k in self.server_node_filters}
+            params['op'] = 'list'
+            res = self.get('/nodes/', params)
+            local = {k: v for k, v in filters.items()
+                     if k not in self.server_node_filters}
+        if not res.ok:
+            return []
+        nodes = res.json()
+        if local:
+            nodes = [n for n in nodes if _node_matches(n, local)]
+        return nodes
 
     def node_get(self, node_id):
         res = self.get('/nodes/%s' % node_id)
@@ -215,6 +373,44 @@ class MaasClient:
             return ds[0]
         return None
 
+    def nodes_bulk(self, op, system_ids, concurrency=None, rate=None,
+                   **params):
+        """ Runs an operation on many nodes at once
+
+        Uses the MAAS bulk operation where there is one, otherwise
+        sends concurrent requests for single nodes.
+
+        :param str op: one of bulk_ops, e.g. 'start' or 'release'
+        :param list system_ids: nodes to run op on
+        :param int concurrency: requests in flight, see bulk_concurrency
+        :param float rate: requests per second, see bulk_rate
+        :param params: passed to the single node method, e.g. user_data
+                       for start
+        :returns: list of results in the order of system_ids, as the
+                  single node method returns them (True on success,
+                  False on failure), or the exception its request
+                  raised
+        """
+        try:
+            method = getattr(self, self.bulk_ops[op])
+        except KeyError:
+            raise ValueError("no bulk operation {}".format(op))
+        system_ids = list(system_ids)
+
+        if op == 'release' and system_ids:
+            try:
+                res = self.post('/nodes/', dict(op='release',
+                                                nodes=system_ids))
+                if res.ok:
+                    return [True] * len(system_ids)
+            except requests.RequestException:
+                pass
+            # older MAAS, or a node that can't be released: find out
+            # which one
+
+        return self._fan_out(lambda system_id: method(system_id, **params),
+                             system_ids, concurrency, rate)
+
     def nodes_accept_all(self):
         """ Accept all commissioned nodes
 
@@ -335,6 +531,21 @@ class MaasClient:
             return True
         return False
 
+    def tag_nodes(self, tag, system_ids):
+        """ Tag several machines with one request
+
+        :param tag: Tag name
+        :type tag: str
+        :param system_ids: IDs of nodes
+        :type system_ids: list
+        :returns: Success or Fail
+        :rtype: bool
+        """
+        res = self.post('/tags/%s/' % (tag,),
+                        dict(op='update_nodes',
+                             add=list(system_ids)))
+        return res.ok
+
     def tag_name(self, nodes):
         """ Tag each managed node with its hostname.
 
@@ -346,12 +557,19 @@ class MaasClient:
         constraint to juju.
 
         """
-        for machine in nodes:
-            system_id = machine['system_id']
-            if 'tag_names' not in machine['tag_names'] or \
-               system_id not in machine['tag_names']:
-                self.tag_new(system_id)
-                self.tag_machine(system_id, system_id)
+        untagged = [machine['system_id'] for machine in nodes
+                    if 'tag_names' not in machine['tag_names'] or
+                    machine['system_id'] not in machine['tag_names']]
+        if not untagged:
+            return []
+        existing = {tagmd['name'] for tagmd in self.tags}
+
+        def tag(system_id):
+            if system_id not in existing:
+                self.post('/tags/', dict(op='new', name=system_id))
+            return self.tag_machine(system_id, system_id)
+
+        return self._fan_out(tag, untagged)
 
     def tag_fpi(self, nodes):
         """ Tag each DECLARED host with the FPI tag.
@@ -367,9 +585,12 @@ class MaasClient:
         """
         FPI_TAG = 'use-fastpath-installer'
         self.tag_new(FPI_TAG)
-        for machine in nodes:
-            if machine['status'] == 0:
-                self.tag_machine(FPI_TAG, machine['system_id'])
+        declared = [machine['system_id'] for machine in nodes
+                    if machine['status'] == 0]
+        if declared and not self.tag_nodes(FPI_TAG, declared):
+            # one at a time, so a node MAAS refuses doesn't stop the rest
+            self._fan_out(lambda sid: self.tag_machine(FPI_TAG, sid),
+                          declared)
 
     ###########################################################################
     # Users API
@@ -17,15 +17,28 @@
 from ws4py.client.threadedclient import WebSocketClient
 import json
 import logging
-import requests
-from os import path
+from collections import Counter, OrderedDict
 from queue import Queue, Empty
 import pprint
+import re
 import threading
 import time
 
+from macumba.metrics import RequestMetrics, request_type
+
 log = logging.getLogger('macumba')
 
+try:
+    # decodes bytes directly and several times faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    def json_loads(data):
+        """ Decodes a UTF-8 encoded JSON document """
+        return json.loads(data.decode('utf-8'))
+
+# juju writes RequestId first, followed by Error or Response
+RESPONSE_HEAD_RE = re.compile(rb'\{\s*"RequestId"\s*:\s*(\d+)\s*,\s*"(\w+)"')
+
 creds = {'Type': 'Admin',
          'Request': 'Login',
          'RequestId': 1,
@@ -47,22 +60,18 @@ def query_cs(charm):
     """ This helper routine will query the charm store to pull latest revisions
     and charmstore url for the api.
 
+    Lookups are cached, see macumba.charmstore.
+
     :param str charm: charm name, can be in the form of 'precise/<charm>' to
                       specify an alternate series.
     """
+    from macumba.charmstore import charm_store
+
     try:
         series, charm = charm.split('/')
     except ValueError:
         series = 'trusty'
-    charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
-    url = path.join(charm_store_url, series, charm)
-    r = requests.get(url)
-    if r.status_code != 200:
-        log.error("could not find charm store URL for charm '{}'".format(url))
-        rj = r.json()
-        raise CharmNotFoundError("{type} {charm_id}".format(**rj))
-
-    return r.json()
+    return charm_store.query(charm, series)
 
 
 class PrettyLog():
@@ -114,17 +123,97 @@ class RequestTimeout(MacumbaError):
     "Request timed out"
 
 
+class RequestInterruptedError(ConnectionClosedError):
+
+    """Connection dropped while a request that is not safe to resend was
+    in flight. It may or may not have been applied by the server.
+    """
+
+    def __init__(self, request_id, params):
+        self.params = params
+        super().__init__("{} {} interrupted by connection "
+                         "loss".format(request_id, params.get('Request')))
+
+
+# Requests that are safe to resend after a reconnect
+IDEMPOTENT_REQUESTS = {'FullStatus', 'EnvironmentInfo', 'EnvironmentGet',
+                       'GetEnvironmentConstraints', 'CharmInfo',
+                       'ServiceGet', 'GetServiceConstraints',
+                       'ServiceCharmRelations', 'PublicAddress',
+                       'GetAnnotations', 'WatchAll'}
+
+
+def _parse_response(res):
+    """ Unwraps a response message, raising on errors """
+    if 'Error' in res:
+        raise ServerError(res['Error'], res)
+
+    try:
+        return res['Response']
+    except:
+        raise BadResponseError("Failed to parse response: {}".format(res))
+
+
+def _results_or_raise(results, return_exceptions):
+    """ Raises the first error in a batch of results, unless the
+    caller asked for errors to be returned in place.
+    """
+    if not return_exceptions:
+        for rv in results:
+            if isinstance(rv, Exception):
+                raise rv
+    return results
+
+
+def _annotations_set_result(rv, return_exceptions):
+    """ Annotations.Set only reports per-entity errors """
+    errors = [r['Error'] for r in rv.get('Results') or []
+              if r.get('Error')]
+    if errors and not return_exceptions:
+        raise ServerError(errors[0], rv)
+    return rv
+
+
+def _existing_relation_response(e):
+    """ do not treat pre-existing relations as exceptions """
+    if 'relation already exists' in e.response['Error']:
+        return e.response
+    raise e
+
+
 class JujuWS(WebSocketClient):
 
+    # a response is kept until its request is received or abandoned,
+    # responses arriving for abandoned or unknown requests are dropped.
+    # a response nobody is waiting on is dropped after this many seconds
+    message_ttl = 300
+    # how many abandoned request ids to remember, to recognize late
+    # responses
+    max_abandoned = 1000
+
     def __init__(self, url, password, protocols=['https-only'],
                  extensions=None, ssl_options=None, headers=None,
-                 start_reqid=1):
+                 start_reqid=1, stats=None, decoder=None, metrics=None):
         WebSocketClient.__init__(self, url, protocols, extensions,
                                  ssl_options=ssl_options, headers=headers)
+        self.decode = decoder or json_loads
+        self.metrics = metrics
         self.open_done = threading.Event()
         self.rid_lock = threading.RLock()
         self.msglock = threading.RLock()
         self.messages = {}
+        self.events = {}
+        self.requests = {}
+        # request id -> arrival time of responses not yet collected
+        self.uncollected = OrderedDict()
+        # request id -> how many callers are waiting on it
+        self.waiters = Counter()
+        self.abandoned = OrderedDict()
+        # request ids whose response is handed back undecoded
+        self.raw_requests = set()
+        # request id -> (request type, send time, bytes sent)
+        self.inflight = {}
+        self.stats = Counter() if stats is None else stats
         self._cur_request_id = start_reqid
 
     # WebSocketClient subclass overrides, run in private thread:
@@ -132,13 +221,90 @@ class JujuWS(WebSocketClient):
         self.open_done.set()
 
     def received_message(self, m):
-        msg = json.loads(m.data.decode('utf-8'))
-        msg_req_id = msg['RequestId']
+        msg_req_id = self._raw_request_id(m.data)
+        if msg_req_id is None:
+            msg = self.decode(m.data)
+            msg_req_id = msg['RequestId']
+            if msg_req_id in self.raw_requests and 'Error' not in msg:
+                # fields in an unexpected order, already decoded anyway
+                msg = m.data
+        else:
+            msg = m.data
+        self._received_response(msg_req_id, msg, len(m.data))
+
+    def _received_response(self, msg_req_id, msg, size):
+        """ Stores the response to msg_req_id, decoded unless it was a
+        raw request. size is the frame's length in bytes.
+        """
         with self.msglock:
+            sent = self.inflight.pop(msg_req_id, None)
+            if msg_req_id not in self.messages:
+                if self.abandoned.pop(msg_req_id, None) is not None:
+                    self.stats['late'] += 1
+                    log.debug("dropping late response to "
+                              "{}".format(msg_req_id))
+                else:
+                    self.stats['orphaned'] += 1
+                    log.debug("dropping response to unknown request "
+                              "{}".format(msg_req_id))
+                return
             self.messages[msg_req_id] = msg
+            self.uncollected[msg_req_id] = time.time()
+            event = self.events.get(msg_req_id)
+            self._evict_uncollected()
+        if event is not None:
+            event.set()
+        if sent is not None and self.metrics is not None:
+            name, sent_at, bytes_out = sent
+            self.metrics.record(name, time.monotonic() - sent_at,
+                                bytes_out, size,
+                                error=isinstance(msg, dict) and 'Error' in msg)
+
+    def _raw_request_id(self, data):
+        """ Returns the request id of a successful response to a raw
+        request without decoding the frame, or None.
+        """
+        if not self.raw_requests:
+            return None
+        match = RESPONSE_HEAD_RE.match(data, 0, 64)
+        if match is None or match.group(2) != b'Response':
+            return None
+        request_id = int(match.group(1))
+        if request_id not in self.raw_requests:
+            return None
+        return request_id
+
+    def _evict_uncollected(self):
+        """ Drops responses older than message_ttl that nobody is
+        waiting on, their callers went away without collecting them.
+        Called with msglock held.
+        """
+        expired = time.time() - self.message_ttl
+        for request_id, arrived in list(self.uncollected.items()):
+            if arrived > expired:
+                break
+            if self.waiters[request_id]:
+                continue
+            self._forget(request_id)
+            self.stats['orphaned'] += 1
+            log.debug("evicted uncollected response to "
+                      "{}".format(request_id))
+
+    def _forget(self, request_id):
+        self.messages.pop(request_id, None)
+        self.uncollected.pop(request_id, None)
+        self.waiters.pop(request_id, None)
+        self.events.pop(request_id, None)
+        self.requests.pop(request_id, None)
+        self.raw_requests.discard(request_id)
+        self.inflight.pop(request_id, None)
 
     def closed(self, code, reason=None):
         log.debug("socket closed: code:{} reason:{}".format(code, reason))
+        # wake up any waiters, they will see ConnectionClosedError
+        with self.msglock:
+            for event in self.events.values():
+                event.set()
 
     # actions for users of the class:
     def get_current_request_id(self):
@@ -155,20 +321,68 @@ class JujuWS(WebSocketClient):
         rv = self.do_send(creds)
         return rv
 
-    def do_send(self, json_message):
+    def do_send(self, json_message, raw=False):
         with self.rid_lock:
             self._cur_request_id += 1
             request_id = self._cur_request_id
 
         json_message['RequestId'] = request_id
 
-        self.send(json.dumps(json_message))
-
+        # register before sending so a fast response can't be lost
         with self.msglock:
             self.messages[request_id] = None
+            self.events[request_id] = threading.Event()
+            self.requests[request_id] = json_message
+            if raw:
+                self.raw_requests.add(request_id)
+            data = json.dumps(json_message)
+            self.inflight[request_id] = (request_type(json_message),
+                                         time.monotonic(), len(data))
+
+        self.send(data)
 
         return request_id
 
+    def wait_for_message(self, request_id, timeout=None):
+        """Blocks until the message matching request_id has arrived or
+        the connection is closed.
+
+        Returns False if 'timeout' seconds passed with no message,
+        True otherwise.
+
+        Raises UnknownRequestError if request_id hasn't been sent yet
+        (or was already received).
+
+        """
+        with self.msglock:
+            if request_id not in self.events:
+                errmsg = ("{} not in messages. "
+                          "cur = {}".format(request_id,
+                                            self._cur_request_id))
+                raise UnknownRequestError(errmsg)
+            event = self.events[request_id]
+        self.hold(request_id)
+        try:
+            return event.wait(timeout)
+        finally:
+            self.release(request_id)
+
+    def hold(self, request_id):
+        """ Marks request_id as waited on, its response is not evicted
+        until it is received, abandoned or release()d.
+        """
+        with self.msglock:
+            if request_id in self.messages:
+                self.waiters[request_id] += 1
+
+    def release(self, request_id):
+        "undoes a hold()"
+        with self.msglock:
+            if self.waiters[request_id] > 1:
+                self.waiters[request_id] -= 1
+            else:
+                self.waiters.pop(request_id, None)
+
     def do_receive(self, request_id):
         """Checks for message matching request_id.
 
@@ -177,10 +391,10 @@ class JujuWS(WebSocketClient):
         Raises UnknownRequestError if request_id hasn't been sent yet
         (or was already received).
 
-        """
-        if self.terminated:
-            raise ConnectionClosedError
+        Raises ConnectionClosedError if the message has not arrived and
+        never will.
 
+        """
         with self.msglock:
             if request_id not in self.messages:
                 errmsg = ("{} not in messages. "
@@ -190,19 +404,62 @@ class JujuWS(WebSocketClient):
 
             message = self.messages[request_id]
             if message is not None:
-                del self.messages[request_id]
+                self._forget(request_id)
+
+        if message is None and self.terminated:
+            raise ConnectionClosedError(request_id)
 
         return message
 
+    def abandon(self, request_id):
+        """The caller has stopped waiting for request_id (e.g. timed out).
+
+        Forgets it, so a response arriving later is dropped instead of
+        being kept forever.
+        """
+        with self.msglock:
+            if request_id not in self.messages:
+                return
+            sent = self.inflight.get(request_id)
+            if self.messages[request_id] is not None:
+                self.stats['late'] += 1
+            else:
+                self.abandoned[request_id] = time.time()
+                if len(self.abandoned) > self.max_abandoned:
+                    self.abandoned.popitem(last=False)
+            self._forget(request_id)
+        if sent is not None and self.metrics is not None:
+            name, sent_at, bytes_out = sent
+            self.metrics.record(name, bytes_out=bytes_out, timed_out=True)
+
 
 class JujuClient:
 
-    def __init__(self, url='wss://localhost:17070', password='pass'):
+    # seconds to wait before the first reconnect attempt, and the cap
+    # for the exponential backoff between attempts
+    reconnect_backoff = (1, 30)
+    max_reconnect_attempts = 8
+
+    def __init__(self, url='wss://localhost:17070', password='pass',
+                 auto_reconnect=True, decoder=None, metrics=None):
         self.url = url
         self.password = password
+        self.auto_reconnect = auto_reconnect
+        self.decoder = decoder
+        # per request type counts, latencies and sizes, see
+        # macumba.metrics
+        self.metrics = metrics or RequestMetrics()
+        # ident of the thread reconnecting, others wait for it
+        self._reconnecting = None
         self.connlock = threading.RLock()
+        self._reconnect_done = threading.Condition(self.connlock)
+        # request id -> connection it was sent on, until received
+        self.sent = {}
+        # counts of late and orphaned responses, across reconnects
+        self.response_stats = Counter()
         with self.connlock:
-            self.conn = JujuWS(url, password)
+            self.conn = self._connection()
+        self.facades = {}
         creds['Params']['Password'] = password
 
     def _prepare_strparams(self, d):
@@ -223,22 +480,45 @@ class JujuClient:
         block other threads until done.
         """
         with self.connlock:
-            req_id = self.conn.do_connect()
-            try:
-                res = self.receive(req_id)
-                if 'Error' in res:
-                    raise LoginError(res['ErrorCode'])
-            except Exception as e:
-                raise LoginError(str(e))
+            self.facades = self._login(self.conn)
+
+    def _login(self, conn):
+        """ Connects and logs in conn, returns its facades """
+        req_id = conn.do_connect()
+        self.sent[req_id] = conn
+        try:
+            res = self.receive(req_id)
+            if 'Error' in res:
+                raise LoginError(res['ErrorCode'])
+        except Exception as e:
+            raise LoginError(str(e))
+        return {f['Name']: f['Versions'] for f in res.get('Facades') or []}
 
     def reconnect(self):
+        """ Replaces the connection with a new one, logged in. Other
+        threads only wait for the lock while the new one is swapped in.
+        """
+        with self.connlock:
+            old = self.conn
+        try:
+            old.do_close()
+        except (OSError, RuntimeError):
+            # socket is already gone
+            pass
+        conn = self._connection(old.get_current_request_id() + 1)
+        facades = self._login(conn)
         with self.connlock:
-            self.close()
-            start_id = self.conn.get_current_request_id() + 1
-            self.conn = JujuWS(self.url,
-                               self.password,
-                               start_reqid=start_id)
-            self.login()
+            self.conn = conn
+            self.facades = facades
+
+    def _connection(self, start_reqid=1):
+        """ Returns a new JujuWS, not connected yet """
+        return JujuWS(self.url,
+                      self.password,
+                      start_reqid=start_reqid,
+                      stats=self.response_stats,
+                      decoder=self.decoder,
+                      metrics=self.metrics)
 
     def close(self):
         """ Closes connection to juju websocket """
@@ -254,23 +534,83 @@ class JujuClient:
         with no received message.
 
         """
-        res = None
-        start_time = time.time()
-        while res is None:
+        return self._receive(request_id, timeout or None)
+
+    def _sent_on(self, request_id):
+        """ The connection request_id was sent on, forgetting it """
+        conn = self.sent.pop(request_id, None)
+        if conn is None:
             with self.connlock:
-                res = self.conn.do_receive(request_id)
-            if res is None:
-                time.sleep(0.1)
-                if timeout and (time.time() - start_time > timeout):
-                    raise RequestTimeout(request_id)
+                conn = self.conn
+        return conn
 
-        if 'Error' in res:
-            raise ServerError(res['Error'], res)
+    def _receive(self, request_id, timeout):
+        conn = self._sent_on(request_id)
+        if not conn.wait_for_message(request_id, timeout):
+            conn.abandon(request_id)
+            raise RequestTimeout(request_id)
 
         try:
-            return res['Response']
-        except:
-            raise BadResponseError("Failed to parse response: {}".format(res))
+            res = conn.do_receive(request_id)
+            if res is None:
+                # woken up without a message, connection went away
+                raise ConnectionClosedError(request_id)
+        except ConnectionClosedError:
+            params = conn.requests.get(request_id)
+            raw = request_id in conn.raw_requests
+            if not self.auto_reconnect or params is None:
+                raise
+            self._reconnect_after(conn)
+            if params.get('Request') not in IDEMPOTENT_REQUESTS:
+                raise RequestInterruptedError(request_id, params)
+            log.debug("replaying request {} after "
+                      "reconnect".format(PrettyLog(params)))
+            return self._receive(self.send(params, raw), timeout)
+
+        if isinstance(res, bytes):
+            return res
+        return _parse_response(res)
+
+    def _reconnect_after(self, dead_conn):
+        """ Replaces a dropped connection, retrying with exponential
+        backoff. Does nothing if another thread already did it, waits
+        if another thread is doing it. The backoff runs without holding
+        connlock.
+        """
+        with self.connlock:
+            waited = False
+            while self._reconnecting is not None:
+                if self._reconnecting == threading.get_ident():
+                    raise ConnectionClosedError("lost connection while "
+                                                "reconnecting")
+                self._reconnect_done.wait()
+                waited = True
+            if self.conn is not dead_conn and not self.conn.terminated:
+                return
+            if waited:
+                # the other thread gave up
+                raise ConnectionClosedError("could not reconnect to "
+                                            "{}".format(self.url))
+            self._reconnecting = threading.get_ident()
+        delay, max_delay = self.reconnect_backoff
+        try:
+            for attempt in range(1, self.max_reconnect_attempts + 1):
+                try:
+                    self.reconnect()
+                    log.info("reconnected to {} after {} "
+                             "attempt(s)".format(self.url, attempt))
+                    return
+                except Exception as e:
+                    log.warning("reconnect attempt {} to {} failed: "
+                                "{}".format(attempt, self.url, e))
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+        finally:
+            with self.connlock:
+                self._reconnecting = None
+                self._reconnect_done.notify_all()
+        raise ConnectionClosedError("could not reconnect to "
+                                    "{}".format(self.url))
 
     def call(self, params, timeout=None):
         """ Get json data from juju api daemon.
@@ -278,21 +618,99 @@ class JujuClient:
         :params params: Additional params to be passed into request
         :type params: dict
         """
+        return self.receive(self.send(params), timeout)
+
+    def call_raw(self, params, timeout=None):
+        """ Like call(), but returns the undecoded response frame.
+
+        Nothing is decoded in the websocket thread, so large responses
+        can be decoded later, or only partly, by the caller, e.g. with
+        macumba.json_loads(). Error responses are still raised as
+        ServerError.
+
+        :returns: bytes of the whole response, RequestId included
+        """
+        return self.receive(self.send(params, raw=True), timeout)
+
+    def send(self, params, raw=False):
+        """ Sends a request without waiting for its response.
+
+        :params params: Additional params to be passed into request
+        :type params: dict
+        :param bool raw: have receive() return the undecoded frame
+        :returns: request id to pass to receive()
+        """
         with self.connlock:
-            req_id = self.conn.do_send(params)
+            conn = self.conn
+        if conn.terminated and self.auto_reconnect:
+            self._reconnect_after(conn)
+            with self.connlock:
+                conn = self.conn
+        request_id = conn.do_send(params, raw)
+        self.sent[request_id] = conn
+        return request_id
 
-        return self.receive(req_id, timeout)
+    def call_many(self, params_list, timeout=None, return_exceptions=False):
+        """ Pipelines several requests over the websocket.
+
+        Every request is sent before waiting on any response, so the
+        batch costs about one round trip instead of one per request.
+
+        :param list params_list: request params, as passed to call()
+        :param timeout: seconds to wait for the whole batch
+        :param bool return_exceptions: put a failed request's MacumbaError
+                                       in the results instead of raising it
+        :returns: list of responses in the same order as params_list
+        """
+        req_ids = []
+        results = []
+        try:
+            for params in params_list:
+                req_id = self.send(params)
+                req_ids.append(req_id)
+                conn = self.sent.get(req_id)
+                if conn is not None:
+                    # collected below, even if an earlier one is slow
+                    conn.hold(req_id)
+            deadline = time.time() + timeout if timeout else None
+
+            for req_id in req_ids:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+                try:
+                    results.append(self._receive(req_id, remaining))
+                except MacumbaError as e:
+                    results.append(e)
+        finally:
+            # interrupted, don't keep the responses nobody will collect
+            for req_id in req_ids[len(results):]:
+                self._sent_on(req_id).abandon(req_id)
+
+        return _results_or_raise(results, return_exceptions)
 
     def info(self):
         """ Returns Juju environment state """
         return self.call(dict(Type="Client",
                               Request="EnvironmentInfo"))
 
-    def status(self):
-        """ Returns status of juju environment """
-        return self.call(dict(Type="Client",
-                              Request="FullStatus"),
-                         timeout=60)
+    def _status_params(self, patterns):
+        params = dict(Type="Client", Request="FullStatus")
+        if patterns:
+            params['Params'] = dict(Patterns=list(patterns))
+        return params
+
+    def status(self, patterns=None):
+        """ Returns status of juju environment
+
+        :param list patterns: only the services, units and machines
+                              matching these juju status patterns
+        """
+        return self.call(self._status_params(patterns), timeout=60)
+
+    def status_raw(self, patterns=None):
+        """ Returns the undecoded FullStatus response, see call_raw() """
+        return self.call_raw(self._status_params(patterns), timeout=60)
 
     def get_watcher(self):
         """ Returns watcher """
@@ -343,6 +761,13 @@ class JujuClient:
                     machine_spec="", parent_id="", container_type=""):
         """Allocate a new machine from the iaas provider.
         """
+        return self.add_machines([self.machine_params(
+            series, constraints, machine_spec, parent_id, container_type)])
+
+    def machine_params(self, series="", constraints={},
+                       machine_spec="", parent_id="", container_type=""):
+        """Build the params for one machine, suitable for add_machines().
+        """
         if machine_spec:
             err_msg = "Cant specify machine spec with container_type/parent_id"
             assert not (parent_id or container_type), err_msg
@@ -354,7 +779,7 @@ class JujuClient:
             ParentId=parent_id,
             Constraints=self._prepare_constraints(constraints),
             Jobs=[Jobs.HostUnits])
-        return self.add_machines([params])
+        return params
 
     def add_machines(self, machines):
         """ Add machines """
@@ -373,19 +798,36 @@ class JujuClient:
     def add_relation(self, endpoint_a, endpoint_b):
         """ Adds relation between units """
         try:
-            rv = self.call(dict(Type="Client",
-                                Request="AddRelation",
-                                Params=dict(Endpoints=[endpoint_a,
-                                                       endpoint_b])))
+            rv = self.call(self._add_relation_params(endpoint_a, endpoint_b))
         except ServerError as e:
-            # do not treat pre-existing relations as exceptions:
-            if 'relation already exists' in e.response['Error']:
-                rv = e.response
-            else:
-                raise e
+            rv = _existing_relation_response(e)
 
         return rv
 
+    def add_relations(self, relations, return_exceptions=False):
+        """ Adds several relations in one pipelined batch
+
+        :param list relations: (endpoint_a, endpoint_b) tuples
+        :param bool return_exceptions: see call_many()
+        :returns: list of responses, one per relation
+        """
+        results = self.call_many([self._add_relation_params(a, b)
+                                  for a, b in relations],
+                                 return_exceptions=True)
+        for i, rv in enumerate(results):
+            if isinstance(rv, ServerError):
+                try:
+                    results[i] = _existing_relation_response(rv)
+                except ServerError:
+                    pass
+        return _results_or_raise(results, return_exceptions)
+
+    def _add_relation_params(self, endpoint_a, endpoint_b):
+        return dict(Type="Client",
+                    Request="AddRelation",
+                    Params=dict(Endpoints=[endpoint_a,
+                                           endpoint_b]))
+
     def remove_relation(self, endpoint_a, endpoint_b):
         """ Removes relation """
         return self.call(dict(Type="Client",
@@ -405,10 +847,15 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns: Deployed charm status
         """
-        params = {'ServiceName': service_name}
-
         _url = query_cs(charm)
-        params['CharmUrl'] = _url['charm']['url']
+        return self.call(self._deploy_params(
+            _url['charm']['url'], service_name, num_units, config_yaml,
+            constraints, machine_spec))
+
+    def _deploy_params(self, charm_url, service_name, num_units, config_yaml,
+                       constraints, machine_spec):
+        params = {'ServiceName': service_name}
+        params['CharmUrl'] = charm_url
         params['NumUnits'] = num_units
         params['ConfigYAML'] = config_yaml
 
@@ -417,9 +864,9 @@ class JujuClient:
                 constraints)
         if machine_spec:
             params['ToMachineSpec'] = machine_spec
-        return self.call(dict(Type="Client",
-                              Request="ServiceDeploy",
-                              Params=dict(params)))
+        return dict(Type="Client",
+                    Request="ServiceDeploy",
+                    Params=dict(params))
 
     def set_config(self, service_name, config_keys):
         """ Sets machine config """
@@ -509,15 +956,37 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns dict: Units added
         """
+        return self.call(self._add_unit_params(service_name, num_units,
+                                               machine_spec))
+
+    def add_units(self, units, return_exceptions=False):
+        """ Add units to several machines in one pipelined batch
+
+        Units for the same service and machine spec are folded into a
+        single AddServiceUnits request.
+
+        :param list units: (service_name, num_units, machine_spec) tuples
+        :param bool return_exceptions: see call_many()
+        :returns: list of responses, one per distinct (service, spec)
+        """
+        folded = OrderedDict()
+        for service_name, num_units, machine_spec in units:
+            key = (service_name, machine_spec)
+            folded[key] = folded.get(key, 0) + num_units
+        return self.call_many([self._add_unit_params(svc, n, spec)
+                               for (svc, spec), n in folded.items()],
+                              return_exceptions=return_exceptions)
+
+    def _add_unit_params(self, service_name, num_units, machine_spec):
         params = {}
         params['ServiceName'] = service_name
         params['NumUnits'] = num_units
         if machine_spec:
             params['ToMachineSpec'] = machine_spec
 
-        return self.call(dict(Type="Client",
-                              Request="AddServiceUnits",
-                              Params=dict(params)))
+        return dict(Type="Client",
+                    Request="AddServiceUnits",
+                    Params=dict(params))
 
     def remove_unit(self, unit_names):
         """ Removes unit """
@@ -547,9 +1016,52 @@ class JujuClient:
                               Params=dict(Tag="%s-%s" % (entity_type, entity),
                                           Pairs=annotation)))
 
+    def set_annotations_many(self, annotations, return_exceptions=False):
+        """ Sets annotations on several entities.
+
+        Uses a single Annotations.Set request when the server offers
+        the Annotations facade, otherwise pipelines SetAnnotations.
+
+        :param list annotations: (entity, entity_type, annotation) tuples
+        :param bool return_exceptions: see call_many()
+        """
+        if 'Annotations' in self.facades:
+            rv = self.call(self._annotations_set_params(annotations))
+            return _annotations_set_result(rv, return_exceptions)
+        return self.call_many(
+            [dict(Type="Client",
+                  Request="SetAnnotations",
+                  Params=dict(Tag="%s-%s" % (entity_type, entity),
+                              Pairs=annotation))
+             for entity, entity_type, annotation in annotations],
+            return_exceptions=return_exceptions)
+
+    def _annotations_set_params(self, annotations):
+        entities = [dict(EntityTag="%s-%s" % (entity_type, entity),
+                         Annotations=annotation)
+                    for entity, entity_type, annotation in annotations]
+        return dict(Type="Annotations",
+                    Version=max(self.facades['Annotations']),
+                    Request="Set",
+                    Params=dict(Annotations=entities))
+
     def get_annotations(self, entity, entity_type):
         """ Gets annotations """
         return self.call(dict(Type="Client",
                               Request="GetAnnotations",
                               Params=dict(Tag="%s-%s" % (entity_type,
                                                          entity))))
+
+    def get_annotations_many(self, entities, return_exceptions=False):
+        """ Gets annotations for several entities in one pipelined batch
+
+        :param list entities: (entity, entity_type) tuples
+        :param bool return_exceptions: see call_many()
+        :returns: list of responses, one per entity
+        """
+        return self.call_many(
+            [dict(Type="Client",
+                  Request="GetAnnotations",
+                  Params=dict(Tag="%s-%s" % (entity_type, entity)))
+             for entity, entity_type in entities],
+            return_exceptions=return_exceptions)
@@ -0,0 +1,367 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" asyncio juju client
+
+Runs on an asyncio event loop (by default the one urwid is driven by)
+instead of a private reader thread. API methods are coroutines:
+
+    client = AsyncJujuClient(url, password)
+    yield from client.login()
+    status = yield from client.status()
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import time
+
+from ws4py.client import WebSocketBaseClient
+from ws4py.exc import HandshakeError
+
+from macumba import (JujuClient, MacumbaError, LoginError, ServerError,
+                     ConnectionClosedError, RequestTimeout,
+                     UnknownRequestError, RESPONSE_HEAD_RE, creds,
+                     json_loads, query_cs, _parse_response, _results_or_raise,
+                     _annotations_set_result, _existing_relation_response)
+from macumba.metrics import RequestMetrics, request_type
+
+log = logging.getLogger('macumba.aio')
+
+
+class AsyncJujuWS(WebSocketBaseClient):
+
+    """ websocket connection driven by an asyncio event loop """
+
+    def __init__(self, url, loop, protocols=['https-only'],
+                 extensions=None, ssl_options=None, headers=None,
+                 start_reqid=1, decoder=None, metrics=None):
+        WebSocketBaseClient.__init__(self, url, protocols, extensions,
+                                     ssl_options=ssl_options,
+                                     headers=headers)
+        self.decode = decoder or json_loads
+        self.metrics = metrics
+        # the blocking socket made by the base class is never used
+        WebSocketBaseClient.close_connection(self)
+        self.loop = loop
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        # request ids whose response is handed back undecoded
+        self.raw_requests = set()
+        # request id -> (request type, send time, bytes sent)
+        self.inflight = {}
+        self._cur_request_id = start_reqid
+
+    @asyncio.coroutine
+    def connect(self):
+        """ Opens the connection and runs the upgrade handshake """
+        ssl_ctx = None
+        if self.scheme == "wss":
+            # same as the threaded client: no certificate checks
+            ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.reader, self.writer = yield from asyncio.open_connection(
+            self.host, self.port, ssl=ssl_ctx, loop=self.loop)
+
+        self._write(self.handshake_request)
+
+        response_line = yield from self.reader.readline()
+        headers = b''
+        while True:
+            line = yield from self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            headers += line
+        if not response_line:
+            self.close_connection()
+            raise HandshakeError("Invalid response")
+
+        try:
+            self.process_response_line(response_line.strip())
+            self.protocols, self.extensions = \
+                self.process_handshake_header(headers)
+        except HandshakeError:
+            self.close_connection()
+            raise
+
+        self.loop.create_task(self._read_frames())
+
+    @asyncio.coroutine
+    def _read_frames(self):
+        try:
+            while not self.terminated:
+                data = yield from self.reader.read(self.reading_buffer_size)
+                if not self.process(data):
+                    break
+        except Exception:
+            log.exception("error reading from juju websocket")
+        finally:
+            if self.stream is not None:
+                self.terminate()
+
+    def _write(self, b):
+        if self.terminated or self.writer is None:
+            raise RuntimeError("Cannot send on a terminated websocket")
+        self.writer.write(b)
+
+    def close_connection(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def received_message(self, m):
+        msg_req_id = self._raw_request_id(m.data)
+        if msg_req_id is None:
+            msg = self.decode(m.data)
+            msg_req_id = msg['RequestId']
+            if msg_req_id in self.raw_requests and 'Error' not in msg:
+                # fields in an unexpected order, already decoded anyway
+                msg = m.data
+        else:
+            msg = m.data
+        self.raw_requests.discard(msg_req_id)
+        fut = self.pending.pop(msg_req_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+        sent = self.inflight.pop(msg_req_id, None)
+        if sent is not None and self.metrics is not None:
+            name, sent_at, bytes_out = sent
+            self.metrics.record(name, time.monotonic() - sent_at,
+                                bytes_out, len(m.data),
+                                error=isinstance(msg, dict) and 'Error' in msg)
+
+    def _raw_request_id(self, data):
+        """ See JujuWS._raw_request_id() """
+        if not self.raw_requests:
+            return None
+        match = RESPONSE_HEAD_RE.match(data, 0, 64)
+        if match is None or match.group(2) != b'Response':
+            return None
+        request_id = int(match.group(1))
+        if request_id not in self.raw_requests:
+            return None
+        return request_id
+
+    def abandon(self, request_id):
+        """ The caller stopped waiting for request_id """
+        self.pending.pop(request_id, None)
+        self.raw_requests.discard(request_id)
+        sent = self.inflight.pop(request_id, None)
+        if sent is not None and self.metrics is not None:
+            name, sent_at, bytes_out = sent
+            self.metrics.record(name, bytes_out=bytes_out, timed_out=True)
+
+    def closed(self, code, reason=None):
+        log.debug("socket closed: code:{} reason:{}".format(code, reason))
+        pending, self.pending = self.pending, {}
+        self.inflight = {}
+        self.raw_requests = set()
+        for req_id, fut in pending.items():
+            if not fut.done():
+                fut.set_exception(ConnectionClosedError(req_id))
+
+    def get_current_request_id(self):
+        "only intended to pass to constructor of a replacing client"
+        return self._cur_request_id
+
+    def do_send(self, json_message, raw=False):
+        """ Sends a request.
+
+        :param bool raw: resolve the future to the undecoded frame
+        :returns: (request id, future resolving to the response)
+        """
+        self._cur_request_id += 1
+        request_id = self._cur_request_id
+        json_message['RequestId'] = request_id
+
+        fut = asyncio.Future(loop=self.loop)
+        self.pending[request_id] = fut
+        if raw:
+            self.raw_requests.add(request_id)
+        data = json.dumps(json_message)
+        self.inflight[request_id] = (request_type(json_message),
+                                     time.monotonic(), len(data))
+        self.send(data)
+        return request_id, fut
+
+
+class AsyncJujuClient(JujuClient):
+
+    """ JujuClient whose API methods are coroutines
+
+    Shares the calling thread's event loop, so no locks or extra
+    threads are involved. Every method inherited from JujuClient that
+    only wraps call() works unchanged; the ones that post-process a
+    response are overridden below. send() returns a request id at
+    once, receive() is a coroutine.
+    """
+
+    def __init__(self, url='wss://localhost:17070', password='pass',
+                 loop=None, decoder=None, metrics=None):
+        self.url = url
+        self.password = password
+        self.decoder = decoder
+        self.metrics = metrics or RequestMetrics()
+        self.loop = loop or asyncio.get_event_loop()
+        self.conn = AsyncJujuWS(url, self.loop, decoder=decoder,
+                                metrics=self.metrics)
+        self.facades = {}
+        # request id -> future of requests sent but not received
+        self.sent = {}
+        creds['Params']['Password'] = password
+
+    @asyncio.coroutine
+    def login(self):
+        """ Connect and log in to juju websocket endpoint. """
+        try:
+            yield from self.conn.connect()
+            res = yield from self.call(dict(creds))
+        except Exception as e:
+            raise LoginError(str(e))
+        self.facades = {f['Name']: f['Versions']
+                        for f in res.get('Facades') or []}
+
+    @asyncio.coroutine
+    def reconnect(self):
+        self.close()
+        start_id = self.conn.get_current_request_id() + 1
+        self.conn = AsyncJujuWS(self.url, self.loop, start_reqid=start_id,
+                                decoder=self.decoder,
+                                metrics=self.metrics)
+        yield from self.login()
+
+    def close(self):
+        """ Closes connection to juju websocket """
+        if not self.conn.terminated and self.conn.writer is not None:
+            self.conn.close()
+
+    @asyncio.coroutine
+    def call(self, params, timeout=None):
+        """ Get json data from juju api daemon.
+
+        :params params: Additional params to be passed into request
+        :type params: dict
+        """
+        rv = yield from self.receive(self.send(params), timeout)
+        return rv
+
+    @asyncio.coroutine
+    def call_raw(self, params, timeout=None):
+        """ Like call(), but returns the undecoded response frame.
+
+        See JujuClient.call_raw().
+        """
+        rv = yield from self.receive(self.send(params, raw=True), timeout)
+        return rv
+
+    def send(self, params, raw=False):
+        """ Sends a request without waiting for its response.
+
+        :param bool raw: have receive() return the undecoded frame
+        :returns: request id to pass to receive()
+        """
+        req_id, fut = self.conn.do_send(params, raw)
+        self.sent[req_id] = (self.conn, fut)
+        return req_id
+
+    @asyncio.coroutine
+    def receive(self, request_id, timeout=None):
+        """ Waits for the response to request_id.
+
+        Raises RequestTimeout after 'timeout' seconds with no response.
+        """
+        try:
+            conn, fut = self.sent.pop(request_id)
+        except KeyError:
+            raise UnknownRequestError("{} not sent, or already "
+                                      "received".format(request_id))
+        try:
+            res = yield from asyncio.wait_for(fut, timeout or None,
+                                              loop=self.loop)
+        except asyncio.TimeoutError:
+            conn.abandon(request_id)
+            raise RequestTimeout(request_id)
+        finally:
+            conn.pending.pop(request_id, None)
+        if isinstance(res, bytes):
+            return res
+        return _parse_response(res)
+
+    @asyncio.coroutine
+    def call_many(self, params_list, timeout=None, return_exceptions=False):
+        """ Pipelines several requests over the websocket.
+
+        See JujuClient.call_many().
+        """
+        results = yield from asyncio.gather(
+            *[self.call(params, timeout) for params in params_list],
+            loop=self.loop, return_exceptions=True)
+        return _results_or_raise(results, return_exceptions)
+
+    @asyncio.coroutine
+    def add_relation(self, endpoint_a, endpoint_b):
+        """ Adds relation between units """
+        try:
+            rv = yield from self.call(
+                self._add_relation_params(endpoint_a, endpoint_b))
+        except ServerError as e:
+            rv = _existing_relation_response(e)
+        return rv
+
+    @asyncio.coroutine
+    def add_relations(self, relations, return_exceptions=False):
+        """ Adds several relations in one pipelined batch """
+        results = yield from self.call_many(
+            [self._add_relation_params(a, b) for a, b in relations],
+            return_exceptions=True)
+        for i, rv in enumerate(results):
+            if isinstance(rv, ServerError):
+                try:
+                    results[i] = _existing_relation_response(rv)
+                except MacumbaError:
+                    pass
+        return _results_or_raise(results, return_exceptions)
+
+    @asyncio.coroutine
+    def deploy(self, charm, service_name, num_units=1, config_yaml="",
+               constraints=None, machine_spec=""):
+        """ Deploy a charm to an instance
+
+        The charm store lookup runs in the loop's default executor.
+        """
+        _url = yield from self.loop.run_in_executor(None, query_cs, charm)
+        rv = yield from self.call(self._deploy_params(
+            _url['charm']['url'], service_name, num_units, config_yaml,
+            constraints, machine_spec))
+        return rv
+
+    @asyncio.coroutine
+    def get_config(self, service_name):
+        """ Get service configuration """
+        svc = yield from self.get_service(service_name)
+        return svc['Config']
+
+    @asyncio.coroutine
+    def set_annotations_many(self, annotations, return_exceptions=False):
+        """ Sets annotations on several entities. """
+        if 'Annotations' in self.facades:
+            rv = yield from self.call(
+                self._annotations_set_params(annotations))
+            return _annotations_set_result(rv, return_exceptions)
+        rv = yield from super().set_annotations_many(annotations,
+                                                     return_exceptions)
+        return rv
@@ -0,0 +1,163 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" cached charm store lookups
+
+Charm metadata is kept in memory and on disk. Entries younger than
+ttl are used as they are. Older ones are revalidated with their ETag,
+and are still used when the charm store can't be reached:
+
+    info = charm_store.query('keystone')
+    infos = charm_store.query_many(['keystone', 'nova-compute'])
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from os import path
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from macumba import CharmNotFoundError, _results_or_raise
+
+log = logging.getLogger('macumba.charmstore')
+
+CHARM_STORE_URL = 'https://manage.jujucharms.com/api/3/charm'
+
+
+class CharmStoreCache:
+
+    """ Charm store metadata, cached on disk under cache_dir
+
+    :param str cache_dir: where to keep entries, None for memory only
+    :param int ttl: seconds an entry is used without revalidating
+    """
+
+    timeout = 10
+    max_workers = 8
+
+    def __init__(self, cache_dir=None, ttl=3600, url=CHARM_STORE_URL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.url = url
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers, max_retries=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _filename(self, series, charm):
+        return path.join(self.cache_dir, series, "{}.json".format(charm))
+
+    def _load(self, series, charm):
+        key = (series, charm)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None or self.cache_dir is None:
+            return entry
+        try:
+            with open(self._filename(series, charm)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def _store(self, series, charm, entry):
+        with self.lock:
+            self.entries[(series, charm)] = entry
+        if self.cache_dir is None:
+            return
+        filename = self._filename(series, charm)
+        try:
+            os.makedirs(path.dirname(filename), exist_ok=True)
+            tmp = "{}.{}".format(filename, threading.get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, filename)
+        except OSError:
+            log.exception("could not cache charm store entry "
+                          "{}".format(filename))
+
+    def query(self, charm, series='trusty'):
+        """ Returns the charm store metadata of charm
+
+        :raises CharmNotFoundError: if the charm store doesn't know the
+                                    charm, or can't be reached and
+                                    nothing is cached
+        """
+        entry = self._load(series, charm)
+        if entry is not None and time.time() - entry['fetched'] < self.ttl:
+            return entry['data']
+
+        url = path.join(self.url, series, charm)
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if entry is not None:
+                log.warning("charm store unreachable ({}), using cached "
+                            "{}".format(e, url))
+                return entry['data']
+            raise CharmNotFoundError("could not reach charm store for "
+                                     "{}: {}".format(url, e))
+
+        if r.status_code == 304 and entry is not None:
+            entry = dict(entry, fetched=time.time())
+        elif r.status_code == 200:
+            entry = dict(data=r.json(), etag=r.headers.get('ETag'),
+                         fetched=time.time())
+        else:
+            log.error("could not find charm store URL for charm "
+                      "'{}'".format(url))
+            try:
+                rj = r.json()
+                msg = "{type} {charm_id}".format(**rj)
+            except (ValueError, KeyError):
+                msg = "{} {}".format(r.status_code, url)
+            raise CharmNotFoundError(msg)
+        self._store(series, charm, entry)
+        return entry['data']
+
+    def query_many(self, charms, series='trusty', return_exceptions=False):
+        """ Looks up several charms in parallel
+
+        :param list charms: charm names
+        :param bool return_exceptions: put a failed lookup's error in
+                                       the results instead of raising it
+        :returns: list of metadata in the same order as charms
+        """
+        def query(charm):
+            try:
+                return self.query(charm, series)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(query, charms))
+        return _results_or_raise(results, return_exceptions)
+
+
+charm_store = CharmStoreCache(
+    cache_dir=path.expanduser('~/.cache/macumba/charmstore'))
@@ -0,0 +1,568 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" fake juju api server
+
+Speaks the part of the juju websocket api macumba uses, against an
+in-memory environment, for tests and offline benchmarks:
+
+    env = FakeJujuEnvironment(agent_delay=0.5)
+    env.populate(services=50, units_per_service=10)
+    server = FakeJujuServer(env, latency=0.02, error_rate=0.01)
+    server.start()
+    client = JujuClient(url=server.url, password='pass')
+
+The server speaks plain ws://, not wss://.
+"""
+
+import fnmatch
+import json
+import logging
+import random
+import threading
+from collections import OrderedDict
+from wsgiref.simple_server import make_server
+
+from ws4py.server.wsgirefserver import (WSGIServer,
+                                        WebSocketWSGIRequestHandler)
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.websocket import WebSocket
+
+log = logging.getLogger('macumba.fakeserver')
+
+DEFAULT_HARDWARE = dict(Arch='amd64', CpuCores=1, Mem=1024, RootDisk=8192)
+
+
+class FakeJujuError(Exception):
+
+    "Sent back to the client as the response's Error"
+
+
+class FakeJujuEnvironment:
+
+    """ In-memory juju environment
+
+    Entities are kept in AllWatcher delta form, FullStatus is built
+    from them. Every change is appended to a delta log that watchers
+    read from.
+
+    :param float agent_delay: seconds new machines and units stay
+                              pending before they are started, None
+                              to leave them pending
+    """
+
+    def __init__(self, agent_delay=0, series='trusty'):
+        self.agent_delay = agent_delay
+        self.series = series
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.machines = OrderedDict()
+        self.services = OrderedDict()
+        self.units = OrderedDict()
+        self.relations = OrderedDict()
+        self.annotations = {}
+        self.deltas = []
+        self.watchers = {}
+        self._next_machine = 0
+        self._next_container = {}
+        self._next_unit = {}
+        self._next_watcher = 0
+        # the bootstrap node
+        bootstrap = self.add_machine()
+        self.machines[bootstrap]['Jobs'] = ['JobManageEnviron']
+        self._start('machine', bootstrap)
+
+    def _changed(self, kind, entity, change='change'):
+        self.deltas.append([kind, change, dict(entity)])
+        self.changed.notify_all()
+
+    def _start_later(self, kind, key):
+        if self.agent_delay is None:
+            return
+        if self.agent_delay == 0:
+            self._start(kind, key)
+        else:
+            timer = threading.Timer(self.agent_delay, self._start,
+                                    [kind, key])
+            timer.daemon = True
+            timer.start()
+
+    def _start(self, kind, key):
+        with self.lock:
+            if kind == 'machine':
+                m = self.machines.get(key)
+                if m is None:
+                    return
+                m.update(Status='started',
+                         InstanceId='fake-{}'.format(key.replace('/', '-')),
+                         Addresses=[dict(Value=self._hostname(key),
+                                         Type='hostname',
+                                         Scope='public')],
+                         HardwareCharacteristics=dict(DEFAULT_HARDWARE))
+                self._changed('machine', m)
+            else:
+                u = self.units.get(key)
+                if u is None:
+                    return
+                m = self.machines.get(u['MachineId'], {})
+                if m.get('Status') != 'started':
+                    # units start after their machine, like in juju
+                    self._start_later('unit', key)
+                    return
+                u.update(Status='started',
+                         PublicAddress=self._hostname(u['MachineId']),
+                         WorkloadStatus=dict(Current='active', Message=''),
+                         AgentStatus=dict(Current='idle', Message=''))
+                self._changed('unit', u)
+
+    def _hostname(self, machine_id):
+        return "machine-{}.fake".format(machine_id.replace('/', '-'))
+
+    # environment changes, also used by the request handlers
+    def add_machine(self, parent_id='', container_type='', series=''):
+        """ Adds a pending machine, or a container if parent_id is set.
+        Returns its id.
+        """
+        with self.lock:
+            if parent_id:
+                if parent_id not in self.machines:
+                    raise FakeJujuError("machine {} not found".format(
+                        parent_id))
+                key = (parent_id, container_type)
+                n = self._next_container.get(key, 0)
+                self._next_container[key] = n + 1
+                mid = "{}/{}/{}".format(parent_id, container_type, n)
+            else:
+                mid = str(self._next_machine)
+                self._next_machine += 1
+            self.machines[mid] = dict(Id=mid, InstanceId='',
+                                      Status='pending', StatusInfo='',
+                                      Life='alive',
+                                      Series=series or self.series,
+                                      Jobs=['JobHostUnits'],
+                                      Addresses=[],
+                                      HardwareCharacteristics={},
+                                      HasVote=False, WantsVote=False)
+            self._changed('machine', self.machines[mid])
+            self._start_later('machine', mid)
+            return mid
+
+    def _place(self, machine_spec):
+        """ machine id for a unit placed with a ToMachineSpec """
+        if not machine_spec:
+            return self.add_machine()
+        if ':' in machine_spec:
+            container_type, parent_id = machine_spec.split(':', 1)
+            return self.add_machine(parent_id, container_type)
+        if machine_spec not in self.machines:
+            raise FakeJujuError("machine {} not found".format(machine_spec))
+        return machine_spec
+
+    def deploy(self, name, charm_url, num_units=1, machine_spec=''):
+        with self.lock:
+            if name in self.services:
+                raise FakeJujuError("service already exists")
+            self.services[name] = dict(Name=name, CharmURL=charm_url,
+                                       Exposed=False, Life='alive',
+                                       Subordinate=False)
+            self._changed('service', self.services[name])
+            return self.add_units(name, num_units, machine_spec)
+
+    def add_units(self, service_name, num_units=1, machine_spec=''):
+        with self.lock:
+            svc = self.services.get(service_name)
+            if svc is None:
+                raise FakeJujuError("service {} not found".format(
+                    service_name))
+            names = []
+            for _ in range(num_units):
+                n = self._next_unit.get(service_name, 0)
+                self._next_unit[service_name] = n + 1
+                name = "{}/{}".format(service_name, n)
+                self.units[name] = dict(
+                    Name=name, Service=service_name,
+                    CharmURL=svc['CharmURL'],
+                    MachineId=self._place(machine_spec),
+                    PublicAddress='', Status='pending', StatusInfo='',
+                    Subordinate=False,
+                    WorkloadStatus=dict(Current='unknown', Message=''),
+                    AgentStatus=dict(Current='allocating', Message=''))
+                self._changed('unit', self.units[name])
+                self._start_later('unit', name)
+                names.append(name)
+            return names
+
+    def add_relation(self, endpoint_a, endpoint_b):
+        with self.lock:
+            endpoints = []
+            for ep in (endpoint_a, endpoint_b):
+                service, _, relation = ep.partition(':')
+                if service not in self.services:
+                    raise FakeJujuError("service {} not found".format(
+                        service))
+                endpoints.append(dict(ServiceName=service,
+                                      Relation=dict(
+                                          Name=relation or 'juju-info',
+                                          Role='peer',
+                                          Interface=relation or 'juju-info',
+                                          Scope='global')))
+            key = " ".join(sorted("{}:{}".format(
+                e['ServiceName'], e['Relation']['Name']) for e in endpoints))
+            if key in self.relations:
+                raise FakeJujuError("cannot add relation \"{}\": relation "
+                                    "already exists".format(key))
+            self.relations[key] = dict(Key=key, Endpoints=endpoints)
+            self._changed('relation', self.relations[key])
+            return {e['ServiceName']: e['Relation'] for e in endpoints}
+
+    def populate(self, services=0, units_per_service=1, relations=True):
+        """ Adds started services and units, each unit on its own
+        machine. With relations, each service is related to the
+        previous one.
+        """
+        delay, self.agent_delay = self.agent_delay, 0
+        try:
+            for n in range(services):
+                name = "service-{}".format(n)
+                self.deploy(name, "cs:{}/{}-1".format(self.series, name),
+                            units_per_service)
+                if relations and n > 0:
+                    self.add_relation("service-{}:db".format(n - 1),
+                                      "{}:db".format(name))
+        finally:
+            self.agent_delay = delay
+
+    # status
+    def _machine_status(self, m):
+        hwc = m['HardwareCharacteristics']
+        hw = [('arch', hwc.get('Arch')),
+              ('cpu-cores', hwc.get('CpuCores')),
+              ('mem', hwc.get('Mem') and "{}M".format(hwc['Mem'])),
+              ('root-disk', hwc.get('RootDisk') and
+               "{}M".format(hwc['RootDisk']))]
+        addresses = [a['Value'] for a in m['Addresses']]
+        return dict(Id=m['Id'], InstanceId=m['InstanceId'],
+                    AgentState=m['Status'],
+                    AgentStateInfo=m['StatusInfo'],
+                    Agent=dict(Status=m['Status'], Info=m['StatusInfo']),
+                    DNSName=addresses[0] if addresses else '',
+                    Series=m['Series'], Jobs=m['Jobs'], Life=m['Life'],
+                    HasVote=m['HasVote'], WantsVote=m['WantsVote'],
+                    Hardware=" ".join("{}={}".format(k, v)
+                                      for k, v in hw if v),
+                    Containers={})
+
+    def full_status(self, patterns=None):
+        with self.lock:
+            machines = {}
+            for mid, m in self.machines.items():
+                parts = mid.split('/')
+                if len(parts) == 1:
+                    machines[mid] = self._machine_status(m)
+                else:
+                    parent = machines[parts[0]]
+                    parent['Containers'][mid] = self._machine_status(m)
+
+            services = {}
+            for name, s in self.services.items():
+                services[name] = dict(Charm=s['CharmURL'],
+                                      Exposed=s['Exposed'], Life=s['Life'],
+                                      Relations={}, Units={},
+                                      SubordinateTo=[], Networks={})
+            for name, u in self.units.items():
+                services[u['Service']]['Units'][name] = dict(
+                    AgentState=u['Status'],
+                    AgentStateInfo=u['StatusInfo'],
+                    Machine=u['MachineId'],
+                    PublicAddress=u['PublicAddress'],
+                    Charm=u['CharmURL'],
+                    Workload=dict(Status=u['WorkloadStatus']['Current'],
+                                  Info=u['WorkloadStatus']['Message']),
+                    UnitAgent=dict(Status=u['AgentStatus']['Current'],
+                                   Info=u['AgentStatus']['Message']))
+            for r in self.relations.values():
+                names = [e['ServiceName'] for e in r['Endpoints']]
+                for e in r['Endpoints']:
+                    others = [n for n in names if n != e['ServiceName']] \
+                        or [e['ServiceName']]
+                    rels = services[e['ServiceName']]['Relations']
+                    rels.setdefault(e['Relation']['Name'], []).extend(others)
+            if patterns:
+                machines, services = self._filter_status(machines, services,
+                                                         patterns)
+            return dict(EnvironmentName='fake', Machines=machines,
+                        Services=services, Networks={})
+
+    def _filter_status(self, machines, services, patterns):
+        """ Keeps what patterns match like juju does: services and units
+        by name, machines by id, and the machines hosting kept units
+        """
+        def matches(name):
+            return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+        kept_services = {}
+        hosts = set()
+        for name, svc in services.items():
+            units = {u: unit for u, unit in svc['Units'].items()
+                     if matches(name) or matches(u)}
+            if matches(name) or units:
+                kept_services[name] = dict(svc, Units=units)
+                hosts.update(unit['Machine'].split('/')[0]
+                             for unit in units.values())
+        kept_machines = {mid: m for mid, m in machines.items()
+                         if mid in hosts or matches(mid)}
+        return kept_machines, kept_services
+
+    # allwatcher
+    def watch(self):
+        with self.lock:
+            self._next_watcher += 1
+            watcher_id = str(self._next_watcher)
+            self.watchers[watcher_id] = None
+            return watcher_id
+
+    def next_deltas(self, watcher_id):
+        """ Blocks until there are changes the watcher hasn't seen. The
+        first call returns the whole environment.
+        """
+        with self.lock:
+            if watcher_id not in self.watchers:
+                raise FakeJujuError("unknown watcher id")
+            cursor = self.watchers[watcher_id]
+            if cursor is None:
+                deltas = ([['machine', 'change', dict(m)]
+                           for m in self.machines.values()] +
+                          [['service', 'change', dict(s)]
+                           for s in self.services.values()] +
+                          [['unit', 'change', dict(u)]
+                           for u in self.units.values()] +
+                          [['relation', 'change', dict(r)]
+                           for r in self.relations.values()])
+            else:
+                while len(self.deltas) == cursor and \
+                        watcher_id in self.watchers:
+                    self.changed.wait()
+                if watcher_id not in self.watchers:
+                    raise FakeJujuError("watcher was stopped")
+                deltas = self.deltas[cursor:]
+            self.watchers[watcher_id] = len(self.deltas)
+            return deltas
+
+    def stop_watcher(self, watcher_id):
+        with self.lock:
+            self.watchers.pop(watcher_id, None)
+            self.changed.notify_all()
+
+
+class FakeJujuSocket(WebSocket):
+
+    """ One client connection, requests are answered by self.server """
+
+    server = None
+
+    def opened(self):
+        self.sendlock = threading.Lock()
+
+    def received_message(self, m):
+        self.server.dispatch(self, json.loads(m.data.decode('utf-8')))
+
+    def send_frame(self, frame):
+        with self.sendlock:
+            if not self.terminated:
+                self.send(json.dumps(frame))
+
+
+class FakeJujuServer:
+
+    """ Serves a FakeJujuEnvironment over the juju websocket api
+
+    :param float latency: seconds to hold back every response
+    :param float error_rate: fraction of requests answered with an
+                             injected error
+    :param dict errors: request name -> error message, always returned
+                        for that request, e.g. {'ServiceDeploy': 'boom'}
+    :param int seed: seed for the error injection
+    """
+
+    facades = [dict(Name='Client', Versions=[0]),
+               dict(Name='AllWatcher', Versions=[0]),
+               dict(Name='Annotations', Versions=[1])]
+
+    def __init__(self, env=None, host='127.0.0.1', port=0, latency=0,
+                 error_rate=0, errors=None, seed=None):
+        self.env = env or FakeJujuEnvironment()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors or {}
+        self.random = random.Random(seed)
+        self.requests = 0
+        socket_cls = type('FakeJujuSocket', (FakeJujuSocket,),
+                          dict(server=self))
+        self.httpd = make_server(
+            host, port, server_class=WSGIServer,
+            handler_class=WebSocketWSGIRequestHandler,
+            app=WebSocketWSGIApplication(handler_cls=socket_cls))
+        self.httpd.initialize_websockets_manager()
+        self.thread = None
+        self.handlers = {
+            ('Admin', 'Login'): self.login,
+            ('Client', 'FullStatus'):
+                lambda p: self.env.full_status(p.get('Patterns')),
+            ('Client', 'EnvironmentInfo'): self.environment_info,
+            ('Client', 'CharmInfo'): self.charm_info,
+            ('Client', 'ServiceGet'): self.service_get,
+            ('Client', 'ServiceDeploy'): self.service_deploy,
+            ('Client', 'AddServiceUnits'): self.add_service_units,
+            ('Client', 'AddMachines'): self.add_machines,
+            ('Client', 'AddRelation'): self.add_relation,
+            ('Client', 'SetAnnotations'): self.set_annotations,
+            ('Client', 'GetAnnotations'): self.get_annotations,
+            ('Annotations', 'Set'): self.annotations_set,
+            ('Client', 'WatchAll'): self.watch_all,
+            ('AllWatcher', 'Next'): self.allwatcher_next,
+            ('AllWatcher', 'Stop'): self.allwatcher_stop,
+        }
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "ws://{}:{}/".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='fake-juju-api', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self.env.lock:
+            for watcher_id in list(self.env.watchers):
+                self.env.stop_watcher(watcher_id)
+
+    def dispatch(self, socket, msg):
+        """ Answers one request, on its own thread when it may block """
+        self.requests += 1
+        if (msg.get('Type'), msg.get('Request')) == ('AllWatcher', 'Next'):
+            threading.Thread(target=self._respond, args=(socket, msg),
+                             daemon=True).start()
+        else:
+            self._respond(socket, msg)
+
+    def _respond(self, socket, msg):
+        frame = dict(RequestId=msg.get('RequestId'))
+        request = msg.get('Request')
+        try:
+            handler = self.handlers.get((msg.get('Type'), request))
+            if handler is None:
+                raise FakeJujuError("unknown request {}.{}".format(
+                    msg.get('Type'), request))
+            if request in self.errors:
+                raise FakeJujuError(self.errors[request])
+            if self.error_rate and request != 'Login' and \
+               self.random.random() < self.error_rate:
+                raise FakeJujuError("injected error")
+            params = dict(msg.get('Params') or {})
+            if 'Id' in msg:
+                params['Id'] = msg['Id']
+            frame['Response'] = handler(params)
+        except FakeJujuError as e:
+            frame['Error'] = str(e)
+            frame['ErrorCode'] = ''
+        except Exception as e:
+            log.exception("fake juju api failed on {}".format(msg))
+            frame['Error'] = str(e)
+            frame['ErrorCode'] = ''
+
+        if self.latency:
+            timer = threading.Timer(self.latency, socket.send_frame, [frame])
+            timer.daemon = True
+            timer.start()
+        else:
+            socket.send_frame(frame)
+
+    # request handlers, each takes the request's Params
+    def login(self, params):
+        return dict(Facades=self.facades, Servers=[])
+
+    def environment_info(self, params):
+        return dict(Name='fake', ProviderType='fake',
+                    DefaultSeries=self.env.series, UUID='fake-uuid')
+
+    def charm_info(self, params):
+        return dict(URL=params.get('CharmURL'), Meta={}, Config={})
+
+    def service_get(self, params):
+        svc = self.env.services.get(params.get('ServiceName'))
+        if svc is None:
+            raise FakeJujuError("service not found")
+        return dict(Service=svc['Name'], Charm=svc['CharmURL'],
+                    Config={}, Constraints={})
+
+    def service_deploy(self, params):
+        self.env.deploy(params['ServiceName'], params['CharmUrl'],
+                        params.get('NumUnits', 1),
+                        params.get('ToMachineSpec', ''))
+        return {}
+
+    def add_service_units(self, params):
+        units = self.env.add_units(params['ServiceName'],
+                                   params.get('NumUnits', 1),
+                                   params.get('ToMachineSpec', ''))
+        return dict(Units=units)
+
+    def add_machines(self, params):
+        machines = []
+        for mp in params.get('MachineParams') or []:
+            try:
+                mid = self.env.add_machine(mp.get('ParentId', ''),
+                                           mp.get('ContainerType', ''),
+                                           mp.get('Series', ''))
+                machines.append(dict(Machine=mid, Error=None))
+            except FakeJujuError as e:
+                machines.append(dict(Machine='', Error=dict(
+                    Message=str(e), Code='')))
+        return dict(Machines=machines)
+
+    def add_relation(self, params):
+        return dict(Endpoints=self.env.add_relation(*params['Endpoints']))
+
+    def set_annotations(self, params):
+        with self.env.lock:
+            self.env.annotations.setdefault(params['Tag'], {}).update(
+                params.get('Pairs') or {})
+        return {}
+
+    def get_annotations(self, params):
+        with self.env.lock:
+            return dict(Annotations=dict(
+                self.env.annotations.get(params['Tag'], {})))
+
+    def annotations_set(self, params):
+        for a in params.get('Annotations') or []:
+            self.set_annotations(dict(Tag=a['EntityTag'],
+                                      Pairs=a['Annotations']))
+        return dict(Results=[])
+
+    def watch_all(self, params):
+        return dict(AllWatcherId=self.env.watch())
+
+    def allwatcher_next(self, params):
+        return dict(Deltas=self.env.next_deltas(params['Id']))
+
+    def allwatcher_stop(self, params):
+        self.env.stop_watcher(params['Id'])
+        return {}
@@ -0,0 +1,128 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" per request type juju api metrics
+
+Every JujuClient has a RequestMetrics registry at client.metrics:
+
+    client.metrics.add_callback(lambda sample: log.debug(sample))
+    client.metrics.summary()['Client.FullStatus']['latency_max']
+    client.metrics.dump('/tmp/juju-metrics.json')
+"""
+
+import bisect
+import json
+import logging
+import threading
+from collections import namedtuple
+
+log = logging.getLogger('macumba.metrics')
+
+Sample = namedtuple('Sample', ['request_type', 'latency', 'bytes_out',
+                               'bytes_in', 'error', 'timed_out'])
+
+
+def request_type(params):
+    """ Name of a request as used by the metrics, e.g. Client.FullStatus """
+    return "{}.{}".format(params.get('Type'), params.get('Request'))
+
+
+class RequestMetrics:
+
+    """ Collects count, latency histogram, bytes and timeouts per
+    request type. Thread safe, record() is called from the websocket
+    thread.
+    """
+
+    # upper bounds of the latency histogram buckets, in seconds. the
+    # last bucket counts everything slower.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """ callback(sample) is called with a Sample for every request """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def _new_stats(self):
+        return dict(count=0, errors=0, timeouts=0,
+                    bytes_out=0, bytes_in=0,
+                    latency_total=0.0, latency_max=0.0,
+                    histogram=[0] * (len(self.buckets) + 1))
+
+    def record(self, request_type, latency=None, bytes_out=0, bytes_in=0,
+               error=False, timed_out=False):
+        """ Records one finished request.
+
+        :param str request_type: e.g. Client.FullStatus
+        :param float latency: seconds until the response arrived, None
+                              if it never did
+        """
+        sample = Sample(request_type, latency, bytes_out, bytes_in,
+                        error, timed_out)
+        with self.lock:
+            stats = self.stats.get(request_type)
+            if stats is None:
+                stats = self.stats[request_type] = self._new_stats()
+            stats['count'] += 1
+            stats['bytes_out'] += bytes_out
+            stats['bytes_in'] += bytes_in
+            if error:
+                stats['errors'] += 1
+            if timed_out:
+                stats['timeouts'] += 1
+            if latency is not None:
+                stats['latency_total'] += latency
+                stats['latency_max'] = max(stats['latency_max'], latency)
+                stats['histogram'][bisect.bisect_left(self.buckets,
+                                                      latency)] += 1
+        for callback in list(self.callbacks):
+            try:
+                callback(sample)
+            except Exception:
+                log.exception("metrics callback {} failed".format(callback))
+
+    def summary(self):
+        """ Returns a copy of the stats, keyed by request type """
+        with self.lock:
+            summary = {}
+            for name, stats in self.stats.items():
+                stats = dict(stats, histogram=list(stats['histogram']))
+                answered = sum(stats['histogram'])
+                stats['latency_mean'] = (stats['latency_total'] / answered
+                                         if answered else None)
+                summary[name] = stats
+            return summary
+
+    def dump(self, filename):
+        """ Writes summary() and the bucket bounds as json """
+        summary = self.summary()
+        if not summary:
+            return
+        try:
+            with open(filename, 'w') as f:
+                json.dump(dict(buckets=list(self.buckets),
+                               requests=summary),
+                          f, indent=2, sort_keys=True)
+        except OSError:
+            log.exception("Could not write juju api metrics "
+                          "to {}".format(filename))
@@ -0,0 +1,288 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" recording and replaying juju api traffic
+
+RecordingJujuClient is a JujuClient that writes every request and its
+response, with the time it arrived, to a gzipped json lines file. It
+records on the websocket, so call(), call_many(), call_raw() and
+send()/receive() are all covered:
+
+    client = RecordingJujuClient('juju-api.rec.gz', url=url, password=pw)
+
+ReplayJujuClient plays such a file back in place of a JujuClient,
+optionally faster than it was recorded, without any juju around:
+
+    client = ReplayJujuClient('juju-api.rec.gz', speed=50)
+    juju_state = WatchingJujuState(client)
+
+FullStatus is answered with the latest recorded status for the replay
+time. AllWatcher.Next returns the recorded deltas in order, each once
+its time has come. Other requests get their recorded responses in
+order, or an empty response if none were recorded.
+"""
+
+from collections import defaultdict
+import gzip
+import itertools
+import json
+import logging
+import threading
+import time
+
+import macumba
+from macumba import (ConnectionClosedError, JujuClient, JujuWS, MacumbaError,
+                     ServerError, json_loads)
+from macumba.metrics import request_type
+
+log = logging.getLogger('macumba.recording')
+
+RECORDING_FORMAT = 1
+
+
+class _RecordingJujuWS(JujuWS):
+
+    """ JujuWS handing every response and its request to recorder """
+
+    def __init__(self, *args, recorder=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+
+    def _received_response(self, msg_req_id, msg, size):
+        # the request is only forgotten once its response was collected
+        with self.msglock:
+            params = self.requests.get(msg_req_id)
+        if params is not None:
+            try:
+                # raw responses are the only ones still undecoded
+                decoded = json_loads(msg) if isinstance(msg, bytes) else msg
+            except ValueError:
+                log.exception("could not record juju api response")
+            else:
+                self.recorder(params, decoded)
+        super()._received_response(msg_req_id, msg, size)
+
+
+class RecordingJujuClient(JujuClient):
+
+    """ JujuClient that records its requests to filename
+
+    Each line after the header is [seconds since start, request type,
+    params, response, error], error being None or [class name,
+    message, error frame]. Logins are not recorded. Neither are
+    requests that got no response, e.g. timed out ones.
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        self.recording = None
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.started = time.time()
+        self.record_lock = threading.Lock()
+        self.recording = gzip.open(filename, 'wt')
+        self._write(dict(format=RECORDING_FORMAT, started=self.started,
+                         url=self.url))
+
+    def _connection(self, start_reqid=1):
+        return _RecordingJujuWS(self.url,
+                                self.password,
+                                start_reqid=start_reqid,
+                                stats=self.response_stats,
+                                decoder=self.decoder,
+                                metrics=self.metrics,
+                                recorder=self._record)
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.record_lock:
+            if self.recording is None:
+                return
+            self.recording.write(line + "\n")
+
+    def _record(self, params, msg):
+        """ Writes the response msg to the request params """
+        rtype = request_type(params)
+        if rtype == 'Admin.Login':
+            # holds the password
+            return
+        recorded = {k: v for k, v in params.items() if k != 'RequestId'}
+        t = time.time() - self.started
+        if 'Error' in msg:
+            self._write([t, rtype, recorded, None,
+                         [ServerError.__name__, msg['Error'], msg]])
+        else:
+            self._write([t, rtype, recorded, msg.get('Response'), None])
+
+    def flush(self):
+        with self.record_lock:
+            if self.recording is not None:
+                self.recording.flush()
+
+    def close(self):
+        super().close()
+        with self.record_lock:
+            if self.recording is not None:
+                self.recording.close()
+                self.recording = None
+
+
+def load_recording(filename):
+    """ Returns the header and the entries of a recording """
+    with gzip.open(filename, 'rt') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != RECORDING_FORMAT:
+            raise ValueError("{} is not a juju api recording in format "
+                             "{}".format(filename, RECORDING_FORMAT))
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # cut short when the recording process was killed
+                log.warning("ignoring truncated entry in "
+                            "{}".format(filename))
+                break
+    return header, entries
+
+
+class ReplayJujuClient(JujuClient):
+
+    """ Plays a recording back as a JujuClient
+
+    :param float speed: how much faster than recorded time passes
+    """
+
+    def __init__(self, filename, speed=1):
+        self.header, entries = load_recording(filename)
+        super().__init__(url=self.header.get('url', 'wss://localhost:17070'),
+                         auto_reconnect=False)
+        self.speed = speed
+        self.started = None
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        # FullStatus by params, the others in order per request type
+        self.statuses = defaultdict(list)
+        self.queues = defaultdict(list)
+        self.cursors = defaultdict(int)
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        for t, rtype, params, response, error in entries:
+            entry = (t, response, error)
+            if rtype == 'Client.FullStatus':
+                self.statuses[self._status_key(params)].append(entry)
+            else:
+                self.queues[rtype].append(entry)
+
+    def _status_key(self, params):
+        return json.dumps(params.get('Params'), sort_keys=True)
+
+    def elapsed(self):
+        """ Recorded seconds replayed so far """
+        if self.started is None:
+            return 0
+        return (time.time() - self.started) * self.speed
+
+    def login(self):
+        if self.started is None:
+            self.started = time.time()
+        self.closed.clear()
+
+    def close(self):
+        self.closed.set()
+
+    def reconnect(self):
+        self.login()
+
+    def _result(self, entry):
+        t, response, error = entry
+        if error is None:
+            return response
+        name, message, frame = error
+        if frame is not None:
+            raise ServerError(frame.get('Error', message), frame)
+        cls = getattr(macumba, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, MacumbaError)):
+            cls = MacumbaError
+        raise cls(message)
+
+    def _status(self, params):
+        entries = self.statuses.get(self._status_key(params))
+        if not entries:
+            # no status recorded with these params, use any
+            entries = max(self.statuses.values(), key=len, default=[])
+        if not entries:
+            return {}
+        now = self.elapsed()
+        current = entries[0]
+        for entry in entries:
+            if entry[0] > now:
+                break
+            current = entry
+        return self._result(current)
+
+    def _next(self, rtype, wait):
+        with self.lock:
+            entries = self.queues.get(rtype)
+            if not entries:
+                return {}
+            n = self.cursors[rtype]
+            if n < len(entries):
+                self.cursors[rtype] += 1
+            elif not wait:
+                n = len(entries) - 1
+            else:
+                n = None
+        if n is None:
+            # the recording is over, like a watcher with nothing new
+            self.closed.wait()
+            raise ConnectionClosedError("end of recording")
+        entry = entries[n]
+        if wait:
+            delay = (entry[0] - self.elapsed()) / self.speed
+            if delay > 0 and self.closed.wait(delay):
+                raise ConnectionClosedError("replay closed")
+        return self._result(entry)
+
+    def call(self, params, timeout=None):
+        rtype = request_type(params)
+        start = time.time()
+        error = True
+        try:
+            if rtype == 'Client.FullStatus':
+                rv = self._status(params)
+            else:
+                rv = self._next(rtype, wait=rtype == 'AllWatcher.Next')
+            error = False
+            return rv
+        finally:
+            self.metrics.record(rtype, time.time() - start, error=error)
+
+    def call_raw(self, params, timeout=None):
+        return json.dumps(dict(Response=self.call(params,
+                                                  timeout))).encode('utf-8')
+
+    def send(self, params, raw=False):
+        with self.lock:
+            request_id = next(self.request_ids)
+            self.pending[request_id] = (params, raw)
+        return request_id
+
+    def _receive(self, request_id, timeout):
+        with self.lock:
+            params, raw = self.pending.pop(request_id)
+        if raw:
+            return self.call_raw(params, timeout)
+        return self.call(params, timeout)
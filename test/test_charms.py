@@ -21,7 +21,7 @@ import os
 from importlib import import_module
 import pkgutil
 import unittest
-from unittest.mock import ANY, MagicMock, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
 import cloudinstall.utils as utils
 import cloudinstall.charms
@@ -33,6 +33,7 @@ from cloudinstall.charms.glance import CharmGlance
 from cloudinstall.charms.swift import CharmSwift
 from cloudinstall.charms.mysql import CharmMysql
 from cloudinstall.charms.ntp import CharmNtp
+from macumba import RequestTimeout
 
 log = logging.getLogger('cloudinstall.test_charms')
 
@@ -150,7 +151,7 @@ class TestCharmRelations(unittest.TestCase):
         """ Verifies watch_relations croaks on failed add_relation """
         juju = self.mock_jujuclient
 
-        juju.add_relation.side_effect = Exception('Failed to add relations')
+        juju.add_relations.side_effect = Exception('Failed to add relations')
 
         charm_q = CharmQueue(
             ui=self.mock_ui,
@@ -160,6 +161,22 @@ class TestCharmRelations(unittest.TestCase):
             deployed_charms=self.deployed_charms)
         self.assertRaises(Exception, charm_q.watch_relations)
 
+    def test_watch_relations_timeout(self):
+        """ Verifies watch_relations raises any failed relation """
+        juju = self.mock_jujuclient
+        juju.add_relations.side_effect = lambda relations, **kw: \
+            [RequestTimeout(1)] * len(relations)
+
+        charm_q = CharmQueue(
+            ui=self.mock_ui,
+            config=self.mock_config,
+            juju=juju,
+            juju_state=self.mock_juju_state,
+            deployed_charms=self.deployed_charms)
+        self.assertRaises(RequestTimeout, charm_q.watch_relations)
+        self.assertNotIn(call('relations_complete', True),
+                         self.mock_config.setopt.mock_calls)
+
 
 class TestCharmQueuePostProc(unittest.TestCase):
 
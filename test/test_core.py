@@ -22,6 +22,7 @@ from unittest.mock import MagicMock, patch
 from cloudinstall.config import Config
 from cloudinstall.core import Controller
 from cloudinstall.juju import JujuState
+from cloudinstall.maas import MaasState
 
 log = logging.getLogger('cloudinstall.test_core')
 
@@ -49,12 +50,12 @@ class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
     def test_validate_services_ready(self):
         """ Verifies wait_for_deployed_services_ready
 
-        async.sleep_until should not be called here as all services
+        background.sleep_until should not be called here as all services
         are in a started state.
         """
         self.dc.juju_state.all_agents_started.return_value = True
 
-        with patch('cloudinstall.async.sleep_until') as mock_sleep:
+        with patch('cloudinstall.background.sleep_until') as mock_sleep:
             self.dc.wait_for_deployed_services_ready()
         self.assertEqual(len(mock_sleep.mock_calls), 0)
 
@@ -62,13 +63,120 @@ class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
         """ Verifies wait_for_deployed_services_ready against some of the
         services in started state
 
-        Here we test if async.sleep_until was called twice due to some services
-        being in an installing and allocating state.
+        Here we test if background.sleep_until was called twice due to some
+        services being in an installing and allocating state.
         """
         self.dc.juju_state.all_agents_started.side_effect = [
             False, False, True, True]
 
-        with patch('cloudinstall.async.sleep_until') as mock_sleep:
+        with patch('cloudinstall.background.sleep_until') as mock_sleep:
             self.dc.wait_for_deployed_services_ready()
         print(mock_sleep.mock_calls)
         self.assertEqual(len(mock_sleep.mock_calls), 2)
+
+
+class AddMachinesToJujuCoreTestCase(unittest.TestCase):
+
+    """ Tests core.add_machines_to_juju_single """
+
+    def setUp(self):
+        self.conf = Config({}, save_backups=False)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.juju = MagicMock(name='juju')
+        self.dc.juju_state = MagicMock(name='juju_state')
+        self.dc.juju_state.machines.return_value = []
+        self.dc.placement_controller = MagicMock(name='pc')
+
+    def test_failed_machine_others_annotated(self):
+        """ Machines added in a batch with a failure are still annotated
+        """
+        machines = [MagicMock(instance_id='/nodes/{}/'.format(n))
+                    for n in range(3)]
+        self.dc.placement_controller.machines_pending.return_value = machines
+        self.dc.juju.add_machines.return_value = dict(Machines=[
+            dict(Machine='1', Error=None),
+            dict(Machine='', Error=dict(Message='no')),
+            dict(Machine='2', Error=None)])
+
+        self.assertRaises(Exception, self.dc.add_machines_to_juju_single)
+        self.dc.juju.set_annotations_many.assert_called_once_with(
+            [('1', 'machine', {'instance_id': '/nodes/0/'}),
+             ('2', 'machine', {'instance_id': '/nodes/2/'})])
+
+
+class AllMaasMachinesReadyCoreTestCase(unittest.TestCase):
+
+    """ Tests core.all_maas_machines_ready """
+
+    def setUp(self):
+        self.conf = Config({}, save_backups=False)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.placement_controller = MagicMock(name='pc')
+        self.dc.placement_controller.machines_pending.return_value = []
+        self.now = 1000.0
+        self.fetches = 0
+
+    def clock(self):
+        return self.now
+
+    def slow_nodes(self, client):
+        # listing nodes takes longer than a poll's max age
+        self.fetches += 1
+        self.now += 2
+        return [dict(hostname='a', status=4, architecture='amd64/generic',
+                     tag_names=[])]
+
+    def test_one_fetch_per_poll(self):
+        """ A slow node list is fetched once per poll """
+        client = MagicMock(name='maas')
+        type(client).nodes = property(self.slow_nodes)
+        self.dc.maas_state = MaasState(client)
+        self.conf.setopt('constraints', 'arch=amd64')
+        with patch('time.time', self.clock):
+            self.assertTrue(self.dc.all_maas_machines_ready())
+            self.assertEqual(self.fetches, 1)
+            self.now += 3
+            self.dc.all_maas_machines_ready()
+            self.assertEqual(self.fetches, 2)
+
+
+class BeginDeploymentCoreTestCase(unittest.TestCase):
+
+    """ Tests core.begin_deployment waiting for a live juju status """
+
+    def setUp(self):
+        self.conf = Config({}, save_backups=False)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.juju_state = JujuState(juju=MagicMock())
+        self.dc.live_status_timeout = 0
+
+    def test_no_live_status_raises(self):
+        """ Gives up with the last refresh error instead of hanging """
+        self.dc.juju_state.last_error = 'connection refused'
+        with self.assertRaisesRegex(Exception, 'connection refused'):
+            self.dc.begin_deployment()
+
+
+class AuthenticateJujuCoreTestCase(unittest.TestCase):
+
+    """ Tests core.authenticate_juju """
+
+    def setUp(self):
+        self.conf = MagicMock(name='config')
+        self.conf.juju_env = {'state-servers': []}
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+
+    @patch('cloudinstall.core.WatchingJujuState')
+    @patch('cloudinstall.core.atexit')
+    @patch('cloudinstall.core.ReplayJujuClient')
+    def test_replay_keeps_metrics(self, mock_replay, mock_atexit, mock_js):
+        """ Replaying a recording doesn't overwrite the saved metrics """
+        env = {'JUJU_API_REPLAY': 'rec.json'}
+        with patch('cloudinstall.core.getenv', env.get):
+            self.dc.authenticate_juju()
+        registered = [c[1][0] for c in mock_atexit.register.mock_calls]
+        self.assertNotIn(mock_replay.return_value.metrics.dump, registered)
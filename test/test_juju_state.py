@@ -15,13 +15,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, PropertyMock
+from unittest.mock import MagicMock, PropertyMock, patch
 
 from cloudinstall.config import Config
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import JujuState, PollInterval, WatchingJujuState
+from cloudinstall.machine import Machine
 from cloudinstall.service import Service
+from macumba import ConnectionClosedError, MacumbaError
+from macumba.metrics import RequestMetrics
 
 log = logging.getLogger('cloudinstall.test_core')
 
@@ -58,20 +66,486 @@ class JujuStateTestCase(unittest.TestCase):
     def test_services_ready(self):
         """ Verifies all ready services  """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_ready)
-        type(juju_state).services = services
-
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
 
         self.assertEqual(len(not_ready), 0)
 
     def test_some_services_ready(self):
         """ Verifies some ready services == not_ready list """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_some_ready)
-        type(juju_state).services = services
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
-        self.assertEqual(len(not_ready), 2)
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_some_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
+            self.assertEqual(len(not_ready), 2)
+
+        juju_state.juju.status.return_value = {
+            'Machines': {},
+            'Services': {svc.service_name: svc.service
+                         for svc in self.services_some_ready}}
+        self.assertFalse(juju_state.all_agents_started())
+        self.assertEqual(sorted(juju_state.agent_summary().not_ready),
+                         ['fake3', 'fake4'])
+
+    def test_agent_summary(self):
+        """ Counts are kept per published status, unchanged services
+        and machines are not walked again
+        """
+        status = {'Machines': {'0': {'AgentState': 'started'},
+                               '1': {'AgentState': 'started'},
+                               '2': {'AgentState': 'pending',
+                                     'Life': 'dying'}},
+                  'Services': {
+                      'keystone': {'Units': {
+                          'keystone/0': {'AgentState': 'started'}}},
+                      'glance': {'Units': {
+                          'glance/0': {'AgentState': 'pending'},
+                          'glance/1': {'AgentState': 'started'}}}}}
+        juju_state = JujuState(juju=MagicMock())
+        juju_state.juju.status.return_value = status
+        summary = juju_state.agent_summary()
+        self.assertEqual(summary.unit_states,
+                         {'started': 2, 'pending': 1})
+        self.assertEqual(summary.not_ready,
+                         {'glance/0': ('glance', 'pending')})
+        self.assertEqual(juju_state.machines_summary(),
+                         {'started': 1, 'pending dying': 1})
+        self.assertEqual([m.machine_id for m in
+                          juju_state.machines_allocated()], ['1', '2'])
+        juju_state.valid_states = ['started']
+        self.assertEqual([m.machine_id for m in
+                          juju_state.machines_allocated()], ['1'])
         self.assertFalse(juju_state.all_agents_started())
+
+        new_status = dict(status, Services=dict(status['Services']))
+        new_status['Services']['glance'] = {'Units': {
+            'glance/0': {'AgentState': 'started'},
+            'glance/1': {'AgentState': 'started'}}}
+        juju_state.juju.status.return_value = new_status
+        juju_state.invalidate_status_cache()
+        new_summary = juju_state.agent_summary()
+        self.assertIsNot(new_summary, summary)
+        self.assertIs(new_summary._services['keystone'],
+                      summary._services['keystone'])
+        self.assertEqual(new_summary.unit_states, {'started': 3})
+        self.assertTrue(juju_state.all_agents_started())
+
+    def test_lookups_indexed_per_status(self):
+        """ Lookups reuse objects until the status document changes """
+        status = {'Machines': {'0': {}, '1': {'Containers': {
+            '1/lxc/0': {'InstanceId': 'c'}}}},
+                  'Services': {'keystone': {'Units': {}}}}
+        juju_state = JujuState(juju=MagicMock())
+        juju_state.juju.status.return_value = status
+
+        m = juju_state.machine('1')
+        self.assertIs(juju_state.machine('1'), m)
+        self.assertEqual(juju_state.machine('0').machine_id, '-')
+        self.assertEqual(juju_state.machine_or_container('1/lxc/0')
+                         .instance_id, 'c')
+        self.assertIs(juju_state.base_machine('1/lxc/0'), m)
+        svc = juju_state.service('keystone')
+        self.assertIs(juju_state.services[0], svc)
+
+        juju_state.juju.status.return_value = dict(status, Networks={})
+        juju_state.invalidate_status_cache()
+        self.assertIsNot(juju_state.machine('1'), m)
+        self.assertIsNot(juju_state.service('keystone'), svc)
+
+    def test_version_and_diff(self):
+        """ Versions only change with the status, diff() reports what
+        changed
+        """
+        status = {'Machines': {'1': {'AgentState': 'pending'}},
+                  'Services': {'keystone': {'Units': {
+                      'keystone/0': {'AgentState': 'pending'}}}}}
+        juju_state = JujuState(juju=MagicMock())
+        juju_state.juju.status.return_value = status
+        juju_state.status()
+        v1 = juju_state.version
+
+        juju_state.juju.status.return_value = copy.deepcopy(status)
+        juju_state.invalidate_status_cache()
+        juju_state.status()
+        self.assertEqual(juju_state.version, v1)
+        self.assertFalse(juju_state.diff(v1))
+
+        new_status = copy.deepcopy(status)
+        new_status['Machines']['2'] = {}
+        new_status['Services']['keystone']['Units']['keystone/0'] = {
+            'AgentState': 'started'}
+        new_status['Services']['glance'] = {'Units': {}}
+        del new_status['Machines']['1']
+        juju_state.juju.status.return_value = new_status
+        juju_state.invalidate_status_cache()
+
+        diff = juju_state.diff(v1)
+        self.assertEqual(diff.version, v1 + 1)
+        self.assertEqual(diff.machines, ({'2'}, {'1'}, set()))
+        self.assertEqual(diff.services, ({'glance'}, set(), set()))
+        self.assertEqual(diff.units, (set(), set(), {'keystone/0'}))
+        self.assertEqual(juju_state.diff(None).units.added, {'keystone/0'})
+
+        # over several versions, only the net changes are reported
+        v2 = juju_state.version
+        for machines in ({'2': {}, '3': {}}, {'3': {}}, {'3': {'x': 1}}):
+            juju_state.juju.status.return_value = dict(new_status,
+                                                       Machines=machines)
+            juju_state.invalidate_status_cache()
+            juju_state.status()
+        diff = juju_state.diff(v2)
+        self.assertEqual(diff.version, v2 + 3)
+        self.assertEqual(diff.machines, ({'3'}, {'2'}, set()))
+        self.assertFalse(any(diff.units))
+        self.assertEqual(juju_state.diff(v1).machines,
+                         ({'3'}, {'1'}, set()))
+        self.assertEqual(len(juju_state._diffs), juju_state.version)
+        juju_state.max_diffs = 1
+        juju_state.juju.status.return_value = new_status
+        juju_state.invalidate_status_cache()
+        self.assertEqual(juju_state.diff(v2).machines.added, {'2'})
+
+    def test_background_refresher(self):
+        """ status() serves the last document while the refresher
+        fetches the next one, failures are kept in freshness()
+        """
+        status = {'Machines': {'1': {}}, 'Services': {}}
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_status(patterns=None):
+            fetching.set()
+            release.wait(5)
+            return dict(status, Machines={})
+
+        juju_state = JujuState(juju=MagicMock())
+        juju_state.juju.status.return_value = status
+        juju_state.start_refresher(interval=60)
+        self.addCleanup(juju_state.stop_refresher)
+        self.assertIs(juju_state.status(), status)
+        self.assertIsNone(juju_state.freshness().last_error)
+
+        juju_state.juju.status.side_effect = slow_status
+        juju_state.invalidate_status_cache()
+        self.assertTrue(fetching.wait(5))
+        # the refresh is in flight, readers don't wait for it
+        self.assertIs(juju_state.status(), status)
+        release.set()
+        for _ in range(100):
+            if juju_state.status() is not status:
+                break
+            time.sleep(0.01)
+        self.assertEqual(juju_state.status()['Machines'], {})
+
+        juju_state.juju.status.side_effect = MacumbaError('gone')
+        fetching.clear()
+        juju_state.invalidate_status_cache()
+        for _ in range(100):
+            if juju_state.freshness().last_error:
+                break
+            time.sleep(0.01)
+        freshness = juju_state.freshness()
+        self.assertEqual(freshness.last_error, 'gone')
+        self.assertFalse(freshness.live)
+        self.assertEqual(juju_state.status()['Machines'], {})
+
+    def test_refresher_restart(self):
+        """ A stopped refresher still refreshing doesn't keep running
+        next to its replacement
+        """
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_status(patterns=None):
+            fetching.set()
+            release.wait(5)
+            return {'Machines': {}, 'Services': {}}
+        juju_state = JujuState(juju=MagicMock())
+        juju_state.juju.status.return_value = {'Machines': {},
+                                               'Services': {}}
+        juju_state.start_refresher(interval=60)
+        old = juju_state._refresher
+        juju_state.juju.status.side_effect = slow_status
+        juju_state.invalidate_status_cache()
+        self.assertTrue(fetching.wait(5))
+
+        juju_state.stop_refresher()
+        juju_state.start_refresher(interval=60)
+        self.addCleanup(juju_state.stop_refresher)
+        new = juju_state._refresher
+        self.assertIsNot(new, old)
+        release.set()
+        old.join(5)
+        self.assertFalse(old.is_alive())
+        self.assertTrue(new.is_alive())
+
+    def test_adaptive_poll_interval(self):
+        """ Polls fast while agents are pending, backs off once they
+        started and right after a deploy polls fast again
+        """
+        pending = {'Machines': {'1': {'AgentState': 'pending'}},
+                   'Services': {}}
+        started = {'Machines': {'1': {'AgentState': 'started'}},
+                   'Services': {'mysql': {'Units': {
+                       'mysql/0': {'AgentState': 'started'}}}}}
+        metrics = RequestMetrics()
+        juju_state = JujuState(juju=MagicMock(metrics=metrics))
+        juju_state.poll = PollInterval(fastest=1, slowest=8)
+        juju_state.juju.status.return_value = pending
+        juju_state.refresh()
+        self.assertEqual(juju_state.refresh_interval, 1)
+
+        juju_state.juju.status.return_value = started
+        intervals = []
+        for _ in range(5):
+            juju_state.refresh()
+            intervals.append(juju_state.refresh_interval)
+        self.assertEqual(intervals, [2, 4, 8, 8, 8])
+
+        # within the interval the cached status is used
+        juju_state.status()
+        self.assertEqual(juju_state.juju.status.call_count, 6)
+
+        metrics.record('Client.FullStatus', 0.1)
+        metrics.record('Client.ServiceDeploy', 0.1, error=True)
+        juju_state.status()
+        self.assertEqual(juju_state.juju.status.call_count, 6)
+
+        metrics.record('Client.ServiceDeploy', 0.1)
+        self.assertEqual(juju_state.refresh_interval, 1)
+        juju_state.status()
+        self.assertEqual(juju_state.juju.status.call_count, 7)
+
+    def test_filtered_status(self):
+        """ Filtered lookups fetch only their patterns and are cached
+        per set of patterns, unless the full status is fresh
+        """
+        juju_state = JujuState(juju=MagicMock())
+        keystone = {'Machines': {'1': {}}, 'Services': {
+            'keystone': {'Units': {'keystone/0': {'Machine': '1'}}}}}
+        juju_state.juju.status.return_value = keystone
+        svc = juju_state.service('keystone', filtered=True)
+        self.assertEqual(svc.units[0].unit_name, 'keystone/0')
+        juju_state.juju.status.assert_called_once_with(['keystone'])
+        self.assertIs(juju_state.service('keystone', filtered=True), svc)
+        self.assertEqual(juju_state.status(patterns=['keystone']), keystone)
+        self.assertEqual(juju_state.juju.status.call_count, 1)
+
+        juju_state.juju.status.return_value = {'Machines': {},
+                                               'Services': {}}
+        self.assertEqual(juju_state.service('glance', filtered=True).units,
+                         [])
+        juju_state.juju.status.assert_called_with(['glance'])
+
+        juju_state.invalidate_status_cache()
+        juju_state.service('keystone', filtered=True)
+        self.assertEqual(juju_state.juju.status.call_count, 3)
+
+        full = dict(keystone, Networks={})
+        juju_state.juju.status.return_value = full
+        juju_state.refresh()
+        self.assertIs(juju_state.status(patterns=['keystone']), full)
+        juju_state.service('keystone', filtered=True)
+        self.assertEqual(juju_state.juju.status.call_count, 4)
+
+    def test_snapshot(self):
+        """ A saved status is served stale without fetching until a
+        live one replaces it
+        """
+        status = {'Machines': {'1': {'AgentState': 'started'}},
+                  'Services': {'keystone': {'Units': {}}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'juju-status.json.gz')
+            juju_state = JujuState(juju=MagicMock(),
+                                   snapshot_filename=filename,
+                                   environment='env-1')
+            self.assertFalse(juju_state.load_snapshot())
+            juju_state.juju.status.return_value = status
+            juju_state.status()
+            self.assertTrue(os.path.exists(filename))
+
+            other = JujuState(juju=MagicMock(), snapshot_filename=filename,
+                              environment='env-2')
+            self.assertFalse(other.load_snapshot())
+
+            juju_state = JujuState(juju=MagicMock(),
+                                   snapshot_filename=filename,
+                                   environment='env-1')
+            self.assertTrue(juju_state.load_snapshot())
+            self.assertFalse(juju_state.wait_live(0))
+            self.assertEqual(juju_state.status(), status)
+            self.assertEqual(juju_state.service('keystone',
+                                                filtered=True).units, [])
+            self.assertFalse(juju_state.juju.status.called)
+            freshness = juju_state.freshness()
+            self.assertTrue(freshness.stale)
+            self.assertLess(freshness.age, 60)
+            # a stale status is not written back
+            os.remove(filename)
+            juju_state.save_snapshot()
+            self.assertFalse(os.path.exists(filename))
+
+            juju_state.juju.status.return_value = {'Machines': {},
+                                                   'Services': {}}
+            juju_state.refresh()
+            self.assertTrue(juju_state.wait_live(0))
+            self.assertFalse(juju_state.freshness().stale)
+            self.assertEqual(juju_state.machines(), [])
+
+            with open(filename, 'wb') as f:
+                f.write(b'not gzip')
+            self.assertFalse(juju_state.load_snapshot())
+
+
+class StatusModelTestCase(unittest.TestCase):
+
+    """ Machine and Service wrappers """
+
+    def test_machine_hardware(self):
+        """ Hardware is parsed lazily and reads are repeatable """
+        m = Machine('1', {'Hardware': 'arch=amd64 cpu-cores=4 '
+                                      'mem=2048M root-disk=8192M'})
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.cpu_cores, '4')
+        self.assertEqual(m.mem, '2048M')
+        self.assertEqual(m.storage, '8.0G')
+        self.assertEqual(m.storage, '8.0G')
+        self.assertEqual(Machine('2', {}).storage, 'N/A')
+
+    def test_memoized(self):
+        """ units, relations and containers are built once """
+        svc = Service('keystone', {'Units': {'keystone/0': {}},
+                                   'Relations': {'identity': ['glance']}})
+        self.assertIs(svc.units, svc.units)
+        self.assertIs(svc.relations, svc.relations)
+        self.assertEqual(svc.relation('identity').charms, ['glance'])
+        m = Machine('1', {'Containers': {'1/lxc/0': {}}})
+        self.assertIs(m.containers[0], m.container('1/lxc/0'))
+
+
+class WatchingJujuStateTestCase(unittest.TestCase):
+
+    """ Tests building status from AllWatcher deltas
+    """
+
+    def setUp(self):
+        self.juju = MagicMock(name='juju')
+        self.juju.get_watcher.return_value = {'AllWatcherId': '1'}
+        self.initial = {'Deltas': [
+            ['machine', 'change',
+             {'Id': '1', 'InstanceId': 'i-1', 'Status': 'started',
+              'HardwareCharacteristics': {'Arch': 'amd64', 'CpuCores': 4,
+                                          'Mem': 8192, 'RootDisk': 20480},
+              'Addresses': [{'Value': '10.0.0.1', 'Scope': 'public'}]}],
+            ['machine', 'change',
+             {'Id': '1/lxc/0', 'Status': 'pending'}],
+            ['service', 'change',
+             {'Name': 'keystone', 'CharmURL': 'cs:trusty/keystone-1'}],
+            ['service', 'change',
+             {'Name': 'mysql', 'CharmURL': 'cs:trusty/mysql-1'}],
+            ['unit', 'change',
+             {'Name': 'keystone/0', 'Service': 'keystone',
+              'MachineId': '1/lxc/0', 'Status': 'pending'}],
+            ['relation', 'change',
+             {'Key': 'keystone:shared-db mysql:shared-db',
+              'Endpoints': [
+                  {'ServiceName': 'keystone',
+                   'Relation': {'Name': 'shared-db'}},
+                  {'ServiceName': 'mysql',
+                   'Relation': {'Name': 'shared-db'}}]}],
+        ]}
+        self.js = WatchingJujuState(self.juju)
+
+    def start(self, *later):
+        """ start with initial deltas, then block the watcher thread """
+        block = MagicMock(side_effect=lambda *args: self.js._stop.wait())
+        self.juju.get_watched_tasks.side_effect = [self.initial] + \
+            list(later)
+        self.js._watch = block
+        self.js.start()
+
+    def test_initial_model(self):
+        self.start()
+        self.assertTrue(self.js.watching)
+        m = self.js.machine('1')
+        self.assertEqual(m.instance_id, 'i-1')
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.cpu_cores, '4')
+        self.assertEqual(m.dns_name, '10.0.0.1')
+        self.assertEqual(self.js.machine_or_container('1/lxc/0').agent_state,
+                         'pending')
+        unit = self.js.service('keystone').unit('keystone/0')
+        self.assertEqual(unit.machine_id, '1/lxc/0')
+        self.assertTrue(self.js.service('mysql').relation(
+            'shared-db').is_relation('keystone'))
+        self.assertFalse(self.js.all_agents_started())
+        self.juju.status.assert_not_called()
+
+    def test_change_and_remove(self):
+        self.start()
+        before = self.js.status()
+        self.js._apply_deltas([
+            ['unit', 'change',
+             {'Name': 'keystone/0', 'Service': 'keystone',
+              'MachineId': '1/lxc/0', 'Status': 'started'}],
+            ['machine', 'remove', {'Id': '1/lxc/0'}],
+            ['service', 'remove', {'Name': 'mysql'}]])
+        self.assertTrue(self.js.all_agents_started())
+        self.assertEqual(list(self.js.machine('1').containers), [])
+        self.assertEqual([s.service_name for s in self.js.services],
+                         ['keystone'])
+        # earlier snapshot is untouched
+        self.assertIn('mysql', before['Services'])
+
+    def test_unit_removed_after_its_service(self):
+        self.start()
+        self.js._apply_deltas([
+            ['service', 'remove', {'Name': 'keystone'}],
+            ['unit', 'remove',
+             {'Name': 'keystone/0', 'Service': 'keystone'}]])
+        self.assertEqual([s.service_name for s in self.js.services],
+                         ['mysql'])
+
+    def test_container_removed_after_its_host(self):
+        self.start()
+        self.js._apply_deltas([
+            ['machine', 'remove', {'Id': '1'}],
+            ['machine', 'remove', {'Id': '1/lxc/0'}]])
+        self.assertEqual(self.js.status()['Machines'], {})
+
+    def test_falls_back_to_polling(self):
+        self.start()
+        self.juju.get_watched_tasks.side_effect = MacumbaError('gone')
+        with patch.object(self.js, 'start_refresher') as start_refresher:
+            WatchingJujuState._watch(self.js)
+        self.assertFalse(self.js.watching)
+        start_refresher.assert_called_once_with()
+        self.assertFalse(self.js.freshness().live)
+        self.juju.status.return_value = {'Machines': {}, 'Services': {}}
+        self.assertEqual(self.js.refresh(), {'Machines': {}, 'Services': {}})
+        self.juju.status.assert_called_once_with(None)
+
+    def test_restarts_after_reconnect(self):
+        self.start()
+        self.juju.get_watcher.return_value = {'AllWatcherId': '2'}
+        rebuilt = {'Deltas': [['service', 'change', {'Name': 'glance'}]]}
+
+        replies = [ConnectionClosedError(), rebuilt]
+
+        def next_deltas(watcher_id):
+            if not replies:
+                self.js._stop.set()
+                return {'Deltas': []}
+            rv = replies.pop(0)
+            if isinstance(rv, Exception):
+                raise rv
+            return rv
+        self.juju.get_watched_tasks.side_effect = next_deltas
+        WatchingJujuState._watch(self.js)
+        self.assertTrue(self.js.watching)
+        self.assertEqual(self.js.watcher_id, '2')
+        self.assertEqual([s.service_name for s in self.js.services],
+                         ['glance'])
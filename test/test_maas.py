@@ -18,6 +18,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, PropertyMock
 import json
@@ -160,3 +162,90 @@ class MaasStateTestCase(unittest.TestCase):
         s = MaasState(self.mock_client_oneready)
         ready_machines = s.machines(MaasMachineStatus.READY)
         self.assertEqual(len(ready_machines), 1)
+
+    def test_summary_and_columns(self):
+        nodes = [dict(hostname='juju-bootstrap.maas', status=6),
+                 dict(hostname='a', status=4),
+                 dict(hostname='b', status=10),
+                 dict(hostname='c', status=6)]
+        client = MagicMock()
+        type(client).nodes = PropertyMock(return_value=nodes)
+        s = MaasState(client)
+        self.assertEqual(s.machines_summary(),
+                         {MaasMachineStatus.ALLOCATED: 2,
+                          MaasMachineStatus.READY: 1,
+                          MaasMachineStatus.MAAS_1_7_ALLOCATED: 1})
+        allocated = s.machines(MaasMachineStatus.ALLOCATED)
+        self.assertEqual([m.hostname for m in allocated], ['c'])
+        self.assertIs(s.columns(), s.columns())
+
+    def test_nodes_cache(self):
+        """ Node lists are cached per constraints for ttl seconds """
+        nodes = [dict(hostname='a', status=4, architecture='amd64/generic',
+                      tag_names=['x', 'y']),
+                 dict(hostname='b', status=4, architecture='i386/generic',
+                      tag_names=['x'])]
+        client = MagicMock()
+        listed = PropertyMock(return_value=nodes)
+        type(client).nodes = listed
+        client.nodes_filtered.return_value = nodes[:1]
+        s = MaasState(client, ttl=60)
+
+        tagged = s.machines(constraints='tags=y,x mem=1G')
+        self.assertEqual([m.hostname for m in tagged], ['a'])
+        client.nodes_filtered.assert_called_once_with(arch=None,
+                                                      tags=['x', 'y'])
+        s.machines(constraints='tags=x,y')
+        s.machines(constraints='tags=x,y', max_age=0)
+        self.assertEqual(client.nodes_filtered.call_count, 2)
+
+        s.machines_summary()
+        s.machines()
+        self.assertEqual(listed.call_count, 1)
+        # filtered from the newer unconstrained list
+        amd64 = s.machines(constraints='arch=amd64')
+        self.assertEqual([m.hostname for m in amd64], ['a'])
+        self.assertEqual(client.nodes_filtered.call_count, 2)
+
+        s.invalidate_nodes_cache()
+        s.machines()
+        self.assertEqual(listed.call_count, 2)
+
+    def test_nodes_single_flight(self):
+        """ Concurrent callers share one fetch """
+        fetched = []
+
+        def fetch():
+            fetched.append(1)
+            time.sleep(0.2)
+            return [dict(hostname='a', status=4)]
+        client = MagicMock()
+        type(client).nodes = property(lambda self: fetch())
+        s = MaasState(client)
+        threads = [threading.Thread(target=s.machines) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(fetched), 1)
+
+    def test_machine_lookup(self):
+        """ Lookups use indexes built once per node list """
+        nodes = [dict(hostname='juju-bootstrap.maas', status=6,
+                      resource_uri='/nodes/boot/', system_id='boot')]
+        nodes += [dict(hostname='h{}'.format(n), status=4,
+                       resource_uri='/nodes/n{}/'.format(n),
+                       system_id='n{}'.format(n)) for n in range(500)]
+        client = MagicMock()
+        type(client).nodes = PropertyMock(side_effect=lambda: list(nodes))
+        s = MaasState(client)
+        m = s.machine('/nodes/n42/')
+        self.assertEqual(m.hostname, 'h42')
+        self.assertIs(s.machine_by_system_id('n42'), m)
+        self.assertIs(s.machine_by_hostname('h42'), m)
+        self.assertIn(m, s.machines())
+        self.assertIsNone(s.machine('/nodes/boot/'))
+        self.assertIsNone(s.machine_by_system_id('missing'))
+
+        s.invalidate_nodes_cache()
+        self.assertIsNot(s.machine('/nodes/n42/'), m)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from maasclient import MaasClient
+from maasclient.auth import MaasAuth
+
+
+class FakeMaasHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # one write per response, so keep-alive isn't slowed by nagle
+    wbufsize = -1
+
+    def _reply(self, body, code=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.peers.add(self.client_address)
+        query = parse_qs(urlparse(self.path).query)
+        self.server.signatures.add(query['oauth_nonce'][0])
+        path = urlparse(self.path).path
+        self.server.gets.append((path, {k: v for k, v in query.items()
+                                        if not k.startswith('oauth_')}))
+        if path.endswith('/tags/'):
+            self._reply([dict(name='node-1')])
+            return
+        if '/tags/' in path:
+            tag = path.split('/')[-2]
+            self._reply([n for n in self.server.nodes
+                         if tag in n['tag_names']])
+            return
+        nodes = self.server.nodes
+        for key, field in (('hostname', 'hostname'), ('id', 'system_id')):
+            if key in query:
+                nodes = [n for n in nodes if n[field] in query[key]]
+        if 'zone' in query:
+            nodes = [n for n in nodes if n['zone']['name'] in query['zone']]
+        self._reply(nodes)
+
+    def do_POST(self):
+        self.server.peers.add(self.client_address)
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        path = urlparse(self.path).path
+        self.server.posts.append((path, form))
+        nodes = set(form.get('nodes', [])) | {path.split('/')[-2]}
+        if nodes & self.server.refused:
+            self._reply({}, code=409)
+            return
+        self._reply({})
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMaasServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class MaasClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeMaasServer(('127.0.0.1', 0), FakeMaasHandler)
+        self.server.peers = set()
+        self.server.signatures = set()
+        self.server.posts = []
+        self.server.gets = []
+        self.server.nodes = [dict(system_id='node-1', hostname='node-1',
+                                  status=4, tag_names=[])]
+        self.server.refused = set()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        host, port = self.server.server_address
+        api_url = 'http://{}:{}/MAAS/api/1.0'.format(host, port)
+        auth = MaasAuth(api_url=api_url, api_key='consumer:token:secret')
+        self.client = MaasClient(auth, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        """ Requests share one connection and one signer, each request
+        still gets its own nonce
+        """
+        for _ in range(20):
+            self.assertEqual(self.client.nodes[0]['system_id'], 'node-1')
+        self.assertTrue(self.client.tag_machine('tag', 'node-1'))
+        self.assertEqual(len(self.server.peers), 1)
+        self.assertEqual(len(self.server.signatures), 20)
+        signer = self.client._oauth()
+        self.assertIs(self.client._oauth(), signer)
+        self.client.auth.api_key = 'consumer:token:other'
+        self.assertIsNot(self.client._oauth(), signer)
+
+    def test_bulk_release(self):
+        """ Uses the bulk release, per node only if it fails """
+        ids = ['node-{}'.format(n) for n in range(5)]
+        self.assertEqual(self.client.nodes_bulk('release', ids), [True] * 5)
+        self.assertEqual(self.server.posts,
+                         [('/MAAS/api/1.0/nodes/',
+                           dict(op=['release'], nodes=ids))])
+
+        self.server.refused.add('node-3')
+        self.assertEqual(self.client.nodes_bulk('release', ids),
+                         [True, True, True, False, True])
+        self.assertEqual(len(self.server.posts), 1 + 1 + 5)
+
+    def test_bulk_start(self):
+        """ Single node requests fan out, results keep their order """
+        ids = ['node-{}'.format(n) for n in range(10)]
+        self.server.refused.add('node-7')
+        rv = self.client.nodes_bulk('start', ids, concurrency=4,
+                                    user_data='data')
+        self.assertEqual(rv, [sid != 'node-7' for sid in ids])
+        starts = sorted(path for path, form in self.server.posts
+                        if form == dict(op=['start'], user_data=['data']))
+        self.assertEqual(len(starts), 10)
+        self.assertRaises(ValueError, self.client.nodes_bulk, 'explode',
+                          ids)
+
+        self.client.auth.api_url = 'http://127.0.0.1:1/MAAS/api/1.0'
+        rv = self.client.nodes_bulk('stop', ids[:2])
+        self.assertIsInstance(rv[0], requests.ConnectionError)
+
+    def test_bulk_rate(self):
+        start = time.time()
+        self.client.nodes_bulk('commission', ['a', 'b', 'c', 'd'], rate=20)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_tag_in_bulk(self):
+        """ tag_fpi tags all declared nodes in one request, tag_name
+        lists tags once
+        """
+        nodes = [dict(system_id='node-{}'.format(n), status=n % 2,
+                      tag_names=[]) for n in range(6)]
+        self.client.tag_fpi(nodes)
+        tagged = [form for path, form in self.server.posts
+                  if form.get('op') == ['update_nodes']]
+        self.assertEqual(tagged, [dict(op=['update_nodes'],
+                                       add=['node-0', 'node-2', 'node-4'])])
+
+        del self.server.posts[:]
+        self.assertEqual(self.client.tag_name(nodes), [True] * 6)
+        created = [form['name'][0] for path, form in self.server.posts
+                   if form.get('op') == ['new']]
+        self.assertEqual(sorted(created), ['node-0', 'node-2', 'node-3',
+                                           'node-4', 'node-5'])
+
+    def test_nodes_filtered(self):
+        """ Filters MAAS supports are sent along, others applied here """
+        self.server.nodes = [
+            dict(system_id='node-{}'.format(n), hostname='h{}'.format(n),
+                 status=n % 3, zone=dict(name='z{}'.format(n % 2)),
+                 architecture='amd64/generic' if n else 'armhf/generic',
+                 tag_names=['odd'] if n % 2 else ['even', 'small'])
+            for n in range(6)]
+
+        def ids(nodes):
+            return [n['system_id'] for n in nodes]
+
+        rv = self.client.nodes_filtered(zone='z1', hostname=['h1', 'h3'])
+        self.assertEqual(ids(rv), ['node-1', 'node-3'])
+        path, query = self.server.gets[-1]
+        self.assertEqual(query, dict(op=['list'], zone=['z1'],
+                                     hostname=['h1', 'h3']))
+
+        rv = self.client.nodes_filtered(zone='z0', status=0)
+        self.assertEqual(ids(rv), ['node-0'])
+        self.assertNotIn('status', self.server.gets[-1][1])
+
+        rv = self.client.nodes_filtered(tags=['even', 'small'],
+                                        arch='amd64', hostname='h2')
+        self.assertEqual(ids(rv), ['node-2'])
+        self.assertEqual(self.server.gets[-1],
+                         ('/MAAS/api/1.0/tags/even/', dict(op=['nodes'])))
+
+        self.assertEqual(self.client.nodes_filtered(tags=['none']), [])
+        machines = self.client.nodes_V2(state=1)
+        self.assertEqual([m.system_id for m in machines],
+                         ['node-1', 'node-4'])
+        machines = self.client.nodes_V2(hostnames=['h1', 'h2'])
+        self.assertEqual([m.system_id for m in machines],
+                         ['node-1', 'node-2'])
+        self.assertEqual(self.server.gets[-1][1],
+                         dict(op=['list'], hostname=['h1', 'h2']))
@@ -0,0 +1,701 @@
+#!/usr/bin/env python
+#
+# tests macumba/__init__.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from macumba import (JujuClient, JujuWS, CharmNotFoundError,
+                     ConnectionClosedError,
+                     RequestInterruptedError, RequestTimeout, ServerError,
+                     UnknownRequestError)
+from macumba.aio import AsyncJujuClient
+from macumba.charmstore import CharmStoreCache
+from macumba.fakeserver import FakeJujuEnvironment, FakeJujuServer
+from macumba.recording import (RecordingJujuClient, ReplayJujuClient,
+                               load_recording)
+
+
+def fake_frame(msg):
+    m = MagicMock(name='frame')
+    m.data = json.dumps(msg).encode('utf-8')
+    return m
+
+
+class JujuClientReceiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient(url='wss://localhost:17070', password='pw')
+        self.conn = self.client.conn
+        self.send_patcher = patch.object(self.conn, 'send')
+        self.mock_send = self.send_patcher.start()
+
+    def tearDown(self):
+        self.send_patcher.stop()
+
+    def respond_with(self, make_response):
+        """ Answers every sent request from the websocket thread """
+        def respond(data):
+            req = json.loads(data)
+            # juju sends RequestId first
+            resp = OrderedDict(RequestId=req['RequestId'])
+            resp.update(make_response(req))
+            threading.Timer(0.01, self.conn.received_message,
+                            [fake_frame(resp)]).start()
+        self.mock_send.side_effect = respond
+
+    def test_response_wakes_caller(self):
+        """ A received frame completes the matching call """
+        self.respond_with(lambda req: dict(Response={'ok': True}))
+        rv = self.client.call(dict(Type="Client", Request="FullStatus"),
+                              timeout=5)
+        self.assertEqual(rv, {'ok': True})
+        self.assertEqual(self.conn.messages, {})
+
+    def test_timeout(self):
+        """ No response raises RequestTimeout after timeout """
+        self.assertRaises(RequestTimeout, self.client.call,
+                          dict(Type="Client", Request="FullStatus"),
+                          timeout=0.05)
+
+    def test_call_many_preserves_order(self):
+        """ Pipelined responses come back in request order """
+        self.respond_with(lambda req: dict(Response=req['Params']))
+        params = [dict(Type="Client", Request="Echo", Params={'n': n})
+                  for n in range(5)]
+        rv = self.client.call_many(params, timeout=5)
+        self.assertEqual(rv, [{'n': n} for n in range(5)])
+        self.assertEqual(self.mock_send.call_count, 5)
+
+    def test_add_relations_existing_ok(self):
+        """ Existing relations are not errors, others are returned """
+        def make_response(req):
+            a, b = req['Params']['Endpoints']
+            if a == 'exists':
+                return dict(Error='relation already exists')
+            if a == 'broken':
+                return dict(Error='no such service')
+            return dict(Response={})
+        self.respond_with(make_response)
+
+        rv = self.client.add_relations([('exists', 'x'), ('ok', 'x'),
+                                        ('broken', 'x')],
+                                       return_exceptions=True)
+        self.assertNotIsInstance(rv[0], Exception)
+        self.assertEqual(rv[1], {})
+        self.assertIsInstance(rv[2], ServerError)
+
+        self.assertRaises(ServerError, self.client.add_relations,
+                          [('ok', 'x'), ('broken', 'x')])
+
+    def test_call_raw(self):
+        """ Raw calls get the frame back undecoded """
+        self.respond_with(lambda req: dict(Response={'Machines': {}}))
+        rv = self.client.call_raw(dict(Type="Client", Request="FullStatus"),
+                                  timeout=5)
+        self.assertIsInstance(rv, bytes)
+        self.assertEqual(json.loads(rv.decode('utf-8'))['Response'],
+                         {'Machines': {}})
+
+    def test_call_raw_error(self):
+        """ Raw calls still raise ServerError """
+        self.respond_with(lambda req: dict(Error='permission denied'))
+        self.assertRaises(ServerError, self.client.call_raw,
+                          dict(Type="Client", Request="FullStatus"),
+                          timeout=5)
+
+    def test_decoder(self):
+        """ Frames are decoded with the client's decoder """
+        decoder = MagicMock(side_effect=lambda data: json.loads(
+            data.decode('utf-8')))
+        self.client.conn.decode = decoder
+        self.respond_with(lambda req: dict(Response={}))
+        self.client.call(dict(Type="Client", Request="FullStatus"),
+                         timeout=5)
+        self.assertEqual(decoder.call_count, 1)
+
+
+class RequestMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient(url='wss://localhost:17070', password='pw')
+        self.conn = self.client.conn
+        self.send_patcher = patch.object(self.conn, 'send')
+        self.mock_send = self.send_patcher.start()
+
+    def tearDown(self):
+        self.send_patcher.stop()
+
+    def test_call_recorded(self):
+        """ Answered calls are counted with latency and sizes """
+        callback = MagicMock()
+        self.client.metrics.add_callback(callback)
+
+        def respond(data):
+            req = json.loads(data)
+            self.conn.received_message(fake_frame(
+                dict(RequestId=req['RequestId'], Response={})))
+        self.mock_send.side_effect = respond
+        self.client.status()
+
+        stats = self.client.metrics.summary()['Client.FullStatus']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertEqual(sum(stats['histogram']), 1)
+        self.assertGreater(stats['bytes_out'], 0)
+        self.assertGreater(stats['bytes_in'], 0)
+        self.assertEqual(callback.call_count, 1)
+
+    def test_timeout_recorded(self):
+        """ Timed out calls are counted without a latency """
+        self.assertRaises(RequestTimeout, self.client.call,
+                          dict(Type="Client", Request="FullStatus"),
+                          timeout=0.01)
+        stats = self.client.metrics.summary()['Client.FullStatus']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['latency_mean'], None)
+
+    def test_dump(self):
+        """ dump() writes the summary as json """
+        self.client.metrics.record('Client.FullStatus', 0.2, 10, 100)
+        with tempfile.NamedTemporaryFile(mode='r') as f:
+            self.client.metrics.dump(f.name)
+            dumped = json.load(f)
+        self.assertEqual(dumped['requests']['Client.FullStatus']['count'],
+                         1)
+
+
+class JujuWSResponseStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient(url='wss://localhost:17070', password='pw')
+        self.conn = self.client.conn
+        self.send_patcher = patch.object(self.conn, 'send')
+        self.send_patcher.start()
+
+    def tearDown(self):
+        self.send_patcher.stop()
+
+    def test_late_response_dropped(self):
+        """ A response arriving after its caller timed out is not kept """
+        self.assertRaises(RequestTimeout, self.client.call,
+                          dict(Type="Client", Request="FullStatus"),
+                          timeout=0.01)
+        req_id = self.conn.get_current_request_id()
+        self.conn.received_message(fake_frame(dict(RequestId=req_id,
+                                                   Response={})))
+        self.assertEqual(self.conn.messages, {})
+        self.assertEqual(self.conn.events, {})
+        self.assertEqual(self.client.response_stats['late'], 1)
+
+    def test_unknown_response_dropped(self):
+        """ Responses to requests never sent are counted and dropped """
+        self.conn.received_message(fake_frame(dict(RequestId=999,
+                                                   Response={})))
+        self.assertEqual(self.conn.messages, {})
+        self.assertEqual(self.client.response_stats['orphaned'], 1)
+
+    def test_pipelined_responses_kept(self):
+        """ Responses are kept until collected, however many are waiting """
+        def respond(data):
+            req = json.loads(data)
+            self.conn.received_message(fake_frame(
+                dict(RequestId=req['RequestId'],
+                     Response=dict(n=req['Params']['n']))))
+        self.send_patcher.stop()
+        self.send_patcher = patch.object(self.conn, 'send',
+                                         side_effect=respond)
+        self.send_patcher.start()
+        rv = self.client.call_many([dict(Type="Client", Request="Echo",
+                                         Params=dict(n=n))
+                                    for n in range(200)])
+        self.assertEqual([r['n'] for r in rv], list(range(200)))
+        self.assertEqual(self.client.response_stats['orphaned'], 0)
+        self.assertEqual(self.conn.messages, {})
+
+    def test_unclaimed_response_evicted(self):
+        """ A response nobody waits on is dropped after message_ttl """
+        old_id = self.client.send(dict(Type="Client", Request="Echo"))
+        self.conn.received_message(fake_frame(dict(RequestId=old_id,
+                                                   Response={})))
+        self.conn.uncollected[old_id] -= self.conn.message_ttl + 1
+        new_id = self.client.send(dict(Type="Client", Request="Echo"))
+        self.conn.received_message(fake_frame(dict(RequestId=new_id,
+                                                   Response={})))
+        self.assertEqual(list(self.conn.messages), [new_id])
+        self.assertEqual(self.client.response_stats['orphaned'], 1)
+
+    def test_held_response_survives(self):
+        """ A response a caller is waiting on outlives message_ttl """
+        held_id = self.client.send(dict(Type="Client", Request="Echo"))
+        self.conn.hold(held_id)
+        self.conn.received_message(fake_frame(dict(RequestId=held_id,
+                                                   Response=dict(n=1))))
+        self.conn.uncollected[held_id] -= self.conn.message_ttl + 1
+        new_id = self.client.send(dict(Type="Client", Request="Echo"))
+        self.conn.received_message(fake_frame(dict(RequestId=new_id,
+                                                   Response={})))
+        self.assertEqual(self.client.receive(held_id), dict(n=1))
+        self.assertEqual(self.client.response_stats['orphaned'], 0)
+        self.assertNotIn(held_id, self.conn.waiters)
+
+    def test_slow_call_many_keeps_pipelined_responses(self):
+        """ call_many's later responses outlive message_ttl while it
+        waits on an earlier one
+        """
+        def respond(data):
+            req = json.loads(data)
+            self.conn.received_message(fake_frame(
+                dict(RequestId=req['RequestId'], Response={})))
+            self.conn.uncollected[req['RequestId']] -= \
+                self.conn.message_ttl + 1
+        self.send_patcher.stop()
+        self.send_patcher = patch.object(self.conn, 'send',
+                                         side_effect=respond)
+        self.send_patcher.start()
+        rv = self.client.call_many([dict(Type="Client", Request="Echo")] * 3)
+        self.assertEqual(rv, [{}] * 3)
+        self.assertEqual(self.client.response_stats['orphaned'], 0)
+        self.assertEqual(self.conn.waiters, {})
+
+    def test_interrupted_call_many_abandons(self):
+        """ call_many doesn't leave responses behind when interrupted """
+        with patch.object(self.client, '_receive',
+                          side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.client.call_many,
+                              [dict(Type="Client", Request="Echo")] * 3)
+        self.assertEqual(self.conn.messages, {})
+        self.assertEqual(self.conn.events, {})
+
+    def test_interrupted_call_many_abandons_on_its_connection(self):
+        """ Requests are abandoned on the connection they were sent on,
+        even after a reconnect
+        """
+        def interrupt(req_id, timeout):
+            self.client.conn = JujuWS(self.client.url, 'pw')
+            raise KeyboardInterrupt
+        with patch.object(self.client, '_receive', side_effect=interrupt):
+            self.assertRaises(KeyboardInterrupt, self.client.call_many,
+                              [dict(Type="Client", Request="Echo")] * 3)
+        self.assertEqual(self.conn.messages, {})
+        self.assertEqual(self.client.sent, {})
+
+
+class AsyncJujuClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncJujuClient(url='wss://localhost:17070',
+                                      password='pw', loop=self.loop)
+        self.conn = self.client.conn
+        self.send_patcher = patch.object(self.conn, 'send')
+        self.mock_send = self.send_patcher.start()
+
+    def tearDown(self):
+        self.send_patcher.stop()
+        self.loop.close()
+
+    def respond_with(self, make_response):
+        def respond(data):
+            req = json.loads(data)
+            resp = make_response(req)
+            resp['RequestId'] = req['RequestId']
+            self.loop.call_soon(self.conn.received_message,
+                                fake_frame(resp))
+        self.mock_send.side_effect = respond
+
+    def test_status(self):
+        """ Inherited API methods are awaitable """
+        self.respond_with(lambda req: dict(Response={'Machines': {}}))
+        rv = self.loop.run_until_complete(self.client.status())
+        self.assertEqual(rv, {'Machines': {}})
+        self.assertEqual(self.conn.pending, {})
+
+    def test_call_many(self):
+        """ Pipelined coroutine calls keep request order """
+        self.respond_with(lambda req: dict(Response=req['Params']))
+        params = [dict(Type="Client", Request="Echo", Params={'n': n})
+                  for n in range(3)]
+        rv = self.loop.run_until_complete(self.client.call_many(params))
+        self.assertEqual(rv, [{'n': n} for n in range(3)])
+
+    def test_timeout(self):
+        """ No response raises RequestTimeout """
+        self.assertRaises(RequestTimeout, self.loop.run_until_complete,
+                          self.client.call(dict(Type="Client",
+                                                Request="FullStatus"),
+                                           timeout=0.01))
+        self.assertEqual(self.conn.pending, {})
+
+    def test_send_receive(self):
+        """ send() returns at once, receive() waits for the response """
+        self.respond_with(lambda req: dict(Response=req['Params']))
+        req_ids = [self.client.send(dict(Type="Client", Request="Echo",
+                                         Params={'n': n}))
+                   for n in range(2)]
+        rv = self.loop.run_until_complete(self.client.receive(req_ids[1]))
+        self.assertEqual(rv, {'n': 1})
+        rv = self.loop.run_until_complete(self.client.receive(req_ids[0]))
+        self.assertEqual(rv, {'n': 0})
+        self.assertRaises(UnknownRequestError, self.loop.run_until_complete,
+                          self.client.receive(req_ids[0]))
+
+    def test_call_raw(self):
+        """ call_raw() returns the frame undecoded """
+        self.respond_with(lambda req: dict(Response={'Machines': {}}))
+        rv = self.loop.run_until_complete(self.client.call_raw(
+            dict(Type="Client", Request="FullStatus")))
+        self.assertIsInstance(rv, bytes)
+        self.assertEqual(json.loads(rv.decode('utf-8'))['Response'],
+                         {'Machines': {}})
+        self.assertEqual(self.conn.raw_requests, set())
+
+
+class JujuClientReconnectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient(url='wss://localhost:17070', password='pw')
+        self.client.reconnect_backoff = (0, 0)
+        self.client.conn.send = MagicMock(side_effect=self.drop_connection)
+        self.reconnects = 0
+
+    def drop_connection(self, data):
+        conn = self.client.conn
+        conn.client_terminated = conn.server_terminated = True
+        threading.Timer(0.01, conn.closed, [1006]).start()
+
+    def fake_reconnect(self):
+        self.reconnects += 1
+        conn = JujuWS(self.client.url, 'pw')
+
+        def respond(data):
+            req = json.loads(data)
+            resp = dict(RequestId=req['RequestId'],
+                        Response={'got': req['Request']})
+            threading.Timer(0.01, conn.received_message,
+                            [fake_frame(resp)]).start()
+        conn.send = MagicMock(side_effect=respond)
+        self.client.conn = conn
+
+    def test_idempotent_request_replayed(self):
+        """ status() survives a dropped connection """
+        with patch.object(self.client, 'reconnect',
+                          side_effect=self.fake_reconnect):
+            rv = self.client.status()
+        self.assertEqual(rv, {'got': 'FullStatus'})
+        self.assertEqual(self.reconnects, 1)
+
+    def test_non_idempotent_request_reported(self):
+        """ Interrupted deploys are reported, not resent """
+        params = dict(Type="Client", Request="ServiceDeploy", Params={})
+        with patch.object(self.client, 'reconnect',
+                          side_effect=self.fake_reconnect):
+            self.assertRaises(RequestInterruptedError, self.client.call,
+                              params)
+            self.assertEqual(self.reconnects, 1)
+            # the new connection is used for the next call
+            self.assertEqual(self.client.call(params),
+                             {'got': 'ServiceDeploy'})
+
+    def test_pipelined_requests_replayed(self):
+        """ Requests pending on a dropped connection are each replayed,
+        or reported if they are not idempotent
+        """
+        def drop_later(data):
+            conn = self.client.conn
+            threading.Timer(0.05, self.drop_connection, [data]).start()
+            conn.send.side_effect = None
+        self.client.conn.send.side_effect = drop_later
+        batch = [dict(Type="Client", Request="FullStatus")] * 3
+        batch.append(dict(Type="Client", Request="ServiceDeploy"))
+        with patch.object(self.client, 'reconnect',
+                          side_effect=self.fake_reconnect):
+            rv = self.client.call_many(batch, return_exceptions=True)
+        self.assertEqual(rv[:3], [{'got': 'FullStatus'}] * 3)
+        self.assertIsInstance(rv[3], RequestInterruptedError)
+        self.assertEqual(self.reconnects, 1)
+        self.assertEqual(self.client.sent, {})
+
+    def test_backoff_without_lock(self):
+        """ Other threads can take connlock while reconnecting backs off
+        """
+        self.client.max_reconnect_attempts = 2
+        self.client.reconnect_backoff = (0.3, 0.3)
+        locked = []
+
+        def take_lock():
+            with self.client.connlock:
+                locked.append(time.time())
+        with patch.object(self.client, 'reconnect',
+                          side_effect=OSError("refused")):
+            start = time.time()
+            threading.Timer(0.1, take_lock).start()
+            self.assertRaises(ConnectionClosedError, self.client.status)
+        self.assertLess(locked[0] - start, 0.25)
+
+    def test_gives_up(self):
+        """ ConnectionClosedError after max_reconnect_attempts """
+        self.client.max_reconnect_attempts = 3
+        with patch.object(self.client, 'reconnect',
+                          side_effect=OSError("refused")) as m:
+            self.assertRaises(ConnectionClosedError, self.client.status)
+        self.assertEqual(m.call_count, 3)
+
+
+class FakeJujuServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = FakeJujuEnvironment()
+        self.env.populate(services=2, units_per_service=2)
+        self.server = FakeJujuServer(self.env)
+        self.server.start()
+        self.client = JujuClient(url=self.server.url, password='pw')
+        self.client.login()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_status(self):
+        """ FullStatus over a real websocket """
+        status = self.client.status()
+        self.assertEqual(sorted(status['Machines']), ['0', '1', '2', '3',
+                                                      '4'])
+        units = status['Services']['service-1']['Units']
+        self.assertEqual(units['service-1/0']['AgentState'], 'started')
+        self.assertEqual(status['Services']['service-1']['Relations'],
+                         {'db': ['service-0']})
+
+    def test_status_patterns(self):
+        """ FullStatus with patterns only returns what matches """
+        status = self.client.status(['service-1'])
+        self.assertEqual(list(status['Services']), ['service-1'])
+        hosts = {u['Machine'] for u in
+                 status['Services']['service-1']['Units'].values()}
+        self.assertEqual(set(status['Machines']), hosts)
+        status = self.client.status(['service-*/0', '0'])
+        self.assertEqual(sorted(status['Services']),
+                         ['service-0', 'service-1'])
+        self.assertEqual(list(status['Services']['service-0']['Units']),
+                         ['service-0/0'])
+        self.assertIn('0', status['Machines'])
+
+    def test_deploy_and_relate(self):
+        """ Deploys and relations change the environment """
+        self.client.call(self.client._deploy_params(
+            'cs:trusty/new-1', 'new', 2, '', None, 'lxc:1'))
+        rv = self.client.add_relations([('new:db', 'service-0:db'),
+                                        ('service-0:db', 'service-1:db'),
+                                        ('missing', 'new')],
+                                       return_exceptions=True)
+        self.assertNotIsInstance(rv[0], Exception)
+        self.assertNotIsInstance(rv[1], Exception)
+        self.assertIsInstance(rv[2], ServerError)
+        units = self.client.status()['Services']['new']['Units']
+        self.assertEqual(sorted(u['Machine'] for u in units.values()),
+                         ['1/lxc/0', '1/lxc/1'])
+
+    def test_injected_errors(self):
+        """ Requests named in errors always fail """
+        self.server.errors['FullStatus'] = 'boom'
+        self.assertRaises(ServerError, self.client.status)
+
+    def test_allwatcher(self):
+        """ The first deltas hold the whole environment, later ones
+        only changes
+        """
+        watcher_id = self.client.get_watcher()['AllWatcherId']
+        deltas = self.client.get_watched_tasks(watcher_id)['Deltas']
+        self.assertEqual(len([d for d in deltas if d[0] == 'unit']), 4)
+        self.client.add_unit('service-0')
+        deltas = self.client.get_watched_tasks(watcher_id)['Deltas']
+        self.assertEqual([(kind, entity.get('Name', entity.get('Id')))
+                          for kind, change, entity in deltas
+                          if kind == 'unit'][-1],
+                         ('unit', 'service-0/2'))
+
+
+class RecordingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = FakeJujuEnvironment()
+        self.env.populate(services=1, units_per_service=1)
+        self.server = FakeJujuServer(self.env)
+        self.server.start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'juju-api.rec.gz')
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_record_and_replay(self):
+        """ Replays answer like the recorded session did """
+        client = RecordingJujuClient(self.filename, url=self.server.url,
+                                     password='pw')
+        client.login()
+        first = client.status()
+        watcher_id = client.get_watcher()['AllWatcherId']
+        initial = client.get_watched_tasks(watcher_id)
+        client.add_unit('service-0')
+        changed = client.get_watched_tasks(watcher_id)
+        second = client.status()
+        self.server.errors['ServiceGet'] = 'boom'
+        self.assertRaises(ServerError, client.get_config, 'service-0')
+        client.close()
+
+        replay = ReplayJujuClient(self.filename, speed=1000)
+        self.assertEqual(replay.status(), first)
+        replay.login()
+        self.assertEqual(replay.get_watcher()['AllWatcherId'], watcher_id)
+        self.assertEqual(replay.get_watched_tasks(watcher_id), initial)
+        self.assertEqual(replay.get_watched_tasks(watcher_id), changed)
+        time.sleep(0.01)
+        self.assertEqual(replay.status(), second)
+        self.assertEqual(replay.call_many([dict(Type='Client',
+                                                Request='FullStatus')]),
+                         [second])
+        self.assertRaises(ServerError, replay.get_config, 'service-0')
+        self.assertEqual(replay.call(dict(Type='Client',
+                                          Request='EnvironmentInfo')), {})
+
+        # past the end, the watcher waits until the replay is closed
+        threading.Timer(0.05, replay.close).start()
+        self.assertRaises(ConnectionClosedError,
+                          replay.get_watched_tasks, watcher_id)
+
+    def test_record_pipelined(self):
+        """ call_many() and call_raw() traffic is recorded too """
+        client = RecordingJujuClient(self.filename, url=self.server.url,
+                                     password='pw')
+        client.login()
+        batch = [dict(Type='Client', Request='ServiceGet',
+                      Params=dict(ServiceName='service-0'))] * 2
+        got = client.call_many(batch)
+        raw = client.status_raw()
+        client.close()
+
+        header, entries = load_recording(self.filename)
+        self.assertEqual([e[1] for e in entries],
+                         ['Client.ServiceGet'] * 2 +
+                         ['Client.FullStatus'])
+        self.assertNotIn('pw', json.dumps(entries))
+        replay = ReplayJujuClient(self.filename, speed=1000)
+        replay.login()
+        self.assertEqual(replay.call_many(batch), got)
+        self.assertEqual(
+            json.loads(replay.status_raw().decode('utf-8'))['Response'],
+            json.loads(raw.decode('utf-8'))['Response'])
+
+    def test_record_decodes_once(self):
+        """ Recording doesn't decode responses a second time """
+        decoder = MagicMock(side_effect=lambda data: json.loads(
+            data.decode('utf-8')))
+        client = RecordingJujuClient(self.filename, url=self.server.url,
+                                     password='pw', decoder=decoder)
+        with patch('macumba.recording.json_loads') as recorder_loads:
+            client.login()
+            client.status()
+            client.close()
+        # the login and the status
+        self.assertEqual(decoder.call_count, 2)
+        recorder_loads.assert_not_called()
+        header, entries = load_recording(self.filename)
+        self.assertEqual([e[1] for e in entries], ['Client.FullStatus'])
+
+
+class CharmStoreCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache = CharmStoreCache(cache_dir=self.tempdir.name)
+        self.get_patcher = patch.object(self.cache.session, 'get')
+        self.mock_get = self.get_patcher.start()
+        self.mock_get.side_effect = self.respond
+
+    def tearDown(self):
+        self.get_patcher.stop()
+        self.tempdir.cleanup()
+
+    def respond(self, url, headers, timeout):
+        charm = url.split('/')[-1]
+        r = MagicMock(name='response')
+        if charm == 'missing':
+            r.status_code = 404
+            r.json.return_value = dict(type='no_such_charm',
+                                       charm_id=charm)
+        elif headers.get('If-None-Match') == 'etag-' + charm:
+            r.status_code = 304
+        else:
+            r.status_code = 200
+            r.headers = {'ETag': 'etag-' + charm}
+            r.json.return_value = dict(charm=dict(url='cs:trusty/' + charm))
+        return r
+
+    def test_cached(self):
+        """ Fresh entries are served without a request """
+        self.assertEqual(self.cache.query('keystone'),
+                         dict(charm=dict(url='cs:trusty/keystone')))
+        self.cache.query('keystone')
+        self.assertEqual(self.mock_get.call_count, 1)
+
+    def test_persisted(self):
+        """ Entries survive in cache_dir """
+        self.cache.query('keystone')
+        other = CharmStoreCache(cache_dir=self.tempdir.name)
+        with patch.object(other.session, 'get') as mock_get:
+            self.assertEqual(other.query('keystone'),
+                             dict(charm=dict(url='cs:trusty/keystone')))
+        self.assertEqual(mock_get.call_count, 0)
+
+    def test_revalidated(self):
+        """ Stale entries are revalidated with their ETag """
+        self.cache.ttl = 0
+        self.cache.query('keystone')
+        self.assertEqual(self.cache.query('keystone'),
+                         dict(charm=dict(url='cs:trusty/keystone')))
+        headers = self.mock_get.call_args[1]['headers']
+        self.assertEqual(headers, {'If-None-Match': 'etag-keystone'})
+
+    def test_offline(self):
+        """ Stale entries are used when the store can't be reached """
+        self.cache.ttl = 0
+        self.cache.query('keystone')
+        self.mock_get.side_effect = requests.ConnectionError("offline")
+        self.assertEqual(self.cache.query('keystone'),
+                         dict(charm=dict(url='cs:trusty/keystone')))
+        self.assertRaises(CharmNotFoundError, self.cache.query, 'nova')
+
+    def test_query_many(self):
+        """ Parallel lookups keep order and report failures """
+        rv = self.cache.query_many(['keystone', 'missing', 'nova'],
+                                   return_exceptions=True)
+        self.assertEqual(rv[0]['charm']['url'], 'cs:trusty/keystone')
+        self.assertIsInstance(rv[1], CharmNotFoundError)
+        self.assertEqual(rv[2]['charm']['url'], 'cs:trusty/nova')
+        self.assertRaises(CharmNotFoundError, self.cache.query_many,
+                          ['missing'])